@@ -1,17 +1,16 @@
-import sqlite3
+"""
+Atualiza o schema do banco (colunas email/city/origin em leads).
 
-conn = sqlite3.connect("crm_whatsapp.db")
-cursor = conn.cursor()
+Mantido por compatibilidade: as alterações agora são migrações
+versionadas em migrations.py e rodam automaticamente no boot.
+"""
+from database import get_pool
+from migrations import run_migrations, get_schema_version
 
-cursor.execute("PRAGMA table_info(leads)")
-columns = [col[1] for col in cursor.fetchall()]
+pool = get_pool("crm_whatsapp.db")
+applied = run_migrations(pool)
 
-# Adiciona coluna 'origin' se não existir
-if "origin" not in columns:
-    cursor.execute("ALTER TABLE leads ADD COLUMN origin TEXT;")
-    print("✅ Coluna 'origin' adicionada com sucesso!")
+if applied:
+    print(f"✅ {applied} migração(ões) aplicada(s) com sucesso!")
 else:
-    print("ℹ️ A coluna 'origin' já existe.")
-
-conn.commit()
-conn.close()
+    print(f"ℹ️ Schema já está atualizado (versão {get_schema_version(pool.connection())}).")
@@ -1,14 +1,45 @@
-from flask import Flask, request, jsonify, session
+from config import config
+from concurrency import monkey_patch
+
+# Precisa vir antes de qualquer import que use socket/threading (modo eventlet)
+monkey_patch(config.SOCKETIO_ASYNC_MODE)
+
+from logs import setup_logging, get_logger, log_body
+
+setup_logging(
+    config.LOG_LEVEL,
+    config.LOG_FILE,
+    json_format=config.LOG_FORMAT == "json",
+    message_bodies=config.LOG_MESSAGE_BODIES,
+    body_sample_rate=config.LOG_BODY_SAMPLE_RATE,
+)
+logger = get_logger(__name__)
+
+from flask import Flask, request, jsonify, session, make_response, g
 from flask_socketio import SocketIO, join_room, leave_room
 from flask_cors import CORS
-from database import Database
+from database import Database, normalize_phone, query_stats
 from whatsapp_service import WhatsAppService
+from ingestion import MessageIngestor
+from outbox import OutboxDispatcher
+from campaigns import CampaignEngine, TEMPLATE_VARIABLES
+from health import HealthMonitor
+from metrics import registry, CONTENT_TYPE
+from realtime import session_rooms, lead_event_rooms, lead_room, parse_lead_room, GESTOR_ROLES
 from middlewares import (
     rate_limit, validate_request, handle_errors, 
     InputValidator, add_security_headers, AuditLogger
 )
-from utils import Paginator, MessageSearcher, LeadSearcher, PerformanceCache
+from utils import (
+    Paginator, MessageSearcher, LeadSearcher, PerformanceCache,
+    encode_cursor, decode_cursor, CURSOR_TIME_ID, CURSOR_ID
+)
 import asyncio
+import hashlib
+import hmac
+import time
+import uuid
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from functools import wraps
 from database_tags_sla import extend_database_with_tags_sla
 from datetime import datetime
@@ -22,29 +53,171 @@ app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # 16MB
 
 CORS(app, supports_credentials=True, origins=["http://localhost:3000"])
 
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "crm_http_request_duration_seconds",
+    "Latência dos requests HTTP por rota",
+    labels=("method", "route", "status"),
+)
+SOCKETIO_EMITS = registry.counter(
+    "crm_socketio_emits_total",
+    "Eventos Socket.IO emitidos pelo servidor",
+    labels=("event",),
+)
+
+
+class InstrumentedSocketIO(SocketIO):
+    """SocketIO que conta os eventos emitidos (inclusive pelas threads de fundo)"""
+    def emit(self, event, *args, **kwargs):
+        SOCKETIO_EMITS.inc(event=event)
+        return super().emit(event, *args, **kwargs)
+
+
+socketio = InstrumentedSocketIO(app, cors_allowed_origins="*", async_mode=config.SOCKETIO_ASYNC_MODE)
 
 # Inicialização dos serviços
-db = Database()
+db = Database(
+    config.DATABASE_NAME,
+    pool_size=config.DB_POOL_SIZE,
+    busy_timeout_ms=config.DB_BUSY_TIMEOUT_MS,
+    cache_size_kb=config.DB_CACHE_SIZE_KB,
+    mmap_size_mb=config.DB_MMAP_SIZE_MB,
+)
 extend_database_with_tags_sla(db)
-whatsapp = WhatsAppService(db, socketio)
+whatsapp = WhatsAppService(
+    db, socketio,
+    base_url=config.WHATSAPP_SERVICE_URL,
+    timeout=config.WHATSAPP_TIMEOUT,
+    connect_timeout=config.WHATSAPP_CONNECT_TIMEOUT,
+    max_retries=config.WHATSAPP_MAX_RETRIES,
+    pool_size=config.WHATSAPP_POOL_SIZE,
+    circuit_failures=config.WHATSAPP_CIRCUIT_FAILURES,
+    circuit_reset_seconds=config.WHATSAPP_CIRCUIT_RESET_SECONDS
+)
+ingestor = MessageIngestor(
+    db, socketio,
+    max_queue=config.INGEST_QUEUE_SIZE,
+    batch_size=config.INGEST_BATCH_SIZE,
+    max_delay_ms=config.INGEST_MAX_DELAY_MS,
+    recent_ids=config.INGEST_RECENT_IDS,
+)
+ingestor.start()
+health_monitor = HealthMonitor(db, whatsapp, socketio, interval=config.HEALTH_CHECK_INTERVAL)
+health_monitor.start()
+outbox = OutboxDispatcher(
+    db, whatsapp, socketio,
+    workers=config.OUTBOX_WORKERS,
+    max_attempts=config.OUTBOX_MAX_ATTEMPTS,
+    retry_base_seconds=config.OUTBOX_RETRY_BASE_SECONDS,
+    retry_max_seconds=config.OUTBOX_RETRY_MAX_SECONDS,
+    lease_seconds=config.OUTBOX_LEASE_SECONDS,
+    health=health_monitor,
+)
+outbox.start()
+campaigns = CampaignEngine(
+    db, whatsapp, outbox, socketio,
+    rate_per_minute=config.CAMPAIGN_RATE_PER_MINUTE,
+    burst=config.CAMPAIGN_BURST,
+    max_in_flight=config.CAMPAIGN_MAX_IN_FLIGHT,
+)
+campaigns.start()
 validator = InputValidator()
-audit_logger = AuditLogger(db)
+audit_logger = AuditLogger(
+    db,
+    buffer_size=config.AUDIT_BUFFER_SIZE,
+    batch_size=config.AUDIT_BATCH_SIZE,
+    flush_interval_ms=config.AUDIT_FLUSH_INTERVAL_MS,
+    overflow_policy=config.AUDIT_OVERFLOW_POLICY,
+)
+audit_logger.start()
 
 # Utilitários
 message_searcher = MessageSearcher(db)
 lead_searcher = LeadSearcher(db)
-cache = PerformanceCache(ttl_seconds=300)
+cache = PerformanceCache(
+    ttl_seconds=config.CACHE_TTL_SECONDS,
+    max_entries=config.CACHE_MAX_ENTRIES,
+    max_bytes=config.CACHE_MAX_BYTES,
+)
+# Escritas no banco invalidam o cache pelo tópico ("leads", "users", "tags", "sla")
+db.on_change(lambda topics: cache.invalidate(*topics))
+
+# =======================
+# MÉTRICAS (lidas na coleta de /metrics)
+# =======================
+def _stats_samples(stats, label="result"):
+    return [({label: key}, value) for key, value in stats.items()]
 
-print("🚀 CRM WhatsApp iniciado com todas as melhorias!")
+
+registry.gauge_callback("crm_ingest_queue_depth", "Mensagens do webhook aguardando gravação", ingestor.pending)
+registry.gauge_callback(
+    "crm_outbox_messages", "Mensagens na outbox por status",
+    lambda: [({"status": status}, db.count_outbox(status)) for status in ("queued", "sending")],
+    labels=("status",),
+)
+registry.gauge_callback("crm_audit_buffer_depth", "Eventos de auditoria aguardando gravação", audit_logger.pending)
+registry.gauge_callback("crm_whatsapp_circuit_open", "1 com o circuito do bridge aberto", lambda: int(whatsapp.circuit_open()))
+registry.gauge_callback(
+    "crm_whatsapp_connected", "1 com o WhatsApp conectado (último health check)",
+    lambda: int(health_monitor.snapshot()["whatsapp"]["connected"]),
+)
+registry.counter_callback(
+    "crm_ingest_messages_total", "Mensagens recebidas pelo webhook por resultado",
+    lambda: _stats_samples(ingestor.stats), labels=("result",),
+)
+registry.counter_callback(
+    "crm_outbox_events_total", "Envios da outbox por resultado",
+    lambda: _stats_samples(outbox.stats), labels=("result",),
+)
+registry.counter_callback(
+    "crm_campaign_events_total", "Mensagens de campanha enfileiradas e campanhas concluídas",
+    lambda: _stats_samples(campaigns.stats, "event"), labels=("event",),
+)
+registry.counter_callback(
+    "crm_audit_events_total", "Eventos de auditoria por resultado",
+    lambda: _stats_samples(audit_logger.stats), labels=("result",),
+)
+registry.counter_callback(
+    "crm_cache_lookups_total", "Consultas ao cache de respostas",
+    lambda: [({"result": "hit"}, cache.stats["hits"]), ({"result": "miss"}, cache.stats["misses"])],
+    labels=("result",),
+)
+registry.counter_callback(
+    "crm_db_slow_queries_total", f"Queries acima de {query_stats.slow_threshold}s",
+    lambda: query_stats.get_stats()["slow_total"],
+)
+
+logger.info("🚀 CRM WhatsApp iniciado com todas as melhorias!")
 
 # =======================
 # MIDDLEWARE GLOBAL
 # =======================
+@app.before_request
+def assign_request_id():
+    """Id do request (do proxy/bridge via X-Request-ID ou gerado) para os logs"""
+    g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+    g.request_started = time.perf_counter()
+
+
 @app.after_request
 def after_request(response):
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    if "request_started" in g:
+        # Rótulo pela regra (/api/leads/<int:lead_id>), não pela URL: cardinalidade fixa
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - g.request_started,
+            method=request.method,
+            route=request.url_rule.rule if request.url_rule else "unmatched",
+            status=response.status_code,
+        )
     return add_security_headers(response)
 
+
+@app.teardown_appcontext
+def release_db_connection(exc):
+    """Devolve a conexão SQLite da thread ao pool ao fim do request"""
+    db.release_connection()
+
 # =======================
 # DECORATORS DE SEGURANÇA
 # =======================
@@ -69,6 +242,76 @@ def role_required(*roles):
         return decorated
     return decorator
 
+# =======================
+# GET CONDICIONAL (ETag)
+# =======================
+def conditional_get(time_bucket_seconds=None):
+    """
+    ETag fraca a partir de db.get_data_version() + usuário + URL.
+
+    A versão vem do banco (trigger), então a ETag é a mesma em todos os
+    workers e muda com escritas de qualquer processo. Com If-None-Match
+    igual responde 304 lendo só essa linha. Use depois de
+    login_required/role_required. time_bucket_seconds entra na ETag para
+    respostas que mudam só com o passar do tempo (ex: alertas de SLA).
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            parts = [db.get_data_version(), session.get("user_id"), session.get("role"), request.full_path]
+            if time_bucket_seconds:
+                parts.append(int(time.time() // time_bucket_seconds))
+            etag = hashlib.sha1("|".join(map(str, parts)).encode()).hexdigest()[:24]
+
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
+        return decorated
+    return decorator
+
+# =======================
+# PAGINAÇÃO POR CURSOR
+# =======================
+def page_request(cursor_fields, id_params=(), default_limit=50, limit_is_legacy=False):
+    """
+    Lê os parâmetros de paginação por cursor do request.
+
+    Retorna None quando o cliente não pediu paginação (resposta antiga,
+    lista completa) ou os kwargs para o método *_page do banco.
+    A paginação é ativada por ?cursor=, ?paginate=1, pelos parâmetros de id
+    ou por ?limit= (exceto onde limit já existia com outro significado).
+    """
+    args = request.args
+    wants_page = "cursor" in args or "paginate" in args or any(p in args for p in id_params)
+    if not wants_page and not ("limit" in args and not limit_is_legacy):
+        return None
+
+    kwargs = decode_cursor(args["cursor"], cursor_fields) if "cursor" in args else {}
+    for param in id_params:
+        if param in args:
+            value = args.get(param, type=int)
+            if value is None:
+                raise ValueError(f"{param} deve ser numérico")
+            kwargs[param] = value
+
+    kwargs["limit"] = max(1, min(args.get("limit", default_limit, type=int), 200))
+    return kwargs
+
+
+def page_response(page):
+    """Serializa uma página no formato {items, has_more, next_cursor}"""
+    return jsonify({
+        "items": page["items"],
+        "has_more": page["has_more"],
+        "next_cursor": encode_cursor(page["next"]) if page["next"] else None
+    })
+
 # =======================
 # LOGIN / LOGOUT
 # =======================
@@ -126,7 +369,7 @@ def get_current_user():
 @rate_limit('per_minute')
 @role_required("admin", "gestor")
 def get_users():
-    return jsonify(db.get_all_users())
+    return jsonify(cache.get_or_set("users:all", db.get_all_users))
 
 
 @app.route("/api/users", methods=["POST"])
@@ -181,21 +424,46 @@ def change_password(user_id):
 @app.route("/api/leads", methods=["GET"])
 @rate_limit('per_minute')
 @login_required
+@conditional_get()
+@handle_errors
 def get_leads():
     role = session["role"]
     uid = session["user_id"]
-    leads = db.get_all_leads() if role in ["admin", "gestor"] else db.get_leads_by_vendedor(uid)
-    
-    # Adiciona tags a cada lead
-    for lead in leads:
-        lead['tags'] = db.get_lead_tags(lead['id'])
-    
+    page_args = page_request(cursor_fields=CURSOR_TIME_ID)
+    if page_args is not None:
+        assigned_to = None if role in ["admin", "gestor"] else uid
+        return page_response(db.get_leads_page(assigned_to=assigned_to, include_tags=True, **page_args))
+
+    if role in ["admin", "gestor"]:
+        leads = db.get_all_leads(include_tags=True)
+    else:
+        leads = db.get_leads_by_vendedor(uid, include_tags=True)
     return jsonify(leads)
 
 
+@app.route("/api/leads/changes", methods=["GET"])
+@rate_limit('per_minute')
+@login_required
+@conditional_get()
+@handle_errors
+def get_leads_changes():
+    """
+    Sync incremental: leads alterados desde ?since= e ids removidos da visão
+
+    Guarde next_since da resposta e repita enquanto has_more for true.
+    """
+    since = request.args.get("since", 0, type=int)
+    if since < 0:
+        raise ValueError("since deve ser >= 0")
+    limit = max(1, min(request.args.get("limit", 500, type=int), 1000))
+    assigned_to = None if session["role"] in ["admin", "gestor"] else session["user_id"]
+    return jsonify(db.get_lead_changes(since, assigned_to=assigned_to, limit=limit))
+
+
 @app.route("/api/leads/queue", methods=["GET"])
 @rate_limit('per_minute')
 @login_required
+@conditional_get()
 def get_leads_queue():
     leads = db.get_leads_by_status("novo")
     return jsonify(leads)
@@ -226,7 +494,7 @@ def assign_lead(lead_id):
     db.add_lead_log(lead_id, "lead_atribuido", uname, f"Lead atribuído para {uname}")
     audit_logger.log_action(uid, "lead_assigned", "lead", lead_id, f"Lead atribuído")
     
-    socketio.emit("lead_assigned", {"lead_id": lead_id, "vendedor_id": uid}, room="gestores")
+    socketio.emit("lead_assigned", {"lead_id": lead_id, "vendedor_id": uid}, to=lead_event_rooms(lead_id, uid))
     return jsonify({"success": True})
 
 
@@ -237,14 +505,18 @@ def assign_lead(lead_id):
 @handle_errors
 def update_lead_status(lead_id):
     data = request.json
-    status = data["status"]
+    valid, status = validator.validate_status(data["status"])
+    if not valid:
+        return jsonify({"error": status}), 400
     uname = session["name"]
     
     db.update_lead_status(lead_id, status)
     db.add_lead_log(lead_id, "status_alterado", uname, f"Status alterado para {status}")
     audit_logger.log_action(session["user_id"], "status_changed", "lead", lead_id, f"Status: {status}")
     
-    socketio.emit("lead_status_changed", {"lead_id": lead_id, "status": status}, room="gestores")
+    assigned_to = db.get_lead_assignees([lead_id]).get(lead_id)
+    socketio.emit("lead_status_changed", {"lead_id": lead_id, "status": status},
+                  to=lead_event_rooms(lead_id, assigned_to))
     return jsonify({"success": True})
 
 
@@ -258,11 +530,13 @@ def transfer_lead(lead_id):
     vendedor_id = data["vendedor_id"]
     uname = session["name"]
     
+    previous_vendedor = db.get_lead_assignees([lead_id]).get(lead_id)
     db.transfer_lead(lead_id, vendedor_id)
     db.add_lead_log(lead_id, "lead_transferido", uname, f"Lead transferido")
     audit_logger.log_action(session["user_id"], "lead_transferred", "lead", lead_id, f"Para vendedor {vendedor_id}")
     
-    socketio.emit("lead_transferred", {"lead_id": lead_id, "vendedor_id": vendedor_id}, room="gestores")
+    socketio.emit("lead_transferred", {"lead_id": lead_id, "vendedor_id": vendedor_id},
+                  to=lead_event_rooms(lead_id, vendedor_id, previous_vendedor))
     return jsonify({"success": True})
 
 # =======================
@@ -273,6 +547,10 @@ def transfer_lead(lead_id):
 @login_required
 @handle_errors
 def get_messages(lead_id):
+    page_args = page_request(cursor_fields=CURSOR_ID, id_params=("before_id", "after_id"))
+    if page_args is not None:
+        return page_response(db.get_messages_page(lead_id, **page_args))
+
     messages = db.get_messages_by_lead(lead_id)
     return jsonify(messages)
 
@@ -294,18 +572,155 @@ def send_message(lead_id):
     content = validator.sanitize_html(content)
     
     uid = session["user_id"]
-    uname = session["name"]
 
     lead = db.get_lead(lead_id)
     if not lead:
         return jsonify({"error": "Lead não encontrado"}), 404
 
-    success = whatsapp.send_message(lead["phone"], content, uid)
-    if success:
-        db.add_lead_log(lead_id, "mensagem_enviada", uname, content[:80])
-        audit_logger.log_action(uid, "message_sent", "message", lead_id, f"Mensagem enviada para lead {lead_id}")
+    # Entrega assíncrona: o resultado chega pelo Socket.IO (message_status)
+    outbox_id = outbox.enqueue(lead, content, uid)
+    audit_logger.log_action(uid, "message_queued", "message", lead_id, f"Mensagem #{outbox_id} na fila para lead {lead_id}")
     
-    return jsonify({"success": success})
+    return jsonify({"success": True, "queued": True, "outbox_id": outbox_id, "status": "queued"}), 202
+
+
+@app.route("/api/outbox/<int:outbox_id>", methods=["GET"])
+@rate_limit('per_minute')
+@login_required
+@handle_errors
+def get_outbox_status(outbox_id):
+    """Status de uma mensagem da fila de saída (queued/sending/sent/failed)"""
+    item = db.get_outbox_item(outbox_id)
+    if not item:
+        return jsonify({"error": "Mensagem não encontrada"}), 404
+    if session["role"] not in GESTOR_ROLES and item["user_id"] != session["user_id"]:
+        return jsonify({"error": "Sem permissão"}), 403
+    return jsonify(item)
+
+# =======================
+# CAMPANHAS (envio em massa)
+# =======================
+@app.route("/api/campaigns", methods=["POST"])
+@rate_limit('per_minute')
+@role_required("admin", "gestor")
+@validate_request('name', 'template')
+@handle_errors
+def create_campaign():
+    """
+    Cria uma campanha e começa a enviar (a menos que start=false)
+
+    Body: name, template (com {{nome}}, {{primeiro_nome}}...) e filters
+    (status, tag_id, assigned_to)
+    """
+    data = request.json
+    valid, template = validator.validate_text(data.get("template"), max_length=4096, field_name="Template")
+    if not valid:
+        return jsonify({"error": template}), 400
+    template = validator.sanitize_html(template)
+
+    filters = data.get("filters") or {}
+    filters = {k: filters[k] for k in ("status", "tag_id", "assigned_to") if filters.get(k) is not None}
+    if not filters:
+        return jsonify({"error": "Informe ao menos um filtro (status, tag_id ou assigned_to)"}), 400
+
+    try:
+        campaign_id, total = campaigns.create(
+            data["name"], template, filters, session["user_id"], start=data.get("start", True)
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e), "variables": list(TEMPLATE_VARIABLES)}), 400
+
+    audit_logger.log_action(session["user_id"], "campaign_created", "campaign", campaign_id,
+                            f"Campanha {data['name']} com {total} destinatários")
+    return jsonify({"success": True, "campaign_id": campaign_id, "total_recipients": total}), 201
+
+
+@app.route("/api/campaigns", methods=["GET"])
+@rate_limit('per_minute')
+@role_required("admin", "gestor")
+@handle_errors
+def list_campaigns():
+    return jsonify(db.get_campaigns())
+
+
+@app.route("/api/campaigns/<int:campaign_id>", methods=["GET"])
+@rate_limit('per_minute')
+@role_required("admin", "gestor")
+@handle_errors
+def get_campaign(campaign_id):
+    """Campanha com contadores de progresso (pending/queued/sent/failed/skipped)"""
+    campaign = db.get_campaign(campaign_id)
+    if not campaign:
+        return jsonify({"error": "Campanha não encontrada"}), 404
+    return jsonify(campaign)
+
+
+@app.route("/api/campaigns/<int:campaign_id>/<any(pause, resume, cancel):action>", methods=["POST"])
+@rate_limit('per_minute')
+@role_required("admin", "gestor")
+@handle_errors
+def change_campaign_status(campaign_id, action):
+    """pause / resume / cancel"""
+    operations = {"pause": campaigns.pause, "resume": campaigns.resume, "cancel": campaigns.cancel}
+    if not db.get_campaign(campaign_id):
+        return jsonify({"error": "Campanha não encontrada"}), 404
+    if not operations[action](campaign_id):
+        return jsonify({"error": f"Não é possível executar '{action}' no status atual"}), 409
+
+    audit_logger.log_action(session["user_id"], f"campaign_{action}", "campaign", campaign_id, "")
+    return jsonify({"success": True, "campaign": db.get_campaign(campaign_id)})
+
+
+@app.route("/api/campaigns/<int:campaign_id>/recipients", methods=["GET"])
+@rate_limit('per_minute')
+@role_required("admin", "gestor")
+@handle_errors
+def get_campaign_recipients(campaign_id):
+    """Resultado por destinatário; ?status= filtra, ?after=<id> pagina"""
+    limit = min(request.args.get("limit", 100, type=int), 500)
+    after_id = request.args.get("after", 0, type=int)
+    recipients = db.get_campaign_recipients(
+        campaign_id, status=request.args.get("status"), after_id=after_id, limit=limit
+    )
+    return jsonify({
+        "recipients": recipients,
+        "next_after": recipients[-1]["id"] if len(recipients) == limit else None
+    })
+
+
+@app.route("/api/messages/search", methods=["GET"])
+@rate_limit('per_minute')
+@login_required
+@handle_errors
+def search_messages():
+    """Busca full-text nas conversas (vendedores só veem os próprios leads)"""
+    term = request.args.get("q", "").strip()
+    if not term:
+        return jsonify({"error": "Informe o termo de busca (q)"}), 400
+
+    assigned_to = None if session["role"] in ["admin", "gestor"] else session["user_id"]
+    results = message_searcher.search_messages(
+        lead_id=request.args.get("lead_id", type=int),
+        search_term=term,
+        sender_type=request.args.get("sender_type"),
+        assigned_to=assigned_to,
+        limit=max(1, min(request.args.get("limit", 50, type=int), 200)),
+        offset=max(0, request.args.get("offset", 0, type=int))
+    )
+    return jsonify(results)
+
+
+@app.route("/api/leads/<int:lead_id>/messages/search", methods=["GET"])
+@rate_limit('per_minute')
+@login_required
+@handle_errors
+def search_lead_messages(lead_id):
+    """Busca em uma conversa, com as mensagens ao redor de cada resultado"""
+    term = request.args.get("q", "").strip()
+    if not term:
+        return jsonify({"error": "Informe o termo de busca (q)"}), 400
+
+    return jsonify(message_searcher.search_in_lead(lead_id, term))
 
 # =======================
 # NOTAS INTERNAS
@@ -313,7 +728,12 @@ def send_message(lead_id):
 @app.route("/api/leads/<int:lead_id>/notes", methods=["GET"])
 @rate_limit('per_minute')
 @login_required
+@handle_errors
 def get_notes(lead_id):
+    page_args = page_request(cursor_fields=CURSOR_TIME_ID)
+    if page_args is not None:
+        return page_response(db.get_internal_notes_page(lead_id, **page_args))
+
     return jsonify(db.get_internal_notes(lead_id))
 
 
@@ -340,7 +760,9 @@ def add_note(lead_id):
     
     audit_logger.log_action(uid, "note_added", "note", lead_id, "Nota interna adicionada")
 
-    socketio.emit("new_note", {"lead_id": lead_id, "note": note, "user_name": uname}, room="gestores")
+    assigned_to = db.get_lead_assignees([lead_id]).get(lead_id)
+    socketio.emit("new_note", {"lead_id": lead_id, "note": note, "user_name": uname},
+                  to=lead_event_rooms(lead_id, assigned_to))
     return jsonify({"success": True})
 
 # =======================
@@ -352,6 +774,10 @@ def add_note(lead_id):
 @handle_errors
 def get_lead_logs(lead_id):
     """Retorna histórico do lead"""
+    page_args = page_request(cursor_fields=CURSOR_ID, id_params=("before_id", "after_id"))
+    if page_args is not None:
+        return page_response(db.get_lead_logs_page(lead_id, **page_args))
+
     logs = db.get_lead_logs(lead_id)
     return jsonify(logs)
 
@@ -363,8 +789,12 @@ def get_lead_logs(lead_id):
 @login_required
 @handle_errors
 def get_metrics():
-    """Retorna métricas gerais do CRM"""
-    metrics = db.get_metrics_summary()
+    """Retorna métricas gerais do CRM (?vendedor_id= filtra por vendedor)"""
+    vendedor_id = request.args.get("vendedor_id", type=int)
+    metrics = cache.get_or_set(
+        f"leads:metrics:{vendedor_id}",
+        lambda: db.get_metrics_summary(vendedor_id=vendedor_id)
+    )
     return jsonify(metrics)
 
 # =======================
@@ -376,6 +806,10 @@ def get_metrics():
 @handle_errors
 def get_audit_log():
     """Retorna logs de auditoria"""
+    page_args = page_request(cursor_fields=CURSOR_TIME_ID, default_limit=100, limit_is_legacy=True)
+    if page_args is not None:
+        return page_response(db.get_audit_logs_page(**page_args))
+
     limit = request.args.get('limit', 100, type=int)
     logs = db.get_audit_logs(limit)
     return jsonify(logs)
@@ -389,12 +823,7 @@ def get_audit_log():
 def get_all_tags():
     """Retorna todas as tags disponíveis"""
     try:
-        conn = db.get_connection()
-        c = conn.cursor()
-        c.execute("SELECT * FROM tags ORDER BY name")
-        tags = [dict(r) for r in c.fetchall()]
-        conn.close()
-        return jsonify(tags)
+        return jsonify(cache.get_or_set("tags:all", db.get_all_tags))
     except:
         return jsonify([])
 
@@ -408,12 +837,9 @@ def create_tag():
     """Cria uma nova tag"""
     data = request.json
     try:
-        conn = db.get_connection()
-        c = conn.cursor()
-        c.execute("INSERT INTO tags (name, color) VALUES (?, ?)", (data["name"], data["color"]))
-        conn.commit()
-        tag_id = c.lastrowid
-        conn.close()
+        tag_id = db.create_tag(data["name"], data["color"])
+        if not tag_id:
+            return jsonify({"error": "Tag já existe"}), 400
         
         audit_logger.log_action(session["user_id"], "tag_created", "tag", tag_id, f"Tag {data['name']}")
         return jsonify({"success": True, "tag_id": tag_id})
@@ -441,11 +867,7 @@ def add_tag_to_lead(lead_id):
     tag_id = data["tag_id"]
     
     try:
-        conn = db.get_connection()
-        c = conn.cursor()
-        c.execute("INSERT OR IGNORE INTO lead_tags (lead_id, tag_id) VALUES (?, ?)", (lead_id, tag_id))
-        conn.commit()
-        conn.close()
+        db.add_tag_to_lead(lead_id, tag_id, session["user_id"])
         
         db.add_lead_log(lead_id, "tag_adicionada", session["name"], f"Tag ID {tag_id}")
         audit_logger.log_action(session["user_id"], "tag_added_to_lead", "lead", lead_id, f"Tag {tag_id}")
@@ -462,11 +884,7 @@ def add_tag_to_lead(lead_id):
 def remove_tag_from_lead(lead_id, tag_id):
     """Remove tag de um lead"""
     try:
-        conn = db.get_connection()
-        c = conn.cursor()
-        c.execute("DELETE FROM lead_tags WHERE lead_id = ? AND tag_id = ?", (lead_id, tag_id))
-        conn.commit()
-        conn.close()
+        db.remove_tag_from_lead(lead_id, tag_id)
         
         db.add_lead_log(lead_id, "tag_removida", session["name"], f"Tag ID {tag_id}")
         audit_logger.log_action(session["user_id"], "tag_removed_from_lead", "lead", lead_id, f"Tag {tag_id}")
@@ -497,22 +915,11 @@ def get_lead_sla(lead_id):
 @app.route("/api/sla/metrics", methods=["GET"])
 @rate_limit('per_minute')
 @role_required("admin", "gestor")
+@conditional_get()
 def get_sla_metrics():
     """Retorna métricas de SLA"""
     try:
-        conn = db.get_connection()
-        c = conn.cursor()
-        c.execute("""
-            SELECT 
-                COUNT(*) as total,
-                AVG(first_response_time) as avg_first_response,
-                AVG(resolution_time) as avg_resolution
-            FROM sla_tracking
-            WHERE first_response_time IS NOT NULL
-        """)
-        metrics = dict(c.fetchone())
-        conn.close()
-        return jsonify(metrics)
+        return jsonify(cache.get_or_set("sla:metrics", db.get_sla_metrics))
     except:
         return jsonify({})
 
@@ -520,23 +927,12 @@ def get_sla_metrics():
 @app.route("/api/sla/alerts", methods=["GET"])
 @rate_limit('per_minute')
 @role_required("admin", "gestor")
+@conditional_get(time_bucket_seconds=60)
 def get_sla_alerts():
     """Retorna alertas de SLA próximos do limite"""
     threshold = request.args.get('threshold', 5, type=int)
     try:
-        conn = db.get_connection()
-        c = conn.cursor()
-        c.execute("""
-            SELECT l.*, s.* 
-            FROM leads l
-            INNER JOIN sla_tracking s ON l.id = s.lead_id
-            WHERE s.first_response_time IS NULL 
-            AND (julianday('now') - julianday(l.created_at)) * 24 * 60 > ?
-            ORDER BY l.created_at ASC
-        """, (threshold,))
-        alerts = [dict(r) for r in c.fetchall()]
-        conn.close()
-        return jsonify(alerts)
+        return jsonify(db.get_leads_with_sla_alert(threshold))
     except:
         return jsonify([])
 
@@ -545,74 +941,185 @@ def get_sla_alerts():
 # =======================
 # Substitua o webhook existente (linha ~433 do app.py) por este código
 
+WEBHOOK_BATCH_MAX = 1000
+
+
+def parse_webhook_message(data):
+    """
+    Normaliza uma mensagem do bridge em evento de ingestão
+
+    Aceita formato Venom (from/body/notifyName), o simplificado
+    (phone/content/name) e o bruto do Baileys (key.remoteJid, message, pushName).
+    O id da mensagem no provedor (id, key.id ou messageId) vira provider_id.
+
+    Returns:
+        (evento, None) ou (None, motivo da recusa); mensagens enviadas por
+        nós (fromMe) voltam como (None, None)
+    """
+    key = data.get("key") or {}
+    if data.get("fromMe") or key.get("fromMe"):
+        return None, None
+
+    message = data.get("message") or {}
+    phone_raw = data.get("from") or data.get("phone") or key.get("remoteJid", "")
+    content = (data.get("body") or data.get("content")
+               or message.get("conversation")
+               or (message.get("extendedTextMessage") or {}).get("text", ""))
+    name = data.get("notifyName") or data.get("name") or data.get("pushName") or "Lead"
+
+    phone = normalize_phone(phone_raw)
+    content = str(content).strip()
+    name = str(name).strip()
+
+    if not phone.isdigit():
+        return None, f"Telefone inválido: {phone_raw}"
+    if not content:
+        return None, "Sem conteúdo"
+
+    provider_id = data.get("id") or key.get("id") or data.get("messageId")
+    if isinstance(provider_id, dict):
+        # Venom/wppconnect: {"_serialized": "false_5511...@c.us_3EB0...", ...}
+        provider_id = provider_id.get("_serialized") or provider_id.get("id")
+
+    return {
+        "phone": phone,
+        "name": name,
+        "content": content,
+        "provider_id": str(provider_id) if provider_id else None,
+        "received_at": datetime.now().isoformat()
+    }, None
+
+
+LOOPBACK_ADDRESSES = ("127.0.0.1", "::1")
+
+
+def _bearer_matches(token):
+    """Compara "Authorization: Bearer <token>" em tempo constante"""
+    supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    return hmac.compare_digest(supplied.encode(), token.encode())
+
+
+def webhook_authenticated():
+    """
+    Chamada do bridge do WhatsApp: com WEBHOOK_TOKEN, quem manda o token;
+    sem ele, só chamadas de localhost (bridge na mesma máquina)
+    """
+    if config.WEBHOOK_TOKEN:
+        return _bearer_matches(config.WEBHOOK_TOKEN)
+    return request.remote_addr in LOOPBACK_ADDRESSES
+
+
+def webhook_required(f):
+    """Com WEBHOOK_TOKEN configurado, recusa chamadas sem o token"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if config.WEBHOOK_TOKEN and not webhook_authenticated():
+            return jsonify({"error": "Não autenticado"}), 401
+        return f(*args, **kwargs)
+    return decorated
+
+
+def _retry_later(seconds=1):
+    """503 com Retry-After: o bridge reenvia a mensagem"""
+    response = jsonify({"error": "Servidor ocupado, tente novamente"})
+    response.headers["Retry-After"] = str(seconds)
+    return response, 503
+
+
 @app.route("/api/webhook/message", methods=["POST"])
-@rate_limit('per_hour')
+@webhook_required
+@rate_limit('per_hour', exempt=webhook_authenticated)
 @handle_errors
 def webhook_message():
     data = request.get_json(force=True)
-    print(f"📩 Webhook recebido: {data}")
 
     try:
         # ✅ Suporta tanto formato Baileys (from/body) quanto Venom (phone/content)
-        phone_raw = data.get("from") or data.get("phone", "")
-        content = data.get("body") or data.get("content", "")
-        name = data.get("notifyName") or data.get("name", "Lead")
-        
-        # Limpa telefone
-        phone = str(phone_raw).strip().replace("+", "").replace(" ", "").replace("-", "").replace("@c.us", "").replace("@s.whatsapp.net", "")
-        content = str(content).strip()
-        name = str(name).strip()
-        timestamp = datetime.now().isoformat()
-
-        print(f"📞 Telefone limpo: {phone}")
-        print(f"💬 Conteúdo: {content[:50]}...")
-        print(f"👤 Nome: {name}")
-
-        if not phone.isdigit():
-            print(f"⚠️ Telefone inválido recebido: {phone_raw} -> {phone}")
-            return jsonify({"error": "Telefone inválido"}), 400
-
-        if not content:
-            print("⚠️ Webhook ignorado (sem conteúdo).")
-            return jsonify({"error": "Sem conteúdo"}), 400
-
-        # 🔹 Cria ou busca o lead
-        lead = db.create_or_get_lead(phone, name)
-        
-        if not lead:
-            print(f"❌ Erro ao criar/buscar lead para {phone}")
-            return jsonify({"error": "Erro ao processar lead"}), 500
-
-        # 🔹 Registra mensagem
-        db.add_message(lead["id"], "lead", name, content)
-
-        # 🔹 Log de histórico
-        db.add_lead_log(lead["id"], "mensagem_recebida", name, content[:100])
-
-        # 🔹 Emite atualização em tempo real
-        socketio.emit("new_message", {
-            "lead_id": lead["id"],
-            "phone": phone,
-            "name": name,
-            "content": content,
-            "timestamp": timestamp,
-            "sender_type": "lead"
-        }, room="gestores")
-
-        print(f"✅ Mensagem processada com sucesso!")
-        print(f"   Lead ID: {lead['id']}")
-        print(f"   Nome: {name}")
-        print(f"   Telefone: {phone}")
-        print("")
-        
-        return jsonify({"success": True, "lead_id": lead["id"]}), 200
+        event, error = parse_webhook_message(data)
+        if error:
+            logger.warning("⚠️ Webhook recusado: %s", error)
+            return jsonify({"error": error.split(":")[0]}), 400
+        if not event:
+            return jsonify({"success": True, "ignored": True}), 200
+
+        # 🔹 Enfileira para gravação em lote (lead + mensagem + timeline + evento em tempo real)
+        # Reentrega do bridge: não enfileira, espera a gravação da original
+        future, duplicate = ingestor.submit(event)
+        if future is None:
+            logger.warning("⚠️ Fila de ingestão cheia, mensagem recusada", extra={"phone": event["phone"]})
+            return _retry_later()
+
+        # Só confirma para o bridge depois do COMMIT do lote
+        try:
+            lead_id = future.result(timeout=config.INGEST_ACK_TIMEOUT_MS / 1000)
+        except FutureTimeoutError:
+            # Provavelmente ainda será gravada; a reentrega cai na deduplicação
+            logger.warning("⚠️ Gravação da mensagem demorou, bridge deve reenviar", extra={"phone": event["phone"]})
+            return _retry_later()
+
+        if duplicate:
+            logger.debug("♻️ Mensagem já recebida, ignorada", extra={"provider_id": event["provider_id"]})
+            return jsonify({"success": True, "duplicate": True, "lead_id": lead_id}), 200
+
+        logger.info("📩 Mensagem gravada", extra={
+            "lead_id": lead_id,
+            "phone": event["phone"],
+            "provider_id": event["provider_id"],
+            "content": log_body(event["content"]),
+        })
+
+        return jsonify({"success": True, "lead_id": lead_id}), 200
     
     except Exception as e:
-        print(f"❌ Erro no webhook: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Erro no webhook: %s", e)
         return jsonify({"error": str(e)}), 500
 
+
+@app.route("/api/webhook/messages", methods=["POST"])
+@webhook_required
+@rate_limit('per_hour', exempt=webhook_authenticated)
+@handle_errors
+def webhook_messages():
+    """
+    Webhook em lote (history sync / backlog de reconexão do bridge)
+
+    Body: lista de mensagens no formato do /api/webhook/message, ou
+    {"messages": [...]}. Tudo é gravado numa única transação e cada lead
+    afetado recebe um único evento em tempo real.
+    """
+    data = request.get_json(force=True)
+    messages = data.get("messages") if isinstance(data, dict) else data
+    if not isinstance(messages, list):
+        return jsonify({"error": "Envie uma lista de mensagens"}), 400
+    if len(messages) > WEBHOOK_BATCH_MAX:
+        return jsonify({"error": f"Máximo de {WEBHOOK_BATCH_MAX} mensagens por lote"}), 413
+
+    events, rejected, ignored, duplicates = [], [], 0, 0
+    for index, item in enumerate(messages):
+        event, error = parse_webhook_message(item if isinstance(item, dict) else {})
+        if event:
+            events.append(event)
+        elif error:
+            rejected.append({"index": index, "error": error})
+        else:
+            ignored += 1
+
+    written = 0
+    if events:
+        written, repeated = ingestor.ingest_batch(events)
+        duplicates += repeated
+    logger.info("📩 Webhook em lote", extra={
+        "written": written, "duplicates": duplicates, "rejected": len(rejected), "ignored": ignored
+    })
+
+    return jsonify({
+        "success": True,
+        "written": written,
+        "duplicates": duplicates,
+        "ignored": ignored,
+        "rejected": rejected
+    })
+
 # =======================
 # SIMULADOR (Modo Desenvolvimento)
 # =======================
@@ -641,6 +1148,7 @@ def simulate_message():
 @app.route("/api/whatsapp/status", methods=["GET"])
 @login_required
 def whatsapp_status():
+    """Estado da última verificação do monitor (não chama o bridge)"""
     return jsonify(whatsapp.get_status())
 
 # =======================
@@ -648,39 +1156,84 @@ def whatsapp_status():
 # =======================
 @socketio.on("connect")
 def on_connect():
-    print("🔌 Cliente conectado")
+    """Entra nas salas do usuário logado (user:<id> e, para gestores, role:gestor)"""
+    if "user_id" not in session:
+        logger.debug("🔌 Cliente conectado sem sessão (não recebe eventos)")
+        return
+    for room in session_rooms(session["user_id"], session.get("role")):
+        join_room(room)
+    logger.debug("🔌 Cliente conectado: usuário %s", session["user_id"])
 
 @socketio.on("disconnect")
 def on_disconnect():
-    print("🔌 Cliente desconectado")
+    logger.debug("🔌 Cliente desconectado")
+
+def can_watch_lead(lead_id):
+    """Gestores acompanham qualquer lead; vendedores, os seus e os da fila"""
+    if session.get("role") in GESTOR_ROLES:
+        return True
+    lead = db.get_lead(lead_id)
+    return bool(lead) and lead.get("assigned_to") in (None, session["user_id"])
 
 @socketio.on("join_room")
 def on_join(data):
-    room = data.get("room")
-    join_room(room)
-    print(f"📍 Entrou na sala: {room}")
+    """Só salas de lead (lead:<id>) podem ser pedidas pelo cliente"""
+    if "user_id" not in session:
+        return
+    room = (data or {}).get("room")
+    lead_id = parse_lead_room(room)
+    if lead_id is None:
+        # 'gestores' e afins: as salas de usuário/role já vêm da sessão
+        logger.debug("⚠️ Sala ignorada: %s", room)
+        return
+    if not can_watch_lead(lead_id):
+        logger.warning("🚫 Usuário %s sem acesso à sala %s", session["user_id"], room)
+        return
+    join_room(lead_room(lead_id))
+    logger.debug("📍 Entrou na sala: %s", room)
 
 @socketio.on("leave_room")
 def on_leave(data):
-    room = data.get("room")
-    leave_room(room)
-    print(f"📍 Saiu da sala: {room}")
+    lead_id = parse_lead_room((data or {}).get("room"))
+    if lead_id is None:
+        return
+    leave_room(lead_room(lead_id))
+    logger.debug("📍 Saiu da sala: lead:%s", lead_id)
 
 # =======================
 # HEALTH CHECK
 # =======================
 @app.route("/health", methods=["GET"])
 def health_check():
-    """Health check para monitoramento"""
-    whatsapp_status = whatsapp.ensure_connected()
+    """Health check para monitoramento (responde do estado do HealthMonitor, sem I/O)"""
+    state = health_monitor.snapshot()
     return jsonify({
-        "status": "healthy" if whatsapp_status else "degraded",
+        "status": state["status"],
         "timestamp": datetime.now().isoformat(),
+        "checked_at": state["checked_at"],
         "services": {
-            "database": "ok",
-            "whatsapp": "connected" if whatsapp_status else "disconnected"
-        }
-    })
+            "database": "ok" if state["database"]["ok"] else "error",
+            "whatsapp": "connected" if state["whatsapp"]["connected"] else "disconnected"
+        },
+        "cache": cache.get_stats()
+    }), 503 if state["status"] == "unhealthy" else 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Métricas no formato do Prometheus
+
+    Interno: sem METRICS_TOKEN só responde para localhost; com ele, exige
+    "Authorization: Bearer <METRICS_TOKEN>".
+    """
+    if config.METRICS_TOKEN:
+        allowed = _bearer_matches(config.METRICS_TOKEN)
+    else:
+        allowed = request.remote_addr in LOOPBACK_ADDRESSES
+    if not allowed:
+        return jsonify({"error": "Acesso negado"}), 403
+    return registry.render(), 200, {"Content-Type": CONTENT_TYPE}
 
 # =======================
 # INICIALIZAÇÃO
@@ -697,10 +1250,11 @@ if __name__ == "__main__":
     print("✅ Cache de performance configurado")
     print("✅ Webhook CORRIGIDO para VenomBot")
     print("=" * 60)
-    print("🌐 API: http://localhost:5000")
+    print(f"⚙️ Modo do servidor: {config.SOCKETIO_ASYNC_MODE}")
+    print(f"🌐 API: http://localhost:{config.PORT}")
     print("🔌 Socket.io ativo")
     print("📊 Health check: http://localhost:5000/health")
     print("📡 Webhook: http://localhost:5000/api/webhook/message")
     print("=" * 60)
 
-    socketio.run(app, debug=False, host="0.0.0.0", port=5000)
\ No newline at end of file
+    socketio.run(app, debug=False, host=config.HOST, port=config.PORT)
@@ -0,0 +1,225 @@
+"""
+Campanhas de envio em massa (broadcast)
+
+A campanha é criada com um template e um seletor de leads (status, tag,
+vendedor); os destinatários são resolvidos numa única consulta e gravados
+em campaign_recipients. Uma thread alimenta a outbox aos poucos:
+
+- token bucket por número de WhatsApp (taxa + rajada), para não ser banido;
+- no máximo `max_in_flight` mensagens de campanha aguardando na outbox,
+  para não atrasar as conversas normais dos vendedores.
+
+A entrega, os retries e o resultado por destinatário ficam com a outbox
+(um trigger copia sent/failed para campaign_recipients). O progresso vai
+para os gestores pelo Socket.IO (evento campaign_progress).
+"""
+import atexit
+import re
+import threading
+import time
+
+from realtime import GESTOR_ROOM
+from utils import TokenBucket
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+# Variáveis aceitas no template: {{nome}}, {{primeiro_nome}}...
+TEMPLATE_VARIABLES = ("nome", "primeiro_nome", "telefone", "cidade", "vendedor", "status")
+_VARIABLE_RE = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+
+def template_variables(template):
+    """Nomes das variáveis usadas no template"""
+    return set(_VARIABLE_RE.findall(template))
+
+
+def render_template(template, lead):
+    """
+    Troca as variáveis pelos dados do lead
+
+    Args:
+        lead: dict com name, phone, city, status e vendedor
+    """
+    name = (lead.get("name") or "").strip()
+    values = {
+        "nome": name,
+        "primeiro_nome": name.split()[0] if name else "",
+        "telefone": lead.get("phone") or "",
+        "cidade": lead.get("city") or "",
+        "vendedor": lead.get("vendedor") or "",
+        "status": lead.get("status") or "",
+    }
+    return _VARIABLE_RE.sub(lambda m: values.get(m.group(1), m.group(0)), template)
+
+
+class CampaignEngine:
+    """
+    Alimenta a outbox com os destinatários das campanhas em andamento
+
+    Usage:
+        campaigns = CampaignEngine(db, whatsapp, outbox, socketio, rate_per_minute=20)
+        campaigns.start()
+        campaign_id, total = campaigns.create("Promo", "Olá {{primeiro_nome}}!", {"status": "novo"}, user_id)
+        campaigns.pause(campaign_id)
+    """
+    _PROGRESS_INTERVAL = 1.0  # segundos entre eventos de progresso da mesma campanha
+
+    def __init__(self, database, whatsapp, outbox, socketio, rate_per_minute=20, burst=5,
+                 max_in_flight=4, poll_interval=1.0):
+        self.db = database
+        self.whatsapp = whatsapp
+        self.outbox = outbox
+        self.socketio = socketio
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self._buckets = {}
+        self._turn = 0
+        self._last_progress = {}
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {
+            "queued": 0,
+            "completed": 0,
+        }
+
+    # =============================
+    # CICLO DE VIDA
+    # =============================
+    def start(self):
+        """Inicia a thread (idempotente); campanhas 'running' continuam de onde pararam"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="campaign-engine", daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        self._wakeup.set()
+        thread = self._thread
+        if thread and thread.is_alive():
+            thread.join(timeout)
+
+    # =============================
+    # OPERAÇÕES (request thread)
+    # =============================
+    def create(self, name, template, filters, user_id=None, start=True):
+        """
+        Cria a campanha e resolve os destinatários
+
+        Raises:
+            ValueError: template com variável desconhecida
+
+        Returns:
+            (campaign_id, total_recipients)
+        """
+        unknown = template_variables(template) - set(TEMPLATE_VARIABLES)
+        if unknown:
+            raise ValueError(f"Variáveis desconhecidas no template: {', '.join(sorted(unknown))}")
+        campaign_id, total = self.db.create_campaign(
+            name, template, filters, user_id, status="running" if start else "paused"
+        )
+        self._wakeup.set()
+        return campaign_id, total
+
+    def pause(self, campaign_id):
+        """Para de alimentar a outbox (o que já está na fila ainda é entregue)"""
+        return self._transition(campaign_id, "paused", ("running",))
+
+    def resume(self, campaign_id):
+        return self._transition(campaign_id, "running", ("paused",))
+
+    def cancel(self, campaign_id):
+        """Cancela; destinatários ainda pendentes ficam 'skipped'"""
+        return self._transition(campaign_id, "cancelled", ("running", "paused"))
+
+    def _transition(self, campaign_id, status, from_statuses):
+        if not self.db.set_campaign_status(campaign_id, status, from_statuses):
+            return False
+        self._emit_progress(campaign_id, status, force=True)
+        self._wakeup.set()
+        return True
+
+    # =============================
+    # ALIMENTAÇÃO DA OUTBOX (thread)
+    # =============================
+    def _bucket(self):
+        """Token bucket do número de WhatsApp conectado"""
+        number = self.whatsapp.phone or "default"
+        bucket = self._buckets.get(number)
+        if bucket is None:
+            bucket = self._buckets[number] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                delay = self._tick()
+            except Exception as e:
+                logger.exception("❌ Erro no motor de campanhas: %s", e)
+                delay = self.poll_interval
+            finally:
+                self.db.release_connection()
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+
+    def _tick(self):
+        """Uma rodada: enfileira o que a taxa permite; retorna quanto esperar"""
+        campaigns = self.db.get_running_campaigns()
+        if not campaigns:
+            return self.poll_interval
+
+        progress = {c["id"]: self.db.get_campaign_progress(c["id"]) for c in campaigns}
+        for campaign in campaigns:
+            p = progress[campaign["id"]]
+            if not p["pending"] and not p["queued"] and self.db.finish_campaign_if_done(campaign["id"]):
+                self.stats["completed"] += 1
+                logger.info("📣 Campanha #%d concluída: %d enviadas, %d falhas", campaign["id"], p["sent"], p["failed"])
+                self._emit_progress(campaign["id"], "completed", p, force=True)
+            else:
+                self._emit_progress(campaign["id"], "running", p)
+
+        # Bridge fora do ar: não adianta encher a outbox
+        if self.whatsapp.circuit_open():
+            return self.poll_interval
+
+        active = [c for c in campaigns if progress[c["id"]]["pending"]]
+        room = self.max_in_flight - sum(progress[c["id"]]["queued"] for c in campaigns)
+        bucket = self._bucket()
+        queued = 0
+        # Rodízio entre campanhas para uma não segurar as outras
+        while active and room > 0 and bucket.try_acquire():
+            campaign = active[self._turn % len(active)]
+            self._turn += 1
+            if self.db.queue_campaign_recipients(campaign, 1, render_template):
+                queued += 1
+                room -= 1
+            else:
+                # Campanha sem pendentes: a ficha não foi usada
+                bucket.refund()
+                active.remove(campaign)
+
+        if queued:
+            self.stats["queued"] += queued
+            self.outbox.notify()
+        if active and room > 0:
+            return min(self.poll_interval, max(bucket.wait_time(), 0.05))
+        return self.poll_interval
+
+    def _emit_progress(self, campaign_id, status, progress=None, force=False):
+        if progress is None:
+            progress = self.db.get_campaign_progress(campaign_id)
+        payload = {"campaign_id": campaign_id, "status": status, **progress}
+        now = time.monotonic()
+        last_at, last_payload = self._last_progress.get(campaign_id, (0, None))
+        if not force and (payload == last_payload or now - last_at < self._PROGRESS_INTERVAL):
+            return
+        self._last_progress[campaign_id] = (now, payload)
+        self.socketio.emit("campaign_progress", payload, to=GESTOR_ROOM)
@@ -0,0 +1,47 @@
+"""
+Modo cooperativo (eventlet) do servidor
+
+Em SOCKETIO_ASYNC_MODE=eventlet cada conexão websocket ociosa é um green
+thread, não uma thread do SO. Para isso:
+- monkey_patch() precisa rodar antes de qualquer outro import (topo do app.py);
+  sockets (requests para o bridge do WhatsApp), time.sleep, queue e threading
+  passam a ceder o controle em vez de bloquear o processo
+- chamadas ao SQLite são código C bloqueante: offload_blocking() as executa
+  no pool de threads do eventlet (tpool) para não travar o hub
+
+No modo threading tudo aqui é no-op.
+"""
+import sys
+
+ASYNC_MODES = ("threading", "eventlet")
+
+
+def monkey_patch(async_mode):
+    """Aplica o monkey patching do eventlet quando o modo pedir"""
+    if async_mode not in ASYNC_MODES:
+        raise ValueError(f"SOCKETIO_ASYNC_MODE deve ser um de: {', '.join(ASYNC_MODES)}")
+    if async_mode != "eventlet":
+        return False
+
+    import eventlet
+    eventlet.monkey_patch()
+    return True
+
+
+def green_mode():
+    """True quando o processo está rodando com eventlet monkey-patched"""
+    eventlet = sys.modules.get("eventlet")
+    return eventlet is not None and eventlet.patcher.is_monkey_patched("thread")
+
+
+def offload_blocking(obj, autowrap=()):
+    """
+    Proxy que executa os métodos de obj no tpool do eventlet
+
+    Objetos retornados dos tipos em autowrap (ex: sqlite3.Cursor) também são
+    embrulhados. Fora do modo eventlet devolve obj sem alteração.
+    """
+    if not green_mode():
+        return obj
+    from eventlet import tpool
+    return tpool.Proxy(obj, autowrap=autowrap)
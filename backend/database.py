@@ -1,106 +1,311 @@
 import sqlite3
 import hashlib
+import json
+import threading
+import time
+from contextlib import contextmanager
 
-class Database:
-    def __init__(self, db_name="crm_whatsapp.db"):
+from concurrency import offload_blocking
+from migrations import run_migrations
+from utils import LRUCache, QueryOptimizer
+from logs import get_logger
+from metrics import registry, DB_BUCKETS
+
+logger = get_logger(__name__)
+
+# Status válidos de um lead, na ordem do funil
+LEAD_STATUSES = ['novo', 'em_atendimento', 'qualificado', 'negociacao', 'ganho', 'perdido']
+
+
+def normalize_phone(phone):
+    """Normaliza telefone/JID do WhatsApp para só dígitos (ex: 5551999999999)"""
+    phone = str(phone).strip()
+    for token in ("@c.us", "@s.whatsapp.net", "+", " ", "-"):
+        phone = phone.replace(token, "")
+    return phone
+
+
+# =======================
+# POOL DE CONEXÕES
+# =======================
+DB_QUERY_SECONDS = registry.histogram(
+    "crm_db_query_duration_seconds",
+    "Tempo de execução dos statements SQL",
+    labels=("statement",),
+    buckets=DB_BUCKETS,
+)
+
+# Estatísticas de todas as queries; as lentas ficam em query_stats.get_stats()
+query_stats = QueryOptimizer(slow_threshold=0.25)
+
+
+def _observe_query(sql, seconds):
+    words = sql.split(None, 1)
+    statement = words[0].upper() if words else "?"
+    DB_QUERY_SECONDS.observe(seconds, statement=statement)
+    query_stats.log_query(sql, seconds)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor que mede cada execute/executemany (métrica crm_db_query_duration_seconds)"""
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _observe_query(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _observe_query(sql, time.perf_counter() - started)
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    Conexão gerenciada pelo pool.
+    close() apenas devolve a conexão; quem fecha de verdade é o pool.
+
+    Todo statement passa por TimedCursor: conn.execute() do sqlite3 não usa
+    conn.cursor(), por isso execute/executemany são refeitos aqui em cima dele.
+    """
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            _observe_query("COMMIT", time.perf_counter() - started)
+
+    def close(self):
+        pass
+
+    def _close(self):
+        super().close()
+
+
+class ConnectionPool:
+    """
+    Pool de conexões SQLite thread-safe.
+
+    Cada thread recebe uma conexão própria (reaproveitada entre requests),
+    aberta uma única vez com WAL, synchronous=NORMAL, busy timeout e cache.
+    Conexões ociosas voltam para o pool em release().
+    """
+    def __init__(self, db_name, pool_size=8, busy_timeout_ms=5000,
+                 cache_size_kb=16384, mmap_size_mb=128):
         self.db_name = db_name
-        self.init_db()
+        self.pool_size = pool_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size_mb = mmap_size_mb
+        self._idle = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
 
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_name)
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=self.busy_timeout_ms / 1000,
+            isolation_level=None,  # autocommit; transações explícitas via transaction()
+            check_same_thread=False,
+            factory=PooledConnection,
+        )
         conn.row_factory = sqlite3.Row  # ← permite acessar colunas por nome
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size_mb) * 1024 * 1024}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        # No modo eventlet as chamadas ao SQLite rodam no tpool (não travam o hub)
+        return offload_blocking(conn, autowrap=(sqlite3.Cursor,))
+
+    def connection(self):
+        """Retorna a conexão da thread atual (pega do pool ou abre uma nova)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._connect()
+            self._local.conn = conn
+            self._local.depth = 0
+            self._local.after_commit = []
         return conn
 
-    # =======================
-    # INICIALIZAÇÃO
-    # =======================
-    def init_db(self):
-        conn = self.get_connection()
-        c = conn.cursor()
-
-        # Usuários
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE,
-                password TEXT,
-                name TEXT,
-                role TEXT,
-                active INTEGER DEFAULT 1
-            )
-        """)
+    def release(self):
+        """Devolve a conexão da thread atual ao pool (fim do request)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.depth:
+            return
+        self._local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn._close()
 
-        # Leads
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS leads (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT,
-                phone TEXT,
-                status TEXT DEFAULT 'novo',
-                assigned_to INTEGER,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+    @contextmanager
+    def transaction(self):
+        """
+        Transação explícita (BEGIN IMMEDIATE ... COMMIT/ROLLBACK).
+        Transações aninhadas na mesma thread participam da transação externa.
+        """
+        conn = self.connection()
+        local = self._local
+        if local.depth == 0:
+            conn.execute("BEGIN IMMEDIATE")
+            local.state = {}
+        local.depth += 1
+        try:
+            yield conn
+        except BaseException:
+            local.depth -= 1
+            if local.depth == 0:
+                conn.rollback()
+                local.after_commit = []
+            raise
+        local.depth -= 1
+        if local.depth == 0:
+            conn.commit()
+            callbacks, local.after_commit = local.after_commit, []
+            for callback in callbacks:
+                self._run_callback(callback)
 
-        # Mensagens
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                lead_id INTEGER,
-                sender_type TEXT,
-                sender_name TEXT,
-                content TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+    def after_commit(self, callback):
+        """
+        Agenda callback() para depois do COMMIT da transação da thread atual
+        (ou executa já, se não houver transação aberta). Descartado no rollback.
+        """
+        self.connection()
+        if self._local.depth:
+            self._local.after_commit.append(callback)
+        else:
+            self._run_callback(callback)
 
-        # Notas internas
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS internal_notes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                lead_id INTEGER,
-                user_id INTEGER,
-                note TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+    def transaction_state(self):
+        """Dict próprio da transação aberta na thread atual (None fora de transação)"""
+        self.connection()
+        return self._local.state if self._local.depth else None
 
-        # Logs de auditoria
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS audit_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                action TEXT,
-                entity_type TEXT,
-                entity_id INTEGER,
-                details TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+    @staticmethod
+    def _run_callback(callback):
+        try:
+            callback()
+        except Exception as e:
+            logger.exception("❌ Erro em callback pós-commit: %s", e)
 
-        # Timeline do lead
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS lead_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                lead_id INTEGER NOT NULL,
-                action TEXT NOT NULL,
-                user_name TEXT NOT NULL,
-                details TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (lead_id) REFERENCES leads(id)
-            )
-        """)
+    def close_all(self):
+        """Fecha todas as conexões ociosas e a da thread atual"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn._close()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and not self._local.depth:
+            self._local.conn = None
+            conn._close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_name, **options):
+    """Retorna o pool compartilhado de um arquivo de banco (cria no primeiro uso)"""
+    with _pools_lock:
+        pool = _pools.get(db_name)
+        if pool is None:
+            pool = _pools[db_name] = ConnectionPool(db_name, **options)
+        return pool
+
+
+class Database:
+    def __init__(self, db_name="crm_whatsapp.db", lead_cache_size=50000, **pool_options):
+        self.db_name = db_name
+        self.pool = get_pool(db_name, **pool_options)
+        self._lead_ids_by_phone = LRUCache(max_entries=lead_cache_size)
+        self._change_listeners = []
+        self._users_by_id = None
+        self._users_lock = threading.Lock()
+        self.on_change(self._invalidate_user_directory)
+        self.init_db()
 
-        conn.commit()
+    def on_change(self, callback):
+        """
+        Registra callback(topics) chamado depois que dados mudam
+
+        Tópicos: "leads", "users", "tags", "sla". Dentro de transação o aviso
+        só sai após o commit (nunca para uma escrita desfeita).
+        """
+        self._change_listeners.append(callback)
+
+    def notify_change(self, *topics):
+        """
+        Avisa os listeners de on_change que os tópicos mudaram
+
+        Vários avisos na mesma transação viram um único disparo no commit.
+        """
+        state = self.pool.transaction_state()
+        if state is None:
+            self.pool.after_commit(lambda: self._dispatch_change(topics))
+            return
+        pending = state.get("changed_topics")
+        if pending is None:
+            pending = state["changed_topics"] = set()
+            self.pool.after_commit(lambda: self._dispatch_change(tuple(sorted(pending))))
+        pending.update(topics)
+
+    def _dispatch_change(self, topics):
+        for callback in self._change_listeners:
+            callback(topics)
+
+    def get_data_version(self):
+        """
+        Versão global dos dados (ETags): "epoch:contador" da tabela data_version
+
+        Mantida por trigger, então vê escritas de qualquer processo.
+        """
+        row = self.get_connection().execute("SELECT epoch, value FROM data_version WHERE id = 1").fetchone()
+        return f"{row[0]}:{row[1]}"
+
+    def get_connection(self):
+        """Conexão da thread atual; close() é opcional (a conexão volta ao pool)"""
+        return self.pool.connection()
+
+    def transaction(self):
+        """Context manager de transação: with db.transaction() as conn: ..."""
+        return self.pool.transaction()
+
+    def release_connection(self):
+        """Devolve a conexão da thread atual ao pool"""
+        self.pool.release()
+
+    # =======================
+    # INICIALIZAÇÃO
+    # =======================
+    def init_db(self):
+        """Aplica migrações pendentes do schema (ver migrations.py)"""
+        run_migrations(self.pool)
 
         # Usuário admin padrão
-        c.execute("SELECT * FROM users WHERE username = 'admin'")
-        if not c.fetchone():
+        admin = self.get_connection().execute("SELECT 1 FROM users WHERE username = 'admin'").fetchone()
+        if not admin:
             self.create_user("admin", "admin123", "Administrador", "admin")
-            print("👤 Usuário criado: admin / admin123")
-
-        conn.close()
+            logger.warning("👤 Usuário criado: admin / admin123")
 
     # =======================
     # USUÁRIOS
@@ -110,247 +315,757 @@ class Database:
 
     def authenticate_user(self, username, password):
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("SELECT * FROM users WHERE username = ? AND active = 1", (username,))
-        user = c.fetchone()
-        conn.close()
+        user = conn.execute("SELECT * FROM users WHERE username = ? AND active = 1", (username,)).fetchone()
         if user and user["password"] == self.hash_password(password):
             return dict(user)
         return None
 
     def create_user(self, username, password, name, role):
         try:
-            conn = self.get_connection()
-            c = conn.cursor()
-            c.execute("""
-                INSERT INTO users (username, password, name, role)
-                VALUES (?, ?, ?, ?)
-            """, (username, self.hash_password(password), name, role))
-            conn.commit()
-            uid = c.lastrowid
-            conn.close()
-            return uid
+            with self.transaction() as conn:
+                c = conn.execute("""
+                    INSERT INTO users (username, password, name, role)
+                    VALUES (?, ?, ?, ?)
+                """, (username, self.hash_password(password), name, role))
+                self.notify_change("users")
+                return c.lastrowid
         except sqlite3.IntegrityError:
             return None
 
     def get_all_users(self):
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("SELECT id, username, name, role, active FROM users")
-        users = [dict(r) for r in c.fetchall()]
-        conn.close()
-        return users
+        c = conn.execute("SELECT id, username, name, role, active FROM users")
+        return [dict(r) for r in c.fetchall()]
+
+    def get_user(self, user_id):
+        """
+        Usuário por id a partir do diretório em memória
+
+        O diretório é carregado uma vez (uma leitura de users) e descartado
+        quando create/update/delete_user avisam mudança em "users".
+        """
+        users = self._users_by_id
+        if users is None:
+            with self._users_lock:
+                users = self._users_by_id
+                if users is None:
+                    users = {u["id"]: u for u in self.get_all_users()}
+                    self._users_by_id = users
+        return users.get(user_id)
+
+    def _invalidate_user_directory(self, topics):
+        if "users" in topics:
+            self._users_by_id = None
 
     def update_user(self, user_id, name, role, active):
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("UPDATE users SET name = ?, role = ?, active = ? WHERE id = ?", (name, role, active, user_id))
-        conn.commit()
-        conn.close()
+        conn.execute("UPDATE users SET name = ?, role = ?, active = ? WHERE id = ?", (name, role, active, user_id))
+        self.notify_change("users")
 
     def delete_user(self, user_id):
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("UPDATE users SET active = 0 WHERE id = ?", (user_id,))
-        conn.commit()
-        conn.close()
+        conn.execute("UPDATE users SET active = 0 WHERE id = ?", (user_id,))
+        self.notify_change("users")
 
     def change_user_password(self, user_id, new_password):
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("UPDATE users SET password = ? WHERE id = ?", (self.hash_password(new_password), user_id))
-        conn.commit()
-        conn.close()
+        conn.execute("UPDATE users SET password = ? WHERE id = ?", (self.hash_password(new_password), user_id))
 
     # =======================
     # LEADS
     # =======================
     def create_or_get_lead(self, phone, name="Lead Desconhecido"):
-        """Cria lead se não existir, ou retorna existente"""
+        """
+        Cria lead se não existir, ou retorna existente
+
+        O telefone de um lead nunca muda: um número já visto é resolvido pelo
+        LRU phone->id com um único SELECT pela chave primária. Os demais vão
+        por INSERT ... ON CONFLICT(phone) DO NOTHING RETURNING contra o índice
+        único de telefone: webhooks simultâneos do mesmo número não geram
+        leads duplicados. Só o INSERT retorna linha; lead existente não é
+        reescrito nem avisa mudança (cache e ETags continuam válidos).
+        """
         try:
-            conn = self.get_connection()
-            c = conn.cursor()
-            phone = str(phone).replace("+", "").replace(" ", "").replace("-", "").replace("@c.us", "")
+            phone = normalize_phone(phone)
 
-            # Verifica se já existe
-            c.execute("SELECT * FROM leads WHERE phone = ?", (phone,))
-            lead = c.fetchone()
-            if lead:
-                print(f"ℹ️ Lead existente encontrado: {lead['name']} ({phone})")
-                conn.close()
-                return dict(lead)
+            conn = self.get_connection()
+            lead_id = self._lead_ids_by_phone.get(phone)
+            if lead_id is not None:
+                lead = conn.execute("SELECT * FROM leads WHERE id = ?", (lead_id,)).fetchone()
+                if lead is not None:
+                    return dict(lead)
+                self._lead_ids_by_phone.delete(phone)
 
-            # Cria novo lead
-            c.execute("""
+            lead = conn.execute("""
                 INSERT INTO leads (name, phone, status, created_at)
                 VALUES (?, ?, 'novo', datetime('now'))
-            """, (name, phone))
-            conn.commit()
+                ON CONFLICT(phone) DO NOTHING
+                RETURNING *
+            """, (name, phone)).fetchone()
+            created = lead is not None
+            if not created:
+                lead = conn.execute("SELECT * FROM leads WHERE phone = ?", (phone,)).fetchone()
 
-            c.execute("SELECT * FROM leads WHERE phone = ?", (phone,))
-            new_lead = c.fetchone()
-            conn.close()
-            print(f"🆕 Lead criado: {name} ({phone})")
-            return dict(new_lead)
+            lead = dict(lead)
+            if not conn.in_transaction:
+                # Dentro de transação o id só vai para o cache após o commit
+                self._lead_ids_by_phone.set(phone, lead["id"])
+            if created:
+                self.notify_change("leads")
+            logger.debug("ℹ️ Lead: %s (%s)", lead["name"], phone)
+            return lead
 
         except Exception as e:
-            print(f"❌ Erro ao criar/obter lead: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("❌ Erro ao criar/obter lead: %s", e)
             return None
 
     def get_lead(self, lead_id):
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("SELECT * FROM leads WHERE id = ?", (lead_id,))
-        r = c.fetchone()
-        conn.close()
+        r = conn.execute("SELECT * FROM leads WHERE id = ?", (lead_id,)).fetchone()
         return dict(r) if r else None
 
     def get_lead_by_phone(self, phone):
         """Busca lead por número de telefone"""
         try:
             # Normaliza o telefone
-            phone_clean = str(phone).replace("+", "").replace(" ", "").replace("-", "").replace("@c.us", "")
+            phone_clean = normalize_phone(phone)
             
             conn = self.get_connection()
-            c = conn.cursor()
-            c.execute("SELECT * FROM leads WHERE phone = ?", (phone_clean,))
-            lead = c.fetchone()
-            conn.close()
+            lead = conn.execute("SELECT * FROM leads WHERE phone = ?", (phone_clean,)).fetchone()
             
             if lead:
                 return dict(lead)
             return None
             
         except Exception as e:
-            print(f"❌ Erro ao buscar lead por telefone: {e}")
+            logger.error("❌ Erro ao buscar lead por telefone: %s", e)
             return None
 
-    def get_all_leads(self):
+    def get_all_leads(self, include_tags=False):
+        """Retorna todos os leads (include_tags=True hidrata as tags em lote)"""
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("""
+        c = conn.execute("""
             SELECT l.*, u.name AS vendedor_name
             FROM leads l LEFT JOIN users u ON l.assigned_to = u.id
             ORDER BY l.updated_at DESC
         """)
         leads = [dict(r) for r in c.fetchall()]
-        conn.close()
-        return leads
+        return self.attach_tags(leads) if include_tags else leads
 
-    def get_leads_by_vendedor(self, user_id):
+    def get_leads_by_vendedor(self, user_id, include_tags=False):
         """Retorna leads atribuídos a um vendedor específico"""
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("""
+        c = conn.execute("""
             SELECT l.*, u.name AS vendedor_name
             FROM leads l LEFT JOIN users u ON l.assigned_to = u.id
             WHERE l.assigned_to = ?
             ORDER BY l.updated_at DESC
         """, (user_id,))
         leads = [dict(r) for r in c.fetchall()]
-        conn.close()
-        return leads
+        return self.attach_tags(leads) if include_tags else leads
 
     def get_leads_by_status(self, status):
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("SELECT * FROM leads WHERE status = ? ORDER BY updated_at DESC", (status,))
-        leads = [dict(r) for r in c.fetchall()]
-        conn.close()
-        return leads
+        c = conn.execute("SELECT * FROM leads WHERE status = ? ORDER BY updated_at DESC", (status,))
+        return [dict(r) for r in c.fetchall()]
 
     def assign_lead(self, lead_id, user_id):
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("""
+        conn.execute("""
             UPDATE leads
             SET assigned_to = ?, status = 'em_atendimento', updated_at = CURRENT_TIMESTAMP
             WHERE id = ?
         """, (user_id, lead_id))
-        conn.commit()
-        conn.close()
+        self.notify_change("leads")
 
     def update_lead_status(self, lead_id, status):
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("UPDATE leads SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (status, lead_id))
-        conn.commit()
-        conn.close()
+        conn.execute("UPDATE leads SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (status, lead_id))
+        self.notify_change("leads")
 
     def transfer_lead(self, lead_id, new_user_id):
         """Transfere lead para outro vendedor"""
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("""
+        conn.execute("""
             UPDATE leads
             SET assigned_to = ?, updated_at = CURRENT_TIMESTAMP
             WHERE id = ?
         """, (new_user_id, lead_id))
-        conn.commit()
-        conn.close()
+        self.notify_change("leads")
 
     # =======================
     # MENSAGENS / LOGS / NOTAS
     # =======================
+    def get_lead_assignees(self, lead_ids):
+        """Vendedor responsável de vários leads em uma query: {lead_id: assigned_to}"""
+        lead_ids = list(set(lead_ids))
+        if not lead_ids:
+            return {}
+        c = self.get_connection().execute(
+            "SELECT id, assigned_to FROM leads WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(lead_ids),)
+        )
+        return {row["id"]: row["assigned_to"] for row in c.fetchall()}
+
     def add_message(self, lead_id, sender_type, sender_name, content):
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("""
+        conn.execute("""
             INSERT INTO messages (lead_id, sender_type, sender_name, content)
             VALUES (?, ?, ?, ?)
         """, (lead_id, sender_type, sender_name, content))
-        conn.commit()
-        conn.close()
+        self.notify_change("messages")
+
+    def ingest_messages(self, events):
+        """
+        Grava um lote de mensagens recebidas em uma única transação
+
+        Telefones fora do cache viram um único UPSERT (todos os leads
+        distintos de uma vez); mensagens e timeline entram com executemany.
+        Eventos com provider_id já gravado (ou repetido no próprio lote)
+        são descartados como reentrega.
+
+        Args:
+            events: dicts com phone, name, content e provider_id (ver ingestion.py)
+
+        Returns:
+            (gravados, duplicados) - listas de (evento, lead_id)
+        """
+        with self.transaction() as conn:
+            provider_ids = [event["provider_id"] for event in events if event.get("provider_id")]
+            existing = {}
+            if provider_ids:
+                existing = {row[0]: row[1] for row in conn.execute("""
+                    SELECT provider_message_id, lead_id FROM messages
+                    WHERE provider_message_id IN (SELECT value FROM json_each(?))
+                """, (json.dumps(provider_ids),))}
+
+            fresh, repeated, seen = [], [], set()
+            for event in events:
+                provider_id = event.get("provider_id")
+                if provider_id and (provider_id in existing or provider_id in seen):
+                    repeated.append(event)
+                    continue
+                seen.add(provider_id)
+                fresh.append(event)
+
+            phones = [normalize_phone(event["phone"]) for event in fresh]
+            lead_ids = {}
+            missing = {}
+            for phone, event in zip(phones, fresh):
+                if not phone or phone in lead_ids or phone in missing:
+                    continue
+                lead_id = self._lead_ids_by_phone.get(phone)
+                if lead_id is not None:
+                    lead_ids[phone] = lead_id
+                else:
+                    missing[phone] = event["name"]
+
+            if missing:
+                # WHERE true: exigido pelo parser do SQLite em INSERT ... SELECT ... ON CONFLICT
+                rows = conn.execute("""
+                    INSERT INTO leads (name, phone, status, created_at)
+                    SELECT json_extract(value, '$[1]'), json_extract(value, '$[0]'), 'novo', datetime('now')
+                    FROM json_each(?) WHERE true
+                    ON CONFLICT(phone) DO NOTHING
+                    RETURNING id, phone
+                """, (json.dumps(list(missing.items())),)).fetchall()
+                lead_ids.update((row["phone"], row["id"]) for row in rows)
+                # Já existiam (fora do LRU): DO NOTHING não retorna, busca o id
+                existing_phones = [phone for phone in missing if phone not in lead_ids]
+                if existing_phones:
+                    lead_ids.update((row["phone"], row["id"]) for row in conn.execute("""
+                        SELECT id, phone FROM leads WHERE phone IN (SELECT value FROM json_each(?))
+                    """, (json.dumps(existing_phones),)))
+
+            results = [(event, lead_ids[phone]) for phone, event in zip(phones, fresh) if phone in lead_ids]
+            conn.executemany("""
+                INSERT INTO messages (lead_id, sender_type, sender_name, content, provider_message_id)
+                VALUES (?, 'lead', ?, ?, ?)
+            """, [(lead_id, event["name"], event["content"], event.get("provider_id"))
+                  for event, lead_id in results])
+            conn.executemany("""
+                INSERT INTO lead_logs (lead_id, action, user_name, details)
+                VALUES (?, 'mensagem_recebida', ?, ?)
+            """, [(lead_id, event["name"], event["content"][:100]) for event, lead_id in results])
+            if results:
+                self.notify_change("leads", "messages")
+
+        # Reentrega: devolve o lead da mensagem original
+        written_ids = {event.get("provider_id"): lead_id for event, lead_id in results}
+        duplicates = [
+            (event, existing.get(event["provider_id"]) or written_ids.get(event["provider_id"]))
+            for event in repeated
+        ]
+
+        for phone, lead_id in lead_ids.items():
+            self._lead_ids_by_phone.set(phone, lead_id)
+        return results, duplicates
 
     def get_messages_by_lead(self, lead_id):
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("SELECT * FROM messages WHERE lead_id = ? ORDER BY id ASC", (lead_id,))
-        msgs = [dict(r) for r in c.fetchall()]
-        conn.close()
-        return msgs
+        c = conn.execute("SELECT * FROM messages WHERE lead_id = ? ORDER BY id ASC", (lead_id,))
+        return [dict(r) for r in c.fetchall()]
 
     def add_internal_note(self, lead_id, user_id, note):
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("INSERT INTO internal_notes (lead_id, user_id, note) VALUES (?, ?, ?)", (lead_id, user_id, note))
-        conn.commit()
-        conn.close()
+        conn.execute("INSERT INTO internal_notes (lead_id, user_id, note) VALUES (?, ?, ?)", (lead_id, user_id, note))
 
     def get_internal_notes(self, lead_id):
         """Retorna notas internas de um lead"""
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("""
+        c = conn.execute("""
             SELECT n.*, u.name as user_name
             FROM internal_notes n
             LEFT JOIN users u ON n.user_id = u.id
             WHERE n.lead_id = ?
             ORDER BY n.created_at DESC
         """, (lead_id,))
-        notes = [dict(r) for r in c.fetchall()]
-        conn.close()
-        return notes
+        return [dict(r) for r in c.fetchall()]
 
     def add_lead_log(self, lead_id, action, user_name, details=""):
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("""
+        conn.execute("""
             INSERT INTO lead_logs (lead_id, action, user_name, details)
             VALUES (?, ?, ?, ?)
         """, (lead_id, action, user_name, details))
-        conn.commit()
-        conn.close()
 
     def get_lead_logs(self, lead_id):
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("SELECT * FROM lead_logs WHERE lead_id = ? ORDER BY id DESC", (lead_id,))
-        logs = [dict(r) for r in c.fetchall()]
-        conn.close()
-        return logs
+        c = conn.execute("SELECT * FROM lead_logs WHERE lead_id = ? ORDER BY id DESC", (lead_id,))
+        return [dict(r) for r in c.fetchall()]
+
+    # =======================
+    # PAGINAÇÃO (KEYSET / CURSOR)
+    # =======================
+    def _fetch_page(self, sql, params, keys, after, limit, descending=True):
+        """
+        Executa uma consulta paginada por cursor (keyset).
+
+        "sql" deve terminar na cláusula WHERE; "keys" são pares (expressão SQL,
+        campo) que formam uma ordenação única, coberta por índice. Cada página
+        custa o mesmo que a primeira, independente da profundidade.
+
+        Returns:
+            (linhas, has_more, chave da última linha)
+        """
+        op, direction = ("<", "DESC") if descending else (">", "ASC")
+        exprs = [expr for expr, _ in keys]
+        if after is not None:
+            sql += f" AND ({', '.join(exprs)}) {op} ({', '.join('?' * len(exprs))})"
+            params = (*params, *after)
+        sql += " ORDER BY " + ", ".join(f"{expr} {direction}" for expr in exprs) + " LIMIT ?"
+
+        rows = [dict(r) for r in self.get_connection().execute(sql, (*params, limit + 1))]
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        last_key = [rows[-1][field] for _, field in keys] if rows else None
+        return rows, has_more, last_key
+
+    def get_leads_page(self, limit=50, after=None, assigned_to=None, include_tags=False):
+        """Página de leads por updated_at/id decrescente ("after" = cursor da página anterior)"""
+        sql = """
+            SELECT l.*, u.name AS vendedor_name
+            FROM leads l LEFT JOIN users u ON l.assigned_to = u.id
+            WHERE 1=1
+        """
+        params = ()
+        if assigned_to is not None:
+            sql += " AND l.assigned_to = ?"
+            params = (assigned_to,)
+
+        items, has_more, last_key = self._fetch_page(
+            sql, params, (("l.updated_at", "updated_at"), ("l.id", "id")), after, limit
+        )
+        if include_tags:
+            self.attach_tags(items)
+        return {"items": items, "has_more": has_more, "next": {"after": last_key} if has_more else None}
+
+    def get_messages_page(self, lead_id, limit=50, before_id=None, after_id=None):
+        """
+        Página de mensagens de um lead, sempre em ordem cronológica.
+
+        Sem cursor retorna as mais recentes; before_id volta no histórico e
+        after_id busca apenas mensagens novas (o cursor "next" continua válido
+        para o próximo polling).
+        """
+        sql = "SELECT * FROM messages WHERE lead_id = ?"
+        if after_id is not None:
+            items, has_more, last_key = self._fetch_page(
+                sql, (lead_id,), (("id", "id"),), (after_id,), limit, descending=False
+            )
+            return {"items": items, "has_more": has_more,
+                    "next": {"after_id": last_key[0] if last_key else after_id}}
+
+        before = (before_id,) if before_id is not None else None
+        items, has_more, last_key = self._fetch_page(sql, (lead_id,), (("id", "id"),), before, limit)
+        items.reverse()
+        return {"items": items, "has_more": has_more, "next": {"before_id": last_key[0]} if has_more else None}
+
+    def get_lead_logs_page(self, lead_id, limit=50, before_id=None, after_id=None):
+        """Página da timeline do lead (mais recentes primeiro, como get_lead_logs)"""
+        sql = "SELECT * FROM lead_logs WHERE lead_id = ?"
+        if after_id is not None:
+            items, has_more, last_key = self._fetch_page(
+                sql, (lead_id,), (("id", "id"),), (after_id,), limit, descending=False
+            )
+            items.reverse()
+            return {"items": items, "has_more": has_more,
+                    "next": {"after_id": last_key[0] if last_key else after_id}}
+
+        before = (before_id,) if before_id is not None else None
+        items, has_more, last_key = self._fetch_page(sql, (lead_id,), (("id", "id"),), before, limit)
+        return {"items": items, "has_more": has_more, "next": {"before_id": last_key[0]} if has_more else None}
+
+    def get_internal_notes_page(self, lead_id, limit=50, after=None):
+        """Página de notas internas (mais recentes primeiro)"""
+        sql = """
+            SELECT n.*, u.name as user_name
+            FROM internal_notes n
+            LEFT JOIN users u ON n.user_id = u.id
+            WHERE n.lead_id = ?
+        """
+        items, has_more, last_key = self._fetch_page(
+            sql, (lead_id,), (("n.created_at", "created_at"), ("n.id", "id")), after, limit
+        )
+        return {"items": items, "has_more": has_more, "next": {"after": last_key} if has_more else None}
+
+    def get_audit_logs_page(self, limit=100, after=None):
+        """Página de logs de auditoria (mais recentes primeiro)"""
+        sql = """
+            SELECT a.*, u.name as user_name
+            FROM audit_log a
+            LEFT JOIN users u ON a.user_id = u.id
+            WHERE 1=1
+        """
+        items, has_more, last_key = self._fetch_page(
+            sql, (), (("a.timestamp", "timestamp"), ("a.id", "id")), after, limit
+        )
+        return {"items": items, "has_more": has_more, "next": {"after": last_key} if has_more else None}
+
+    # =======================
+    # SYNC INCREMENTAL (updated_seq)
+    # =======================
+    def get_sync_version(self):
+        """Valor atual da sequência de sync (ver migração 9)"""
+        row = self.get_connection().execute("SELECT value FROM sync_sequence WHERE id = 1").fetchone()
+        return row[0] if row else 0
+
+    def get_lead_changes(self, since=0, assigned_to=None, limit=500, include_tags=True):
+        """
+        Leads criados/alterados desde `since` + ids que saíram da visão do cliente
+
+        Args:
+            since: next_since da chamada anterior (0 = sync completo)
+            assigned_to: restringe à carteira de um vendedor
+            limit: máximo de leads por chamada (has_more indica que há mais)
+
+        Returns:
+            {"items", "deleted", "has_more", "next_since"}
+        """
+        conn = self.get_connection()
+        current = self.get_sync_version()
+
+        sql = """
+            SELECT l.*, u.name AS vendedor_name
+            FROM leads l LEFT JOIN users u ON l.assigned_to = u.id
+            WHERE l.updated_seq > ? AND l.updated_seq <= ?
+        """
+        params = [since, current]
+        if assigned_to is not None:
+            sql += " AND l.assigned_to = ?"
+            params.append(assigned_to)
+        sql += " ORDER BY l.updated_seq LIMIT ?"
+        rows = [dict(r) for r in conn.execute(sql, params + [limit + 1]).fetchall()]
+
+        has_more = len(rows) > limit
+        items = rows[:limit]
+        upto = items[-1]["updated_seq"] if has_more else current
+
+        # Tombstones: apagados (assigned_to NULL) e, para vendedor, leads que
+        # saíram da carteira e não voltaram depois
+        sql = """
+            SELECT DISTINCT t.lead_id
+            FROM lead_tombstones t
+            WHERE t.seq > ? AND t.seq <= ?
+        """
+        params = [since, upto]
+        if assigned_to is None:
+            sql += " AND t.assigned_to IS NULL"
+        else:
+            sql += """
+                AND (t.assigned_to IS NULL OR t.assigned_to = ?)
+                AND NOT EXISTS (
+                    SELECT 1 FROM leads l
+                    WHERE l.id = t.lead_id AND l.assigned_to = ? AND l.updated_seq > t.seq
+                )
+            """
+            params += [assigned_to, assigned_to]
+        deleted = [r[0] for r in conn.execute(sql, params).fetchall()]
+
+        if include_tags:
+            self.attach_tags(items)
+        return {"items": items, "deleted": deleted, "has_more": has_more, "next_since": upto}
+
+    # =======================
+    # OUTBOX (mensagens de saída)
+    # =======================
+    def enqueue_outbox(self, lead_id, phone, content, user_id=None):
+        """Coloca uma mensagem na fila de saída; retorna o id (status 'queued')"""
+        with self.transaction() as conn:
+            c = conn.execute("""
+                INSERT INTO outbox (lead_id, user_id, phone, content, status, next_attempt_at)
+                VALUES (?, ?, ?, ?, 'queued', 0)
+            """, (lead_id, user_id, phone, content))
+            return c.lastrowid
+
+    def claim_outbox(self, now, owner, lease_seconds):
+        """
+        Reserva a próxima mensagem pronta para envio (status -> 'sending')
+
+        A reserva vale até now + lease_seconds. Uma mensagem 'sending' com
+        lease vencido (dispatcher que caiu no meio do envio) volta a ser
+        elegível; com lease válido ela é de quem reservou, mesmo que seja
+        outro processo.
+
+        Uma mensagem só é elegível se não houver outra anterior do mesmo lead
+        ainda pendente: a ordem por lead é sempre preservada.
+        """
+        with self.transaction() as conn:
+            row = conn.execute("""
+                UPDATE outbox
+                SET status = 'sending', attempts = attempts + 1, claimed_by = ?, lease_until = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = (
+                    SELECT o.id FROM outbox o
+                    WHERE ((o.status = 'queued' AND o.next_attempt_at <= ?)
+                           OR (o.status = 'sending' AND COALESCE(o.lease_until, 0) < ?))
+                    AND NOT EXISTS (
+                        SELECT 1 FROM outbox p
+                        WHERE p.lead_id = o.lead_id AND p.id < o.id
+                        AND p.status IN ('queued', 'sending')
+                    )
+                    ORDER BY o.next_attempt_at, o.id
+                    LIMIT 1
+                )
+                RETURNING *
+            """, (owner, now + lease_seconds, now, now)).fetchone()
+            return dict(row) if row else None
+
+    def mark_outbox_sent(self, outbox_id, owner):
+        """
+        Marca como enviada (só se a reserva ainda é de owner)
+
+        Returns:
+            False se o lease venceu e outro worker assumiu a mensagem
+        """
+        conn = self.get_connection()
+        cursor = conn.execute("""
+            UPDATE outbox
+            SET status = 'sent', last_error = NULL, sent_at = CURRENT_TIMESTAMP,
+                claimed_by = NULL, lease_until = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'sending' AND claimed_by = ?
+        """, (outbox_id, owner))
+        return cursor.rowcount > 0
+
+    def mark_outbox_retry(self, outbox_id, owner, next_attempt_at, error, refund_attempt=False):
+        """
+        Devolve a mensagem para a fila (só se a reserva ainda é de owner)
+
+        refund_attempt: a tentativa não chegou ao bridge (circuito aberto) e não conta
+        """
+        conn = self.get_connection()
+        conn.execute("""
+            UPDATE outbox
+            SET status = 'queued', next_attempt_at = ?, last_error = ?,
+                attempts = attempts - ?, claimed_by = NULL, lease_until = NULL,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'sending' AND claimed_by = ?
+        """, (next_attempt_at, error, 1 if refund_attempt else 0, outbox_id, owner))
+
+    def mark_outbox_failed(self, outbox_id, owner, error):
+        """Falha definitiva (só se a reserva ainda é de owner)"""
+        conn = self.get_connection()
+        conn.execute("""
+            UPDATE outbox
+            SET status = 'failed', last_error = ?, claimed_by = NULL, lease_until = NULL,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'sending' AND claimed_by = ?
+        """, (error, outbox_id, owner))
+
+    def count_expired_outbox_leases(self, now):
+        """Mensagens 'sending' com lease vencido (voltam para a fila no próximo claim)"""
+        conn = self.get_connection()
+        return conn.execute("""
+            SELECT COUNT(*) FROM outbox WHERE status = 'sending' AND COALESCE(lease_until, 0) < ?
+        """, (now,)).fetchone()[0]
+
+    def get_outbox_item(self, outbox_id):
+        conn = self.get_connection()
+        row = conn.execute("SELECT * FROM outbox WHERE id = ?", (outbox_id,)).fetchone()
+        return dict(row) if row else None
+
+    def count_outbox(self, status="queued"):
+        conn = self.get_connection()
+        return conn.execute("SELECT COUNT(*) FROM outbox WHERE status = ?", (status,)).fetchone()[0]
+
+    # =======================
+    # CAMPANHAS (envio em massa)
+    # =======================
+    def create_campaign(self, name, template, filters, created_by=None, status="running"):
+        """
+        Cria a campanha e resolve os destinatários numa única consulta
+
+        Args:
+            filters: dict com status (str ou lista), tag_id e/ou assigned_to
+
+        Returns:
+            (campaign_id, total_recipients)
+        """
+        where = ["l.phone IS NOT NULL", "l.phone != ''"]
+        params = []
+        statuses = filters.get("status")
+        if statuses:
+            statuses = [statuses] if isinstance(statuses, str) else list(statuses)
+            where.append(f"l.status IN ({','.join('?' * len(statuses))})")
+            params.extend(statuses)
+        if filters.get("assigned_to") is not None:
+            where.append("l.assigned_to = ?")
+            params.append(filters["assigned_to"])
+        if filters.get("tag_id") is not None:
+            where.append("EXISTS (SELECT 1 FROM lead_tags lt WHERE lt.lead_id = l.id AND lt.tag_id = ?)")
+            params.append(filters["tag_id"])
+
+        with self.transaction() as conn:
+            campaign_id = conn.execute("""
+                INSERT INTO campaigns (name, template, filters, status, created_by)
+                VALUES (?, ?, ?, ?, ?)
+            """, (name, template, json.dumps(filters), status, created_by)).lastrowid
+            total = conn.execute(f"""
+                INSERT OR IGNORE INTO campaign_recipients (campaign_id, lead_id, phone)
+                SELECT ?, l.id, l.phone FROM leads l
+                WHERE {' AND '.join(where)}
+                ORDER BY l.id
+            """, [campaign_id, *params]).rowcount
+            conn.execute("UPDATE campaigns SET total_recipients = ? WHERE id = ?", (total, campaign_id))
+        return campaign_id, total
+
+    def get_campaign(self, campaign_id):
+        """Campanha com os contadores de progresso por status"""
+        conn = self.get_connection()
+        row = conn.execute("SELECT * FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+        if not row:
+            return None
+        campaign = dict(row)
+        campaign["filters"] = json.loads(campaign["filters"] or "{}")
+        campaign["progress"] = self.get_campaign_progress(campaign_id)
+        return campaign
+
+    def get_campaign_progress(self, campaign_id):
+        conn = self.get_connection()
+        progress = {"pending": 0, "queued": 0, "sent": 0, "failed": 0, "skipped": 0}
+        rows = conn.execute("""
+            SELECT status, COUNT(*) FROM campaign_recipients
+            WHERE campaign_id = ? GROUP BY status
+        """, (campaign_id,)).fetchall()
+        for status, count in rows:
+            progress[status] = count
+        return progress
+
+    def get_campaigns(self, limit=50):
+        conn = self.get_connection()
+        rows = conn.execute("""
+            SELECT id, name, status, created_by, total_recipients, created_at, finished_at
+            FROM campaigns ORDER BY id DESC LIMIT ?
+        """, (limit,)).fetchall()
+        return [dict(r) for r in rows]
+
+    def get_running_campaigns(self):
+        conn = self.get_connection()
+        rows = conn.execute("""
+            SELECT id, template, created_by FROM campaigns
+            WHERE status = 'running' ORDER BY id
+        """).fetchall()
+        return [dict(r) for r in rows]
+
+    def set_campaign_status(self, campaign_id, status, from_statuses):
+        """Transição de status (pause/resume/cancel); False se o status atual não permite"""
+        with self.transaction() as conn:
+            c = conn.execute(f"""
+                UPDATE campaigns SET status = ?, updated_at = CURRENT_TIMESTAMP,
+                    finished_at = CASE WHEN ? = 'cancelled' THEN CURRENT_TIMESTAMP ELSE finished_at END
+                WHERE id = ? AND status IN ({','.join('?' * len(from_statuses))})
+            """, (status, status, campaign_id, *from_statuses))
+            if c.rowcount and status == "cancelled":
+                conn.execute("""
+                    UPDATE campaign_recipients SET status = 'skipped', updated_at = CURRENT_TIMESTAMP
+                    WHERE campaign_id = ? AND status = 'pending'
+                """, (campaign_id,))
+            return c.rowcount > 0
+
+    def queue_campaign_recipients(self, campaign, limit, render):
+        """
+        Move os próximos destinatários pendentes para a outbox
+
+        Args:
+            campaign: dict com id, template e created_by
+            render: função (template, variáveis do lead) -> texto
+
+        Returns:
+            quantidade colocada na fila
+        """
+        with self.transaction() as conn:
+            rows = conn.execute("""
+                SELECT r.id, r.lead_id, r.phone, l.name, l.status, l.city, u.name AS vendedor
+                FROM campaign_recipients r
+                JOIN leads l ON l.id = r.lead_id
+                LEFT JOIN users u ON u.id = l.assigned_to
+                WHERE r.campaign_id = ? AND r.status = 'pending'
+                ORDER BY r.id
+                LIMIT ?
+            """, (campaign["id"], limit)).fetchall()
+            for row in rows:
+                content = render(campaign["template"], dict(row))
+                outbox_id = conn.execute("""
+                    INSERT INTO outbox (lead_id, user_id, phone, content, status, next_attempt_at)
+                    VALUES (?, ?, ?, ?, 'queued', 0)
+                """, (row["lead_id"], campaign["created_by"], row["phone"], content)).lastrowid
+                conn.execute("""
+                    UPDATE campaign_recipients
+                    SET status = 'queued', content = ?, outbox_id = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                """, (content, outbox_id, row["id"]))
+            return len(rows)
+
+    def finish_campaign_if_done(self, campaign_id):
+        """Marca 'completed' quando não sobra destinatário pendente nem na fila"""
+        with self.transaction() as conn:
+            c = conn.execute("""
+                UPDATE campaigns SET status = 'completed', finished_at = CURRENT_TIMESTAMP,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'running' AND NOT EXISTS (
+                    SELECT 1 FROM campaign_recipients
+                    WHERE campaign_id = ? AND status IN ('pending', 'queued')
+                )
+            """, (campaign_id, campaign_id))
+            return c.rowcount > 0
+
+    def get_campaign_recipients(self, campaign_id, status=None, after_id=0, limit=100):
+        """Resultado por destinatário (paginação por id)"""
+        conn = self.get_connection()
+        query = """
+            SELECT r.id, r.lead_id, l.name AS lead_name, r.phone, r.status, r.outbox_id,
+                   r.error, r.updated_at
+            FROM campaign_recipients r
+            LEFT JOIN leads l ON l.id = r.lead_id
+            WHERE r.campaign_id = ? AND r.id > ?
+        """
+        params = [campaign_id, after_id]
+        if status:
+            query += " AND r.status = ?"
+            params.append(status)
+        query += " ORDER BY r.id LIMIT ?"
+        params.append(limit)
+        return [dict(r) for r in conn.execute(query, params).fetchall()]
 
     # =======================
     # LOGS DE AUDITORIA
@@ -358,28 +1073,35 @@ class Database:
     def add_audit_log(self, user_id, action, entity_type, entity_id, details=""):
         """Adiciona log de auditoria para rastreamento de ações"""
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("""
+        conn.execute("""
             INSERT INTO audit_log (user_id, action, entity_type, entity_id, details)
             VALUES (?, ?, ?, ?, ?)
         """, (user_id, action, entity_type, entity_id, details))
-        conn.commit()
-        conn.close()
+
+    def add_audit_logs(self, entries):
+        """
+        Grava vários logs de auditoria em uma transação
+
+        Args:
+            entries: tuplas (user_id, action, entity_type, entity_id, details, timestamp)
+        """
+        with self.transaction() as conn:
+            conn.executemany("""
+                INSERT INTO audit_log (user_id, action, entity_type, entity_id, details, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, entries)
 
     def get_audit_logs(self, limit=100):
         """Retorna logs de auditoria"""
         conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("""
+        c = conn.execute("""
             SELECT a.*, u.name as user_name
             FROM audit_log a
             LEFT JOIN users u ON a.user_id = u.id
             ORDER BY a.timestamp DESC
             LIMIT ?
         """, (limit,))
-        logs = [dict(r) for r in c.fetchall()]
-        conn.close()
-        return logs
+        return [dict(r) for r in c.fetchall()]
 
     # =======================
     # TAGS (para extensão)
@@ -388,45 +1110,51 @@ class Database:
         """Retorna tags de um lead (se tabela existir)"""
         try:
             conn = self.get_connection()
-            c = conn.cursor()
-            c.execute("""
+            c = conn.execute("""
                 SELECT t.* FROM tags t
                 INNER JOIN lead_tags lt ON t.id = lt.tag_id
                 WHERE lt.lead_id = ?
             """, (lead_id,))
-            tags = [dict(r) for r in c.fetchall()]
-            conn.close()
-            return tags
+            return [dict(r) for r in c.fetchall()]
         except sqlite3.OperationalError:
             # Tabela de tags ainda não existe
             return []
 
+    def attach_tags(self, leads):
+        """
+        Preenche lead['tags'] de uma lista de leads sem N+1 queries
+
+        get_tags_for_leads vem de extend_database_with_tags_sla (database_tags_sla.py)
+        """
+        tags_by_lead = self.get_tags_for_leads([lead["id"] for lead in leads])
+        for lead in leads:
+            lead["tags"] = tags_by_lead.get(lead["id"], [])
+        return leads
+
     # =======================
     # MÉTRICAS
     # =======================
-    def get_metrics_summary(self):
-        conn = self.get_connection()
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM leads")
-        total = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM leads WHERE status = 'ganho'")
-        ganhos = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM leads WHERE status = 'perdido'")
-        perdidos = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM leads WHERE status = 'em_atendimento'")
-        ativos = c.fetchone()[0]
-
-        funil = {
-            "novo": total - ganhos - perdidos - ativos,
-            "em_atendimento": ativos,
-            "ganho": ganhos,
-            "perdido": perdidos
-        }
+    def get_metrics_summary(self, vendedor_id=None):
+        """
+        Funil de leads por status (opcionalmente de um vendedor).
+
+        Lê lead_status_counts, mantida por triggers a cada insert/update de
+        leads, então o custo é proporcional ao número de status, não de leads.
+        """
+        sql = "SELECT status, SUM(count) AS total FROM lead_status_counts"
+        params = ()
+        if vendedor_id is not None:
+            sql += " WHERE assigned_to = ?"
+            params = (vendedor_id,)
+        sql += " GROUP BY status"
+
+        funil = dict.fromkeys(LEAD_STATUSES, 0)
+        for r in self.get_connection().execute(sql, params):
+            funil[r["status"]] = r["total"]
 
-        conn.close()
         return {
-            "total_leads": total,
-            "leads_ganhos": ganhos,
-            "leads_perdidos": perdidos,
+            "total_leads": sum(funil.values()),
+            "leads_ganhos": funil["ganho"],
+            "leads_perdidos": funil["perdido"],
             "funil": funil
-        }
\ No newline at end of file
+        }
@@ -8,112 +8,42 @@ import sqlite3
 from datetime import datetime, timedelta
 import json
 
+from database import get_pool
+from migrations import run_migrations
+from logs import get_logger
+
+logger = get_logger(__name__)
+
 
 class DatabaseTagsSLA:
     """
     Extensão para adicionar Tags e SLA Tracking ao banco existente
     """
     
-    def __init__(self, db_name="crm_whatsapp.db"):
+    def __init__(self, db_name="crm_whatsapp.db", on_change=None):
         self.db_name = db_name
+        self.pool = get_pool(db_name)
+        self.on_change = on_change  # ex: Database.notify_change
         self.init_tags_sla_tables()
     
+    def _changed(self, *topics):
+        if self.on_change:
+            self.on_change(*topics)
+    
     # =============================
     # INICIALIZAÇÃO DAS TABELAS
     # =============================
     def init_tags_sla_tables(self):
-        """Cria tabelas de Tags e SLA"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        # Tabela de Tags disponíveis
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS tags (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE,
-                color TEXT NOT NULL,
-                icon TEXT,
-                description TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Tabela de relacionamento Lead-Tag (many-to-many)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS lead_tags (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                lead_id INTEGER NOT NULL,
-                tag_id INTEGER NOT NULL,
-                added_by INTEGER,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (lead_id) REFERENCES leads(id),
-                FOREIGN KEY (tag_id) REFERENCES tags(id),
-                FOREIGN KEY (added_by) REFERENCES users(id),
-                UNIQUE(lead_id, tag_id)
-            )
-        """)
-        
-        # Tabela de SLA (métricas de tempo)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS lead_sla (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                lead_id INTEGER NOT NULL UNIQUE,
-                first_contact_at TIMESTAMP,
-                first_response_at TIMESTAMP,
-                first_response_time_seconds INTEGER,
-                last_interaction_at TIMESTAMP,
-                total_response_time_seconds INTEGER DEFAULT 0,
-                response_count INTEGER DEFAULT 0,
-                avg_response_time_seconds INTEGER,
-                status TEXT DEFAULT 'pending',
-                sla_met BOOLEAN DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (lead_id) REFERENCES leads(id)
-            )
-        """)
-        
-        conn.commit()
-        
-        # Inserir tags padrão se não existirem
-        self._insert_default_tags(cursor)
-        
-        conn.commit()
-        conn.close()
-        
-        print("✅ Tabelas de Tags e SLA criadas com sucesso!")
-    
-    def _insert_default_tags(self, cursor):
-        """Insere tags padrão do sistema"""
-        default_tags = [
-            ("🔥 Quente", "#FF4444", "🔥", "Lead com alta chance de conversão"),
-            ("⭐ VIP", "#FFD700", "⭐", "Cliente importante ou alto ticket"),
-            ("⚡ Urgente", "#FF6600", "⚡", "Requer atenção imediata"),
-            ("💰 Alto Ticket", "#00AA00", "💰", "Oportunidade de alto valor"),
-            ("📅 Agendar Retorno", "#4169E1", "📅", "Marcar para contato futuro"),
-            ("🤔 Indeciso", "#FFA500", "🤔", "Cliente em dúvida"),
-            ("❌ Não Qualificado", "#999999", "❌", "Não se encaixa no perfil"),
-            ("🎯 Novo Lead", "#00CED1", "🎯", "Lead recém chegado"),
-            ("📞 Sem Resposta", "#8B008B", "📞", "Tentativas sem sucesso"),
-            ("✅ Pronto para Fechar", "#32CD32", "✅", "Negociação avançada"),
-        ]
-        
-        for name, color, icon, description in default_tags:
-            try:
-                cursor.execute("""
-                    INSERT OR IGNORE INTO tags (name, color, icon, description)
-                    VALUES (?, ?, ?, ?)
-                """, (name, color, icon, description))
-            except:
-                pass
+        """Cria tabelas de Tags e SLA (migrações versionadas em migrations.py)"""
+        if run_migrations(self.pool):
+            logger.info("✅ Tabelas de Tags e SLA criadas com sucesso!")
     
     # =============================
     # GESTÃO DE TAGS
     # =============================
     def get_all_tags(self):
         """Retorna todas as tags disponíveis"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        conn = self.pool.connection()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -125,12 +55,11 @@ class DatabaseTagsSLA:
         """)
         
         tags = [dict(row) for row in cursor.fetchall()]
-        conn.close()
         return tags
     
     def create_tag(self, name, color, icon="", description=""):
         """Cria uma nova tag"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.pool.connection()
         cursor = conn.cursor()
         
         try:
@@ -138,18 +67,15 @@ class DatabaseTagsSLA:
                 INSERT INTO tags (name, color, icon, description)
                 VALUES (?, ?, ?, ?)
             """, (name, color, icon, description))
-            conn.commit()
             tag_id = cursor.lastrowid
-            conn.close()
+            self._changed("tags")
             return tag_id
         except sqlite3.IntegrityError:
-            conn.close()
             return None  # Tag já existe
     
     def get_lead_tags(self, lead_id):
         """Retorna todas as tags de um lead"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        conn = self.pool.connection()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -162,12 +88,39 @@ class DatabaseTagsSLA:
         """, (lead_id,))
         
         tags = [dict(row) for row in cursor.fetchall()]
-        conn.close()
         return tags
     
+    def get_tags_for_leads(self, lead_ids):
+        """
+        Retorna as tags de vários leads em uma única query
+        
+        Returns:
+            Dict {lead_id: [tags]} no mesmo formato de get_lead_tags
+        """
+        tags_by_lead = {lead_id: [] for lead_id in lead_ids}
+        if not tags_by_lead:
+            return tags_by_lead
+        
+        conn = self.pool.connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT lt.lead_id AS _lead_id, t.*, lt.added_at, u.name as added_by_name
+            FROM lead_tags lt
+            JOIN tags t ON t.id = lt.tag_id
+            LEFT JOIN users u ON lt.added_by = u.id
+            WHERE lt.lead_id IN (SELECT value FROM json_each(?))
+            ORDER BY lt.lead_id, lt.added_at DESC
+        """, (json.dumps(list(tags_by_lead)),))
+        
+        for row in cursor.fetchall():
+            tag = dict(row)
+            tags_by_lead[tag.pop('_lead_id')].append(tag)
+        return tags_by_lead
+    
     def add_tag_to_lead(self, lead_id, tag_id, user_id=None):
         """Adiciona uma tag a um lead"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.pool.connection()
         cursor = conn.cursor()
         
         try:
@@ -175,16 +128,14 @@ class DatabaseTagsSLA:
                 INSERT INTO lead_tags (lead_id, tag_id, added_by)
                 VALUES (?, ?, ?)
             """, (lead_id, tag_id, user_id))
-            conn.commit()
-            conn.close()
+            self._changed("tags")
             return True
         except sqlite3.IntegrityError:
-            conn.close()
             return False  # Tag já está no lead
     
     def remove_tag_from_lead(self, lead_id, tag_id):
         """Remove uma tag de um lead"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.pool.connection()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -192,14 +143,12 @@ class DatabaseTagsSLA:
             WHERE lead_id = ? AND tag_id = ?
         """, (lead_id, tag_id))
         
-        conn.commit()
-        conn.close()
+        self._changed("tags")
         return True
     
     def get_leads_by_tag(self, tag_id):
         """Retorna todos os leads com uma tag específica"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        conn = self.pool.connection()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -211,7 +160,6 @@ class DatabaseTagsSLA:
         """, (tag_id,))
         
         leads = [dict(row) for row in cursor.fetchall()]
-        conn.close()
         return leads
     
     # =============================
@@ -219,7 +167,7 @@ class DatabaseTagsSLA:
     # =============================
     def init_lead_sla(self, lead_id):
         """Inicializa SLA para um novo lead"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.pool.connection()
         cursor = conn.cursor()
         
         now = datetime.now().isoformat()
@@ -229,50 +177,44 @@ class DatabaseTagsSLA:
             (lead_id, first_contact_at, status, created_at, updated_at)
             VALUES (?, ?, 'pending', ?, ?)
         """, (lead_id, now, now, now))
-        
-        conn.commit()
-        conn.close()
     
     def record_first_response(self, lead_id):
         """Registra a primeira resposta ao lead"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
         now = datetime.now()
         
-        # Buscar dados do SLA
-        cursor.execute("""
-            SELECT first_contact_at, first_response_at
-            FROM lead_sla
-            WHERE lead_id = ?
-        """, (lead_id,))
-        
-        row = cursor.fetchone()
-        
-        if row and not row[1]:  # Se ainda não tem primeira resposta
-            first_contact = datetime.fromisoformat(row[0])
-            response_time = int((now - first_contact).total_seconds())
-            
-            # Define se SLA foi cumprido (exemplo: 5 minutos)
-            sla_met = response_time <= 300
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
             
+            # Buscar dados do SLA
             cursor.execute("""
-                UPDATE lead_sla
-                SET first_response_at = ?,
-                    first_response_time_seconds = ?,
-                    status = 'responded',
-                    sla_met = ?,
-                    updated_at = ?
+                SELECT first_contact_at, first_response_at
+                FROM lead_sla
                 WHERE lead_id = ?
-            """, (now.isoformat(), response_time, sla_met, now.isoformat(), lead_id))
+            """, (lead_id,))
             
-            conn.commit()
-        
-        conn.close()
+            row = cursor.fetchone()
+            
+            if row and not row[1]:  # Se ainda não tem primeira resposta
+                first_contact = datetime.fromisoformat(row[0])
+                response_time = int((now - first_contact).total_seconds())
+                
+                # Define se SLA foi cumprido (exemplo: 5 minutos)
+                sla_met = response_time <= 300
+                
+                cursor.execute("""
+                    UPDATE lead_sla
+                    SET first_response_at = ?,
+                        first_response_time_seconds = ?,
+                        status = 'responded',
+                        sla_met = ?,
+                        updated_at = ?
+                    WHERE lead_id = ?
+                """, (now.isoformat(), response_time, sla_met, now.isoformat(), lead_id))
+                self._changed("sla")
     
     def update_lead_interaction(self, lead_id, response_time_seconds=None):
         """Atualiza métricas de interação do lead"""
-        conn = sqlite3.connect(self.db_name)
+        conn = self.pool.connection()
         cursor = conn.cursor()
         
         now = datetime.now().isoformat()
@@ -287,6 +229,7 @@ class DatabaseTagsSLA:
                     updated_at = ?
                 WHERE lead_id = ?
             """, (response_time_seconds, response_time_seconds, now, now, lead_id))
+            self._changed("sla")
         else:
             cursor.execute("""
                 UPDATE lead_sla
@@ -294,14 +237,10 @@ class DatabaseTagsSLA:
                     updated_at = ?
                 WHERE lead_id = ?
             """, (now, now, lead_id))
-        
-        conn.commit()
-        conn.close()
     
     def get_lead_sla(self, lead_id):
         """Retorna métricas de SLA de um lead"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        conn = self.pool.connection()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -310,14 +249,12 @@ class DatabaseTagsSLA:
         """, (lead_id,))
         
         sla = cursor.fetchone()
-        conn.close()
         
         return dict(sla) if sla else None
     
     def get_sla_metrics(self):
         """Retorna métricas gerais de SLA"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        conn = self.pool.connection()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -334,7 +271,6 @@ class DatabaseTagsSLA:
         """)
         
         metrics = dict(cursor.fetchone())
-        conn.close()
         
         # Calcular percentual de SLA cumprido
         if metrics['total_leads'] > 0:
@@ -348,8 +284,7 @@ class DatabaseTagsSLA:
     
     def get_leads_with_sla_alert(self, threshold_minutes=5):
         """Retorna leads que estouraram o SLA"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        conn = self.pool.connection()
         cursor = conn.cursor()
         
         threshold_seconds = threshold_minutes * 60
@@ -366,7 +301,6 @@ class DatabaseTagsSLA:
         """, (threshold_seconds,))
         
         leads = [dict(row) for row in cursor.fetchall()]
-        conn.close()
         
         return leads
     
@@ -400,12 +334,13 @@ def extend_database_with_tags_sla(database_instance):
         extend_database_with_tags_sla(db)
         # Agora db tem todos os métodos de tags e SLA
     """
-    tags_sla = DatabaseTagsSLA(database_instance.db_name)
+    tags_sla = DatabaseTagsSLA(database_instance.db_name, on_change=database_instance.notify_change)
     
     # Adiciona métodos ao objeto database
     database_instance.get_all_tags = tags_sla.get_all_tags
     database_instance.create_tag = tags_sla.create_tag
     database_instance.get_lead_tags = tags_sla.get_lead_tags
+    database_instance.get_tags_for_leads = tags_sla.get_tags_for_leads
     database_instance.add_tag_to_lead = tags_sla.add_tag_to_lead
     database_instance.remove_tag_from_lead = tags_sla.remove_tag_from_lead
     database_instance.get_leads_by_tag = tags_sla.get_leads_by_tag
@@ -418,4 +353,4 @@ def extend_database_with_tags_sla(database_instance):
     database_instance.get_leads_with_sla_alert = tags_sla.get_leads_with_sla_alert
     database_instance.format_response_time = tags_sla.format_response_time
     
-    print("✅ Database estendido com Tags e SLA!")
\ No newline at end of file
+    logger.debug("✅ Database estendido com Tags e SLA!")
\ No newline at end of file
@@ -0,0 +1,159 @@
+"""
+Monitor de saúde em segundo plano
+
+Uma thread verifica o bridge do WhatsApp e o banco a cada `interval`
+segundos e publica o resultado em memória. /health e /api/whatsapp/status
+respondem direto desse estado (nunca esperam a rede), e toda mudança de
+conectividade vira um evento Socket.IO (connection_status).
+"""
+import atexit
+import threading
+import time
+from datetime import datetime
+
+from realtime import AUTHENTICATED_ROOM
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+
+class HealthMonitor:
+    """
+    Verificação periódica do bridge e do banco com estado em cache
+
+    Usage:
+        monitor = HealthMonitor(db, whatsapp, socketio, interval=15)
+        monitor.start()
+        monitor.snapshot()  # dict pronto para jsonify, sem I/O
+    """
+
+    def __init__(self, database, whatsapp, socketio, interval=15):
+        self.db = database
+        self.whatsapp = whatsapp
+        self.socketio = socketio
+        self.interval = interval
+        self._state = {
+            "status": "starting",
+            "checked_at": None,
+            "database": {"ok": False, "latency_ms": None, "error": None},
+            "whatsapp": {"connected": False, "phone": None},
+        }
+        self._state_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # =============================
+    # CICLO DE VIDA
+    # =============================
+    def start(self):
+        """Faz a primeira verificação em segundo plano e segue no intervalo (idempotente)"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="health-monitor", daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        self._wakeup.set()
+        thread = self._thread
+        if thread and thread.is_alive():
+            thread.join(timeout)
+
+    def refresh(self):
+        """Pede uma verificação imediata (ex: depois de desconectar o WhatsApp)"""
+        self._wakeup.set()
+
+    # =============================
+    # LEITURA (request thread)
+    # =============================
+    def snapshot(self):
+        """Último estado publicado (cópia)"""
+        with self._state_lock:
+            state = self._state
+            return {
+                **state,
+                "database": dict(state["database"]),
+                "whatsapp": dict(state["whatsapp"]),
+            }
+
+    def is_healthy(self):
+        return self.snapshot()["status"] == "healthy"
+
+    def whatsapp_connected(self):
+        """Bridge conectado na última verificação (None antes da primeira)"""
+        with self._state_lock:
+            if self._state["status"] == "starting":
+                return None
+            return self._state["whatsapp"]["connected"]
+
+    # =============================
+    # VERIFICAÇÃO (thread do monitor)
+    # =============================
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                logger.exception("❌ Erro no monitor de saúde: %s", e)
+            finally:
+                self.db.release_connection()
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def check(self):
+        """Verifica bridge e banco, publica o estado e avisa se a conectividade mudou"""
+        database = self._check_database()
+        bridge = self.whatsapp.check_connection()
+        whatsapp = {
+            "connected": bool(bridge.get("connected")),
+            "phone": bridge.get("phone"),
+        }
+
+        if not database["ok"]:
+            status = "unhealthy"
+        elif not whatsapp["connected"]:
+            status = "degraded"
+        else:
+            status = "healthy"
+
+        with self._state_lock:
+            previous = self._state
+            self._state = {
+                "status": status,
+                "checked_at": datetime.now().isoformat(),
+                "database": database,
+                "whatsapp": whatsapp,
+            }
+
+        changed = (
+            previous["database"]["ok"] != database["ok"]
+            or previous["whatsapp"]["connected"] != whatsapp["connected"]
+        )
+        if changed:
+            if previous["status"] != "starting":
+                logger.warning("📡 Conectividade mudou: %s → %s", previous["status"], status)
+            self._emit()
+        return status
+
+    def _check_database(self):
+        started = time.perf_counter()
+        try:
+            self.db.get_connection().execute("SELECT 1").fetchone()
+        except Exception as e:
+            return {"ok": False, "latency_ms": None, "error": str(e)}
+        latency = (time.perf_counter() - started) * 1000
+        return {"ok": True, "latency_ms": round(latency, 2), "error": None}
+
+    def _emit(self):
+        state = self.snapshot()
+        self.socketio.emit("connection_status", {
+            "status": state["status"],
+            "checked_at": state["checked_at"],
+            "database": state["database"]["ok"],
+            "whatsapp": state["whatsapp"]["connected"],
+        }, to=AUTHENTICATED_ROOM)
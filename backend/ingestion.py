@@ -0,0 +1,271 @@
+"""
+Pipeline de ingestão de mensagens recebidas (webhook do WhatsApp)
+
+O webhook valida o payload, enfileira o evento e espera o commit do lote
+em que ele entrou (submit devolve um Future resolvido pela thread escritora
+depois do COMMIT): o bridge só recebe o OK de mensagem já gravada. A thread
+escritora drena a fila em lotes e grava lead + mensagem + timeline de vários
+eventos em uma única transação (um fsync por lote, não três por mensagem).
+Os eventos Socket.IO são emitidos depois do commit, um por lead afetado.
+
+Lotes que já chegam agrupados (webhook em lote: history sync, backlog de
+reconexão) não passam pela fila: ingest_batch grava direto, numa transação.
+
+O bridge reentrega mensagens (retry do Venom/Baileys, replay na reconexão).
+Os ids de provedor recentes ficam num LRU em memória (id -> Future da
+gravação original), consultado e reservado sob um único lock antes de
+qualquer acesso ao banco: a reentrega espera o mesmo Future e recebe o
+lead da original. O índice único em messages.provider_message_id garante
+o resto (ex: depois de reiniciar o processo).
+"""
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from realtime import lead_event_rooms
+from utils import LRUCache
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+
+class MessageIngestor:
+    """
+    Fila limitada + thread escritora com group commit
+
+    Usage:
+        ingestor = MessageIngestor(db, socketio)
+        ingestor.start()
+        future, duplicate = ingestor.submit(event)
+        if future is None:
+            ...  # fila cheia: responder 503 para o bridge tentar de novo
+        lead_id = future.result(timeout=5)  # depois do COMMIT (da original, se duplicate)
+    """
+    _STOP = object()
+
+    def __init__(self, database, socketio, max_queue=10000, batch_size=200, max_delay_ms=20,
+                 recent_ids=50000):
+        self.db = database
+        self.socketio = socketio
+        self.batch_size = batch_size
+        self.max_delay = max_delay_ms / 1000
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        # provider_id -> Future da gravação original (resolvido com o lead_id)
+        self._recent_ids = LRUCache(recent_ids)
+        self._ids_lock = threading.Lock()
+        self.stats = {
+            "enqueued": 0,
+            "rejected": 0,
+            "duplicates": 0,
+            "written": 0,
+            "batches": 0,
+            "errors": 0,
+        }
+
+    # =============================
+    # CICLO DE VIDA
+    # =============================
+    def start(self):
+        """Inicia a thread escritora (idempotente)"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="message-ingestor", daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=10):
+        """Grava o que ainda está na fila e encerra a thread"""
+        thread = self._thread
+        if not thread or not thread.is_alive():
+            return
+        self.queue.put(self._STOP)
+        thread.join(timeout)
+
+    # =============================
+    # PRODUTOR (request thread)
+    # =============================
+    def submit(self, event, timeout=0.5):
+        """
+        Enfileira um evento já validado
+
+        Args:
+            event: dict com phone, name, content e received_at
+            timeout: quanto esperar por espaço na fila antes de desistir
+
+        Returns:
+            (future, duplicate): future com o lead_id, resolvido depois do
+            COMMIT do lote (ou com a exceção, se a gravação falhar); para
+            reentrega, o future da mensagem original. (None, False) se a
+            fila está cheia
+        """
+        future, duplicate = self._claim(event)
+        if duplicate:
+            return future, True
+        try:
+            self.queue.put((event, future), timeout=timeout)
+        except queue.Full:
+            self.stats["rejected"] += 1
+            self._release(event, future)
+            return None, False
+        self.stats["enqueued"] += 1
+        return future, False
+
+    def ingest_batch(self, events):
+        """
+        Grava um lote já montado na thread atual (sem passar pela fila)
+
+        Returns:
+            (gravadas, duplicadas)
+        """
+        batch, duplicates = [], 0
+        for event in events:
+            future, duplicate = self._claim(event)
+            if duplicate:
+                duplicates += 1
+            else:
+                batch.append((event, future))
+        if not batch:
+            return 0, duplicates
+        written, repeated = self._write(batch)
+        return written, duplicates + repeated
+
+    def _claim(self, event):
+        """
+        Checa e reserva o id do provedor numa única operação
+
+        Returns:
+            (future, duplicate): o future da original se o id já foi visto,
+            senão um future novo, já registrado para as próximas reentregas
+        """
+        future = Future()
+        provider_id = event.get("provider_id")
+        if not provider_id:
+            return future, False
+        with self._ids_lock:
+            original = self._recent_ids.get(provider_id)
+            if original is not None:
+                self.stats["duplicates"] += 1
+                return original, True
+            self._recent_ids.set(provider_id, future)
+        return future, False
+
+    def _release(self, event, future):
+        """Libera o id de uma mensagem que não foi gravada (a reentrega tem que passar)"""
+        provider_id = event.get("provider_id")
+        if not provider_id:
+            return
+        with self._ids_lock:
+            if self._recent_ids.get(provider_id) is future:
+                self._recent_ids.delete(provider_id)
+
+    def pending(self):
+        """Quantidade aproximada de eventos aguardando gravação"""
+        return self.queue.qsize()
+
+    # =============================
+    # CONSUMIDOR (thread escritora)
+    # =============================
+    def _next_batch(self):
+        """Bloqueia até o primeiro (evento, future) e junta os que chegarem em max_delay"""
+        first = self.queue.get()
+        if first is self._STOP:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if stopping:
+                # Drena o restante da fila antes de sair
+                while True:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not self._STOP:
+                        batch.append(item)
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    logger.exception("❌ Erro na thread de ingestão: %s", e)
+                    # Quem ainda espera o commit recebe o erro (o webhook responde 500)
+                    for event, future in batch:
+                        if not future.done():
+                            self._release(event, future)
+                            future.set_exception(e)
+            self.db.release_connection()
+
+    def _write(self, batch):
+        """Grava [(evento, future)] e resolve cada future depois do COMMIT"""
+        events = [event for event, _ in batch]
+        futures = {id(event): future for event, future in batch}
+        try:
+            results, duplicates = self.db.ingest_messages(events)
+        except Exception as e:
+            # Um evento ruim não pode derrubar o lote inteiro: grava um a um
+            logger.error("❌ Erro ao gravar lote de %d mensagens: %s", len(batch), e)
+            self.stats["errors"] += 1
+            results, duplicates = [], []
+            for event in events:
+                try:
+                    written, repeated = self.db.ingest_messages([event])
+                    results.extend(written)
+                    duplicates.extend(repeated)
+                except Exception as error:
+                    self.stats["errors"] += 1
+                    logger.exception("❌ Mensagem descartada na ingestão", extra={"phone": event.get("phone")})
+                    self._release(event, futures[id(event)])
+                    futures[id(event)].set_exception(error)
+
+        self.stats["batches"] += 1
+        self.stats["written"] += len(results)
+        self.stats["duplicates"] += len(duplicates)
+        for event, lead_id in results + duplicates:
+            futures[id(event)].set_result(lead_id)
+
+        if not results:
+            return 0, len(duplicates)
+        # Um evento por lead, com todas as mensagens dele no lote
+        by_lead = {}
+        for event, lead_id in results:
+            by_lead.setdefault(lead_id, []).append(event)
+        assignees = self.db.get_lead_assignees(by_lead)
+        for lead_id, events in by_lead.items():
+            self._emit(lead_id, events, assignees.get(lead_id))
+        return len(results), len(duplicates)
+
+    def _emit(self, lead_id, events, assigned_to):
+        # 🔹 Emite atualização em tempo real (gestores, conversa aberta e vendedor do lead)
+        last = events[-1]
+        self.socketio.emit("new_message", {
+            "lead_id": lead_id,
+            "phone": last["phone"],
+            "name": last["name"],
+            "content": last["content"],
+            "timestamp": last["received_at"],
+            "sender_type": "lead",
+            "count": len(events),
+            "messages": [
+                {"content": e["content"], "timestamp": e["received_at"], "sender_type": "lead"}
+                for e in events
+            ]
+        }, to=lead_event_rooms(lead_id, assigned_to))
@@ -0,0 +1,146 @@
+"""
+Logging estruturado e não bloqueante
+
+Os módulos usam `logger = get_logger(__name__)`. setup_logging() coloca um
+QueueHandler na raiz: o request só enfileira o registro, e a formatação
+(JSON) e a escrita em stdout/arquivo acontecem na thread do QueueListener.
+
+Cada registro leva o request_id do request atual (cabeçalho X-Request-ID ou
+gerado em app.py). Corpos de mensagem passam por log_body(), que por padrão
+só registra o tamanho (LOG_MESSAGE_BODIES=redact | sample | full).
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+# Atributos padrão de LogRecord; o que sobrar veio de extra={...}
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+_listener = None
+_body_mode = "redact"
+_body_sample_rate = 0.01
+
+
+def get_logger(name):
+    """Logger do módulo (ex: get_logger(__name__))"""
+    return logging.getLogger(f"crm.{name}")
+
+
+def log_body(content):
+    """
+    Versão do corpo de uma mensagem que pode ir para o log
+
+    redact: só o tamanho; sample: texto completo em uma fração dos registros;
+    full: texto completo (só para depuração local)
+    """
+    content = content or ""
+    if _body_mode == "full" or (_body_mode == "sample" and random.random() < _body_sample_rate):
+        return content
+    return f"<{len(content)} chars>"
+
+
+class RequestIdFilter(logging.Filter):
+    """Anexa o request_id do request Flask atual (None fora de request)"""
+
+    def filter(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = _current_request_id()
+        return True
+
+
+def _current_request_id():
+    try:
+        from flask import g, has_request_context
+    except ImportError:
+        return None
+    if not has_request_context():
+        return None
+    return g.get("request_id")
+
+
+class JsonFormatter(logging.Formatter):
+    """Uma linha JSON por registro, com os campos de extra={...}"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Mesmo processo: só resolve msg % args; traceback e JSON ficam para o listener"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(level="INFO", log_file=None, json_format=True, message_bodies="redact",
+                  body_sample_rate=0.01):
+    """
+    Configura o logging da aplicação (idempotente)
+
+    Args:
+        level: nível mínimo (Config.LOG_LEVEL)
+        log_file: arquivo adicional além de stdout (Config.LOG_FILE); None/'' desliga
+        json_format: JSON por linha (False = texto legível)
+        message_bodies: redact | sample | full (ver log_body)
+    """
+    global _listener, _body_mode, _body_sample_rate
+    _body_mode = message_bodies
+    _body_sample_rate = body_sample_rate
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    # Uma linha por conexão do pool HTTP do bridge é ruído mesmo em DEBUG
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+    if _listener is not None:
+        return
+
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)s [%(name)s] [%(request_id)s] %(message)s")
+
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=20 * 1024 * 1024, backupCount=5, encoding="utf-8"
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # O filtro roda no QueueHandler, ainda na thread do request (onde existe o request_id)
+    queue_handler = _QueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(RequestIdFilter())
+    root.handlers = [queue_handler]
+
+    _listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_stop)
+
+
+def _stop():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
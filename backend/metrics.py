@@ -0,0 +1,174 @@
+"""
+Métricas internas no formato texto do Prometheus (GET /metrics)
+
+Registro mínimo, sem dependências: contadores, histogramas e métricas
+calculadas na hora da coleta (tamanho de filas, estado do circuito...).
+As medições são feitas pelos próprios módulos:
+
+    app.py              latência por rota e eventos Socket.IO emitidos
+    database.py         tempo de cada statement SQL (conexão instrumentada)
+    whatsapp_service.py latência das chamadas ao bridge
+
+Os rótulos têm cardinalidade baixa por construção: rota = regra do Flask
+(/api/leads/<int:lead_id>), statement = primeira palavra do SQL.
+"""
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_labels(self.label_names, key)} {_number(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # key -> [contagem por bucket (+Inf no fim), soma]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        lines = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """
+    Valor lido na hora da coleta
+
+    callback() retorna um número ou uma lista de (dict de rótulos, valor).
+    """
+
+    def __init__(self, name, help_text, callback, labels=(), type="gauge"):
+        super().__init__(name, help_text, labels)
+        self.type = type
+        self.callback = callback
+
+    def render(self):
+        value = self.callback()
+        if not isinstance(value, (list, tuple)):
+            value = [({}, value)]
+        return [
+            f"{self.name}{_labels(self.label_names, self._key(labels))} {_number(v)}"
+            for labels, v in value if v is not None
+        ]
+
+
+class Registry:
+    """Conjunto de métricas expostas em /metrics"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            # Reimportar um módulo (ex: testes) reaproveita a métrica existente
+            existing = self._metrics.get(metric.name)
+            if existing is not None and type(existing) is type(metric) and not isinstance(metric, CallbackMetric):
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def gauge_callback(self, name, help_text, callback, labels=()):
+        return self._register(CallbackMetric(name, help_text, callback, labels))
+
+    def counter_callback(self, name, help_text, callback, labels=()):
+        return self._register(CallbackMetric(name, help_text, callback, labels, type="counter"))
+
+    def render(self):
+        """Texto no formato de exposição do Prometheus (0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.render()
+            except Exception:
+                # Uma coleta com erro não derruba as outras
+                continue
+            lines.extend(metric.header())
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -7,66 +7,254 @@ Middlewares de segurança e controle
 """
 from flask import request, jsonify, session
 from functools import wraps
-from datetime import datetime, timedelta
-from collections import defaultdict
+from datetime import datetime
+from collections import deque
+import atexit
 import re
+import sqlite3
+import threading
+import time
+
+from config import config
+from database import LEAD_STATUSES, get_pool
+from logs import get_logger
+
+logger = get_logger(__name__)
 
 # =============================
 # RATE LIMITING
 # =============================
+def _sliding_window_count(previous, current, now, window):
+    """
+    Estimativa do sliding-window counter: a janela anterior entra com o peso
+    da parte dela que ainda cabe nos últimos `window` segundos
+    """
+    elapsed = (now % window) / window
+    return previous * (1 - elapsed) + current
+
+
+def _sliding_window_wait(previous, current, now, window, limit):
+    """
+    Segundos até a estimativa do sliding-window counter voltar a ficar
+    abaixo do limite (valor do header Retry-After)
+    """
+    elapsed = now % window
+    if current < limit:
+        if previous <= 0:
+            return 1
+        wait = window * (1 - (limit - current) / previous) - elapsed
+    else:
+        # A janela atual vira a anterior e precisa perder peso suficiente
+        wait = (window - elapsed) + window * (1 - limit / current)
+    # +1: exatamente na fronteira a estimativa ainda empata com o limite
+    return max(1, int(wait) + 1)
+
+
+class MemoryRateLimitStore:
+    """
+    Contadores em memória do processo: 3 inteiros por chave, thread-safe.
+    Chaves sem uso há mais de duas janelas são descartadas periodicamente.
+    """
+    def __init__(self, evict_interval=60):
+        self._counters = {}  # key -> [window_idx, current, previous, window]
+        self._lock = threading.Lock()
+        self.evict_interval = evict_interval
+        self._next_eviction = time.monotonic() + evict_interval
+
+    def hit(self, key, limit, window, now):
+        """Conta uma request se estiver dentro do limite; retorna se foi permitida"""
+        idx = int(now // window)
+        with self._lock:
+            entry = self._counters.get(key)
+            if entry is None or entry[0] < idx - 1:
+                current, previous = 0, 0
+            elif entry[0] == idx - 1:
+                current, previous = 0, entry[1]
+            else:
+                current, previous = entry[1], entry[2]
+
+            allowed = _sliding_window_count(previous, current, now, window) < limit
+            if allowed:
+                current += 1
+            self._counters[key] = [idx, current, previous, window]
+
+            if time.monotonic() >= self._next_eviction:
+                self._evict(now)
+        return allowed
+
+    def retry_after(self, key, limit, window, now):
+        """Segundos até a chave voltar a ter request permitida"""
+        idx = int(now // window)
+        with self._lock:
+            entry = self._counters.get(key)
+            if entry is None or entry[0] < idx - 1:
+                return 1
+            if entry[0] == idx - 1:
+                return _sliding_window_wait(entry[1], 0, now, window, limit)
+            return _sliding_window_wait(entry[2], entry[1], now, window, limit)
+
+    def _evict(self, now):
+        idle = [
+            key for key, (idx, _, _, window) in self._counters.items()
+            if idx < int(now // window) - 1
+        ]
+        for key in idle:
+            del self._counters[key]
+        self._next_eviction = time.monotonic() + self.evict_interval
+
+    def reset(self, prefix_keys):
+        with self._lock:
+            for key in prefix_keys:
+                self._counters.pop(key, None)
+
+    def __len__(self):
+        return len(self._counters)
+
+
+class SQLiteRateLimitStore:
+    """
+    Contadores compartilhados entre processos/workers em um arquivo SQLite
+    próprio (separado do banco principal para não disputar o lock de escrita).
+    Uma linha por (chave, janela); linhas vencidas são apagadas periodicamente.
+    """
+    def __init__(self, db_name="rate_limits.db", evict_interval=60):
+        self.pool = get_pool(db_name)
+        self.evict_interval = evict_interval
+        self._next_eviction = 0
+        with self.pool.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rate_limit_counters (
+                    key TEXT NOT NULL,
+                    window_idx INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    expires_at INTEGER NOT NULL,
+                    PRIMARY KEY (key, window_idx)
+                ) WITHOUT ROWID
+            """)
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_rate_limit_expires
+                ON rate_limit_counters(expires_at)
+            """)
+        self.pool.release()
+
+    def hit(self, key, limit, window, now):
+        """Conta uma request se estiver dentro do limite; retorna se foi permitida"""
+        idx = int(now // window)
+        try:
+            with self.pool.transaction() as conn:
+                counts = dict(conn.execute("""
+                    SELECT window_idx, count FROM rate_limit_counters
+                    WHERE key = ? AND window_idx IN (?, ?)
+                """, (key, idx - 1, idx)).fetchall())
+
+                allowed = _sliding_window_count(counts.get(idx - 1, 0), counts.get(idx, 0), now, window) < limit
+                if allowed:
+                    conn.execute("""
+                        INSERT INTO rate_limit_counters (key, window_idx, count, expires_at)
+                        VALUES (?, ?, 1, ?)
+                        ON CONFLICT(key, window_idx) DO UPDATE SET count = count + 1
+                    """, (key, idx, (idx + 2) * window))
+
+                if now >= self._next_eviction:
+                    self._next_eviction = now + self.evict_interval
+                    conn.execute("DELETE FROM rate_limit_counters WHERE expires_at < ?", (int(now),))
+            return allowed
+        except sqlite3.Error as e:
+            # Falha do backend compartilhado não pode derrubar a API: libera a request
+            logger.warning("⚠️ Rate limiter indisponível: %s", e)
+            return True
+        finally:
+            self.pool.release()
+
+    def retry_after(self, key, limit, window, now):
+        """Segundos até a chave voltar a ter request permitida"""
+        idx = int(now // window)
+        try:
+            counts = dict(self.pool.connection().execute("""
+                SELECT window_idx, count FROM rate_limit_counters
+                WHERE key = ? AND window_idx IN (?, ?)
+            """, (key, idx - 1, idx)).fetchall())
+        except sqlite3.Error as e:
+            logger.warning("⚠️ Rate limiter indisponível: %s", e)
+            return window
+        finally:
+            self.pool.release()
+        return _sliding_window_wait(counts.get(idx - 1, 0), counts.get(idx, 0), now, window, limit)
+
+    def reset(self, keys):
+        try:
+            with self.pool.transaction() as conn:
+                conn.executemany("DELETE FROM rate_limit_counters WHERE key = ?", [(key,) for key in keys])
+        finally:
+            self.pool.release()
+
+
 class RateLimiter:
     """
-    Rate limiter simples em memória
-    Em produção: usar Redis
+    Rate limiter com sliding-window counter (memória constante por chave)
+
+    Backends:
+        MemoryRateLimitStore  - por processo (default)
+        SQLiteRateLimitStore  - compartilhado entre workers
     """
-    def __init__(self):
-        self.requests = defaultdict(list)
+    WINDOWS = {
+        'per_minute': 60,
+        'per_hour': 3600
+    }
+
+    def __init__(self, per_minute=60, per_hour=1000, store=None, enabled=True):
+        self.store = store or MemoryRateLimitStore()
+        self.enabled = enabled
         self.limits = {
-            'per_minute': 60,
-            'per_hour': 1000
+            'per_minute': per_minute,
+            'per_hour': per_hour
         }
     
     def is_rate_limited(self, identifier, limit_type='per_minute'):
-        """Verifica se o identificador atingiu o limite"""
-        now = datetime.now()
+        """Verifica se o identificador atingiu o limite (e conta a request se não)"""
+        if not self.enabled:
+            return False
         limit = self.limits.get(limit_type, 60)
-        
-        # Define janela de tempo
-        if limit_type == 'per_minute':
-            window = timedelta(minutes=1)
-        elif limit_type == 'per_hour':
-            window = timedelta(hours=1)
-        else:
-            window = timedelta(minutes=1)
-        
-        # Remove requests antigas
-        cutoff = now - window
-        self.requests[identifier] = [
-            req_time for req_time in self.requests[identifier]
-            if req_time > cutoff
-        ]
-        
-        # Verifica limite
-        if len(self.requests[identifier]) >= limit:
-            return True
-        
-        # Adiciona nova request
-        self.requests[identifier].append(now)
-        return False
+        window = self.WINDOWS.get(limit_type, 60)
+        return not self.store.hit(f"{limit_type}:{identifier}", limit, window, time.time())
+
+    def retry_after(self, identifier, limit_type='per_minute'):
+        """Segundos até o identificador voltar a ter request permitida"""
+        limit = self.limits.get(limit_type, 60)
+        window = self.WINDOWS.get(limit_type, 60)
+        return self.store.retry_after(f"{limit_type}:{identifier}", limit, window, time.time())
     
     def reset(self, identifier):
         """Reseta contador para um identificador"""
-        if identifier in self.requests:
-            del self.requests[identifier]
+        self.store.reset([f"{limit_type}:{identifier}" for limit_type in self.WINDOWS])
+
+
+def create_rate_limiter(cfg):
+    """Monta o rate limiter a partir do config (RATE_LIMIT_*)"""
+    if cfg.RATE_LIMIT_BACKEND == 'sqlite':
+        store = SQLiteRateLimitStore(cfg.RATE_LIMIT_DB)
+    elif cfg.RATE_LIMIT_BACKEND == 'memory':
+        store = MemoryRateLimitStore()
+    else:
+        raise ValueError(f"RATE_LIMIT_BACKEND inválido: {cfg.RATE_LIMIT_BACKEND}")
+    return RateLimiter(
+        per_minute=cfg.RATE_LIMIT_PER_MINUTE,
+        per_hour=cfg.RATE_LIMIT_PER_HOUR,
+        store=store,
+        enabled=cfg.RATE_LIMIT_ENABLED,
+    )
 
 
 # Instância global
-rate_limiter = RateLimiter()
+rate_limiter = create_rate_limiter(config)
 
 
-def rate_limit(limit_type='per_minute'):
+def rate_limit(limit_type='per_minute', exempt=None):
     """
     Decorator para rate limiting
+
+    exempt: função chamada a cada request; se retornar True a request não
+    conta nem é limitada (ex.: o bridge autenticado no webhook)
     
     Usage:
         @rate_limit('per_minute')
@@ -76,14 +264,20 @@ def rate_limit(limit_type='per_minute'):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
+            if exempt is not None and exempt():
+                return f(*args, **kwargs)
+
             # Identificador: IP ou user_id se autenticado
             identifier = session.get('user_id') or request.remote_addr
             
             if rate_limiter.is_rate_limited(identifier, limit_type):
-                return jsonify({
+                retry_after = rate_limiter.retry_after(identifier, limit_type)
+                response = jsonify({
                     "error": "Rate limit excedido. Tente novamente em alguns instantes.",
-                    "retry_after": 60 if limit_type == 'per_minute' else 3600
-                }), 429
+                    "retry_after": retry_after
+                })
+                response.headers["Retry-After"] = str(retry_after)
+                return response, 429
             
             return f(*args, **kwargs)
         return decorated_function
@@ -176,9 +370,8 @@ class InputValidator:
     @staticmethod
     def validate_status(status):
         """Valida status de lead"""
-        valid_statuses = ['novo', 'em_atendimento', 'qualificado', 'negociacao', 'ganho', 'perdido']
-        if status not in valid_statuses:
-            return False, f"Status deve ser um de: {', '.join(valid_statuses)}"
+        if status not in LEAD_STATUSES:
+            return False, f"Status deve ser um de: {', '.join(LEAD_STATUSES)}"
         
         return True, status
     
@@ -241,15 +434,13 @@ def handle_errors(f):
         try:
             return f(*args, **kwargs)
         except ValueError as e:
-            print(f"⚠️ Erro de validação: {e}")
+            logger.info("⚠️ Erro de validação: %s", e)
             return jsonify({"error": str(e)}), 400
         except PermissionError as e:
-            print(f"🚫 Erro de permissão: {e}")
+            logger.warning("🚫 Erro de permissão: %s", e)
             return jsonify({"error": "Sem permissão para esta ação"}), 403
         except Exception as e:
-            print(f"❌ Erro interno: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("❌ Erro interno: %s", e)
             return jsonify({"error": "Erro interno do servidor"}), 500
     return decorated_function
 
@@ -258,15 +449,71 @@ def handle_errors(f):
 # AUDIT LOG
 # =============================
 class AuditLogger:
-    """Logger de auditoria para ações críticas"""
-    
-    def __init__(self, database):
+    """
+    Logger de auditoria para ações críticas
+
+    log_action só empilha a entrada em um buffer circular em memória; uma
+    thread de fundo grava no banco com executemany a cada flush_interval_ms
+    ou quando o buffer junta batch_size entradas. Nenhuma rota espera fsync
+    de auditoria.
+
+    Overflow (buffer cheio):
+        'drop_oldest' - descarta a entrada mais antiga ainda não gravada
+        'drop_newest' - descarta a entrada nova
+    """
+    OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest')
+
+    def __init__(self, database, buffer_size=10000, batch_size=500,
+                 flush_interval_ms=1000, overflow_policy='drop_oldest'):
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"overflow_policy deve ser um de: {', '.join(self.OVERFLOW_POLICIES)}")
         self.db = database
-    
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.overflow_policy = overflow_policy
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self.stats = {
+            "logged": 0,
+            "written": 0,
+            "dropped": 0,
+            "errors": 0,
+        }
+
+    # =============================
+    # CICLO DE VIDA
+    # =============================
+    def start(self):
+        """Inicia a thread escritora (idempotente)"""
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=10):
+        """Grava o que ainda está no buffer e encerra a thread"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        thread = self._thread
+        if thread and thread.is_alive():
+            thread.join(timeout)
+        self.flush()
+
+    # =============================
+    # PRODUTOR (request thread)
+    # =============================
     def log_action(self, user_id, action, entity_type, entity_id, details=""):
         """
         Registra ação de auditoria
-        
+
         Args:
             user_id: ID do usuário que executou a ação
             action: Tipo de ação (create, update, delete, etc)
@@ -275,16 +522,72 @@ class AuditLogger:
             details: Detalhes adicionais
         """
         try:
-            # Aqui você pode implementar a lógica de salvar no banco
-            # ou enviar para um serviço de logging externo
-            timestamp = datetime.now().isoformat()
-            print(f"📝 AUDIT: [{timestamp}] User {user_id} - {action} {entity_type} #{entity_id} - {details}")
-            
-            # Opcional: salvar no banco de dados
-            # self.db.save_audit_log(...)
-            
+            # Mesmo formato do CURRENT_TIMESTAMP do SQLite (UTC)
+            timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            logger.debug("📝 AUDIT: %s %s #%s", action, entity_type, entity_id,
+                         extra={"user_id": user_id, "details": details})
+
+            entry = (user_id, action, entity_type, entity_id, details, timestamp)
+            with self._cond:
+                if len(self._buffer) >= self.buffer_size:
+                    self.stats["dropped"] += 1
+                    if self.overflow_policy == 'drop_newest':
+                        return
+                    self._buffer.popleft()
+                self._buffer.append(entry)
+                self.stats["logged"] += 1
+                if len(self._buffer) >= self.batch_size:
+                    self._cond.notify()
+
         except Exception as e:
-            print(f"❌ Erro ao registrar log de auditoria: {e}")
+            logger.error("❌ Erro ao registrar log de auditoria: %s", e)
+
+    def pending(self):
+        """Entradas aguardando gravação"""
+        return len(self._buffer)
+
+    # =============================
+    # CONSUMIDOR (thread escritora)
+    # =============================
+    def _take_batch(self):
+        with self._cond:
+            return [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+
+    def flush(self):
+        """Grava todo o buffer agora (usado no shutdown e pela thread)"""
+        with self._write_lock:
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    break
+                try:
+                    self.db.add_audit_logs(batch)
+                    self.stats["written"] += len(batch)
+                except Exception as e:
+                    logger.error("❌ Erro ao gravar %d logs de auditoria: %s", len(batch), e)
+                    self.stats["errors"] += 1
+                    self._requeue(batch)
+                    break
+                finally:
+                    self.db.release_connection()
+
+    def _requeue(self, batch):
+        """Devolve um lote que falhou para o início do buffer, respeitando o limite"""
+        with self._cond:
+            room = self.buffer_size - len(self._buffer)
+            keep = batch[-room:] if room > 0 else []
+            self.stats["dropped"] += len(batch) - len(keep)
+            self._buffer.extendleft(reversed(keep))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._buffer) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                stopping = self._stopping
+            self.flush()
+            if stopping:
+                return
 
 
 # =============================
@@ -325,4 +628,4 @@ class IPWhitelist:
             if not self.is_allowed(request.remote_addr):
                 return jsonify({"error": "Acesso negado"}), 403
             return f(*args, **kwargs)
-        return decorated_function
\ No newline at end of file
+        return decorated_function
@@ -0,0 +1,612 @@
+"""
+Migrações versionadas do schema SQLite
+
+A versão aplicada fica em PRAGMA user_version. No boot, run_migrations()
+compara com a última versão conhecida e só executa DDL quando há
+migrações pendentes - um banco já atualizado custa uma única leitura.
+
+Para alterar o schema: adicione uma função _mNNN_* e registre em MIGRATIONS.
+Nunca edite uma migração já publicada.
+"""
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+
+# =============================
+# HELPERS
+# =============================
+def get_schema_version(conn):
+    """Retorna a versão atual do schema (PRAGMA user_version)"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _column_exists(conn, table, column):
+    return any(row[1] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+
+def _add_column(conn, table, column, definition):
+    """ALTER TABLE ADD COLUMN idempotente (bancos antigos podem já ter a coluna)"""
+    if not _column_exists(conn, table, column):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+# =============================
+# MIGRAÇÕES
+# =============================
+def _m001_base_schema(conn):
+    """Tabelas principais (antes criadas por Database.init_db)"""
+    # Usuários
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE,
+            password TEXT,
+            name TEXT,
+            role TEXT,
+            active INTEGER DEFAULT 1
+        )
+    """)
+
+    # Leads
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS leads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            phone TEXT,
+            status TEXT DEFAULT 'novo',
+            assigned_to INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Mensagens
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lead_id INTEGER,
+            sender_type TEXT,
+            sender_name TEXT,
+            content TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Notas internas
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS internal_notes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lead_id INTEGER,
+            user_id INTEGER,
+            note TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Logs de auditoria
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS audit_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            action TEXT,
+            entity_type TEXT,
+            entity_id INTEGER,
+            details TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Timeline do lead
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS lead_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lead_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            user_name TEXT NOT NULL,
+            details TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (lead_id) REFERENCES leads(id)
+        )
+    """)
+
+
+def _m002_tags_sla(conn):
+    """Tags e SLA (antes criadas por DatabaseTagsSLA.init_tags_sla_tables)"""
+    # Tabela de Tags disponíveis
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tags (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            color TEXT NOT NULL,
+            icon TEXT,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Tabela de relacionamento Lead-Tag (many-to-many)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS lead_tags (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lead_id INTEGER NOT NULL,
+            tag_id INTEGER NOT NULL,
+            added_by INTEGER,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (lead_id) REFERENCES leads(id),
+            FOREIGN KEY (tag_id) REFERENCES tags(id),
+            FOREIGN KEY (added_by) REFERENCES users(id),
+            UNIQUE(lead_id, tag_id)
+        )
+    """)
+
+    # Tabela de SLA (métricas de tempo)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS lead_sla (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lead_id INTEGER NOT NULL UNIQUE,
+            first_contact_at TIMESTAMP,
+            first_response_at TIMESTAMP,
+            first_response_time_seconds INTEGER,
+            last_interaction_at TIMESTAMP,
+            total_response_time_seconds INTEGER DEFAULT 0,
+            response_count INTEGER DEFAULT 0,
+            avg_response_time_seconds INTEGER,
+            status TEXT DEFAULT 'pending',
+            sla_met BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (lead_id) REFERENCES leads(id)
+        )
+    """)
+
+    # Tags padrão do sistema
+    default_tags = [
+        ("🔥 Quente", "#FF4444", "🔥", "Lead com alta chance de conversão"),
+        ("⭐ VIP", "#FFD700", "⭐", "Cliente importante ou alto ticket"),
+        ("⚡ Urgente", "#FF6600", "⚡", "Requer atenção imediata"),
+        ("💰 Alto Ticket", "#00AA00", "💰", "Oportunidade de alto valor"),
+        ("📅 Agendar Retorno", "#4169E1", "📅", "Marcar para contato futuro"),
+        ("🤔 Indeciso", "#FFA500", "🤔", "Cliente em dúvida"),
+        ("❌ Não Qualificado", "#999999", "❌", "Não se encaixa no perfil"),
+        ("🎯 Novo Lead", "#00CED1", "🎯", "Lead recém chegado"),
+        ("📞 Sem Resposta", "#8B008B", "📞", "Tentativas sem sucesso"),
+        ("✅ Pronto para Fechar", "#32CD32", "✅", "Negociação avançada"),
+    ]
+    conn.executemany("""
+        INSERT OR IGNORE INTO tags (name, color, icon, description)
+        VALUES (?, ?, ?, ?)
+    """, default_tags)
+
+
+def _m003_lead_contact_columns(conn):
+    """Colunas extras de leads (antes adicionadas por adicionar_email.py)"""
+    _add_column(conn, "leads", "email", "TEXT")
+    _add_column(conn, "leads", "city", "TEXT")
+    _add_column(conn, "leads", "origin", "TEXT")
+
+
+def _m004_hot_query_indexes(conn):
+    """Índices das consultas quentes + telefone único por lead"""
+    # Formatos antigos ("+55 51 ...", "...@s.whatsapp.net") viram só dígitos,
+    # como em database.normalize_phone, para o índice único pegar o mesmo número
+    normalized = "TRIM(phone)"
+    for token in ("@c.us", "@s.whatsapp.net", "+", " ", "-"):
+        normalized = f"REPLACE({normalized}, '{token}', '')"
+    conn.execute(f"UPDATE leads SET phone = {normalized} WHERE phone IS NOT NULL AND phone != {normalized}")
+
+    # Leads duplicados (mesmo telefone) são unificados no lead mais antigo
+    duplicates = conn.execute("""
+        SELECT phone, MIN(id) AS keep_id
+        FROM leads
+        WHERE phone IS NOT NULL
+        GROUP BY phone
+        HAVING COUNT(*) > 1
+    """).fetchall()
+
+    for phone, keep_id in duplicates:
+        dup_ids = [r[0] for r in conn.execute(
+            "SELECT id FROM leads WHERE phone = ? AND id != ?", (phone, keep_id)
+        )]
+        marks = ",".join("?" * len(dup_ids))
+        for table in ("messages", "lead_logs", "internal_notes"):
+            conn.execute(f"UPDATE {table} SET lead_id = ? WHERE lead_id IN ({marks})", (keep_id, *dup_ids))
+        for table in ("lead_tags", "lead_sla"):
+            conn.execute(f"UPDATE OR IGNORE {table} SET lead_id = ? WHERE lead_id IN ({marks})", (keep_id, *dup_ids))
+            conn.execute(f"DELETE FROM {table} WHERE lead_id IN ({marks})", dup_ids)
+        conn.execute(f"DELETE FROM leads WHERE id IN ({marks})", dup_ids)
+        logger.warning("🔀 %d lead(s) duplicado(s) unificado(s) no lead %s (%s)", len(dup_ids), keep_id, phone)
+
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_leads_phone ON leads(phone)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_leads_status_updated ON leads(status, updated_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_leads_assigned_updated ON leads(assigned_to, updated_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_lead_id ON messages(lead_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lead_logs_lead_id ON lead_logs(lead_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_internal_notes_lead_created ON internal_notes(lead_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_timestamp ON audit_log(timestamp)")
+    conn.execute("ANALYZE")
+
+
+def _m005_keyset_indexes(conn):
+    """Índice para paginar a lista geral de leads por (updated_at, id)"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_leads_updated ON leads(updated_at, id)")
+
+
+def _m006_messages_fts(conn):
+    """Índice full-text (FTS5) das mensagens, sem acentos, sincronizado por triggers"""
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content,
+            content='messages',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END
+    """)
+    # Indexa as mensagens já existentes
+    conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+
+def _m007_lead_conversation_counters(conn):
+    """Contadores da conversa desnormalizados em leads, mantidos por trigger"""
+    _add_column(conn, "leads", "message_count", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "leads", "last_message_at", "DATETIME")
+    _add_column(conn, "leads", "last_inbound_at", "DATETIME")
+    _add_column(conn, "leads", "last_message_preview", "TEXT")
+
+    # Toda mensagem inserida atualiza o lead na mesma transação
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS leads_counters_message_insert AFTER INSERT ON messages BEGIN
+            UPDATE leads
+            SET message_count = message_count + 1,
+                last_message_at = new.timestamp,
+                last_inbound_at = CASE WHEN new.sender_type = 'lead' THEN new.timestamp ELSE last_inbound_at END,
+                last_message_preview = substr(new.content, 1, 120)
+            WHERE id = new.lead_id;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS leads_counters_message_delete AFTER DELETE ON messages BEGIN
+            UPDATE leads
+            SET message_count = message_count - 1,
+                last_message_at = (SELECT MAX(timestamp) FROM messages WHERE lead_id = old.lead_id),
+                last_inbound_at = (SELECT MAX(timestamp) FROM messages
+                                   WHERE lead_id = old.lead_id AND sender_type = 'lead'),
+                last_message_preview = (SELECT substr(content, 1, 120) FROM messages
+                                        WHERE lead_id = old.lead_id ORDER BY id DESC LIMIT 1)
+            WHERE id = old.lead_id;
+        END
+    """)
+
+    # Backfill único a partir do histórico existente
+    conn.execute("""
+        UPDATE leads
+        SET message_count = (SELECT COUNT(*) FROM messages m WHERE m.lead_id = leads.id),
+            last_message_at = (SELECT MAX(timestamp) FROM messages m WHERE m.lead_id = leads.id),
+            last_inbound_at = (SELECT MAX(timestamp) FROM messages m
+                               WHERE m.lead_id = leads.id AND m.sender_type = 'lead'),
+            last_message_preview = (SELECT substr(content, 1, 120) FROM messages m
+                                    WHERE m.lead_id = leads.id ORDER BY m.id DESC LIMIT 1)
+    """)
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_leads_last_message ON leads(last_message_at)")
+
+
+def _m008_lead_status_counts(conn):
+    """Contagem de leads por (status, vendedor), mantida por triggers em leads"""
+    # assigned_to = 0 representa leads sem vendedor
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS lead_status_counts (
+            status TEXT NOT NULL,
+            assigned_to INTEGER NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (status, assigned_to)
+        ) WITHOUT ROWID
+    """)
+
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS lead_status_counts_insert AFTER INSERT ON leads BEGIN
+            INSERT INTO lead_status_counts (status, assigned_to, count)
+            VALUES (COALESCE(new.status, 'novo'), COALESCE(new.assigned_to, 0), 1)
+            ON CONFLICT (status, assigned_to) DO UPDATE SET count = count + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS lead_status_counts_update AFTER UPDATE OF status, assigned_to ON leads
+        WHEN old.status IS NOT new.status OR old.assigned_to IS NOT new.assigned_to BEGIN
+            UPDATE lead_status_counts SET count = count - 1
+            WHERE status = COALESCE(old.status, 'novo') AND assigned_to = COALESCE(old.assigned_to, 0);
+            INSERT INTO lead_status_counts (status, assigned_to, count)
+            VALUES (COALESCE(new.status, 'novo'), COALESCE(new.assigned_to, 0), 1)
+            ON CONFLICT (status, assigned_to) DO UPDATE SET count = count + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS lead_status_counts_delete AFTER DELETE ON leads BEGIN
+            UPDATE lead_status_counts SET count = count - 1
+            WHERE status = COALESCE(old.status, 'novo') AND assigned_to = COALESCE(old.assigned_to, 0);
+        END
+    """)
+
+    conn.execute("DELETE FROM lead_status_counts")
+    conn.execute("""
+        INSERT INTO lead_status_counts (status, assigned_to, count)
+        SELECT COALESCE(status, 'novo'), COALESCE(assigned_to, 0), COUNT(*)
+        FROM leads
+        GROUP BY 1, 2
+    """)
+
+
+def _m009_lead_sync_sequence(conn):
+    """
+    Versão por linha (updated_seq) para sync incremental da lista de leads
+
+    Um contador global (sync_sequence) é incrementado por trigger a cada
+    mudança visível de um lead: campos editáveis, contadores de mensagem
+    (ou seja, add_message) e tags. create_or_get_lead não toca em lead
+    existente (ON CONFLICT DO NOTHING), então não conta.
+    Leads apagados ou que saíram da carteira de um vendedor viram tombstones.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_sequence (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL
+        )
+    """)
+    _add_column(conn, "leads", "updated_seq", "INTEGER NOT NULL DEFAULT 0")
+
+    # assigned_to = vendedor que perdeu o lead; NULL = lead apagado (todos)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS lead_tombstones (
+            seq INTEGER PRIMARY KEY,
+            lead_id INTEGER NOT NULL,
+            assigned_to INTEGER
+        )
+    """)
+
+    bump = """
+            UPDATE sync_sequence SET value = value + 1 WHERE id = 1;
+            UPDATE leads SET updated_seq = (SELECT value FROM sync_sequence WHERE id = 1) WHERE id = {lead};
+    """
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS leads_seq_insert AFTER INSERT ON leads BEGIN
+            {bump.format(lead="new.id")}
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS leads_seq_update
+        AFTER UPDATE OF name, status, assigned_to, email, city, origin,
+                        message_count, last_message_at, last_inbound_at, last_message_preview
+        ON leads BEGIN
+            {bump.format(lead="new.id")}
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS leads_seq_reassign AFTER UPDATE OF assigned_to ON leads
+        WHEN old.assigned_to IS NOT NULL AND old.assigned_to IS NOT new.assigned_to BEGIN
+            UPDATE sync_sequence SET value = value + 1 WHERE id = 1;
+            INSERT INTO lead_tombstones (seq, lead_id, assigned_to)
+            VALUES ((SELECT value FROM sync_sequence WHERE id = 1), old.id, old.assigned_to);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS leads_seq_delete AFTER DELETE ON leads BEGIN
+            UPDATE sync_sequence SET value = value + 1 WHERE id = 1;
+            INSERT INTO lead_tombstones (seq, lead_id, assigned_to)
+            VALUES ((SELECT value FROM sync_sequence WHERE id = 1), old.id, NULL);
+        END
+    """)
+    for event, row in (("INSERT", "new"), ("DELETE", "old")):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS lead_tags_seq_{event.lower()} AFTER {event} ON lead_tags BEGIN
+                {bump.format(lead=f"{row}.lead_id")}
+            END
+        """)
+
+    # Backfill: numera os leads existentes na ordem de atualização
+    conn.execute("""
+        UPDATE leads SET updated_seq = (
+            SELECT rn FROM (
+                SELECT id, ROW_NUMBER() OVER (ORDER BY updated_at, id) AS rn FROM leads
+            ) ordered WHERE ordered.id = leads.id
+        )
+    """)
+    conn.execute("""
+        INSERT OR REPLACE INTO sync_sequence (id, value)
+        SELECT 1, COALESCE(MAX(updated_seq), 0) FROM leads
+    """)
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_leads_updated_seq ON leads(updated_seq)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_leads_assigned_seq ON leads(assigned_to, updated_seq)")
+
+
+def _m010_outbox(conn):
+    """Fila persistente de mensagens de saída (entregues por outbox.py)"""
+    # status: queued -> sending -> sent | queued (retry) | failed
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lead_id INTEGER NOT NULL,
+            user_id INTEGER,
+            phone TEXT NOT NULL,
+            content TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME,
+            FOREIGN KEY (lead_id) REFERENCES leads(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON outbox(status, next_attempt_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_lead ON outbox(lead_id, id)")
+
+
+def _m011_campaigns(conn):
+    """Campanhas de envio em massa (campaigns.py) e o resultado por destinatário"""
+    # status: running | paused | completed | cancelled
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            template TEXT NOT NULL,
+            filters TEXT,
+            status TEXT NOT NULL DEFAULT 'running',
+            created_by INTEGER,
+            total_recipients INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at DATETIME,
+            FOREIGN KEY (created_by) REFERENCES users(id)
+        )
+    """)
+
+    # status: pending -> queued (na outbox) -> sent | failed; skipped se cancelada
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS campaign_recipients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id INTEGER NOT NULL,
+            lead_id INTEGER NOT NULL,
+            phone TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            content TEXT,
+            outbox_id INTEGER,
+            error TEXT,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (campaign_id) REFERENCES campaigns(id),
+            FOREIGN KEY (lead_id) REFERENCES leads(id),
+            UNIQUE(campaign_id, lead_id)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_campaign_recipients_status ON campaign_recipients(campaign_id, status, id)")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_campaign_recipients_outbox
+        ON campaign_recipients(outbox_id) WHERE outbox_id IS NOT NULL
+    """)
+
+    # O resultado da entrega volta da outbox sem o worker saber de campanhas
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS campaign_recipients_outbox_result
+        AFTER UPDATE OF status ON outbox
+        WHEN new.status IN ('sent', 'failed') AND old.status != new.status
+        BEGIN
+            UPDATE campaign_recipients
+            SET status = new.status, error = new.last_error, updated_at = CURRENT_TIMESTAMP
+            WHERE outbox_id = new.id;
+        END
+    """)
+
+
+def _m012_message_provider_id(conn):
+    """Id da mensagem no provedor (Venom/Baileys): reentregas do bridge viram no-op"""
+    _add_column(conn, "messages", "provider_message_id", "TEXT")
+    # Parcial: mensagens enviadas por nós e as antigas ficam sem id
+    conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_provider_id
+        ON messages(provider_message_id) WHERE provider_message_id IS NOT NULL
+    """)
+
+
+def _m013_data_version(conn):
+    """
+    Versão global dos dados lidos pelas respostas com ETag
+
+    Incrementada por trigger em toda escrita nas tabelas abaixo, venha de
+    qualquer processo (workers, outbox, scripts, sqlite3 na mão). epoch é
+    sorteado na criação: um banco recriado não reaproveita ETags antigas.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS data_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            epoch TEXT NOT NULL,
+            value INTEGER NOT NULL
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO data_version (id, epoch, value) VALUES (1, lower(hex(randomblob(8))), 0)")
+    for table in ("users", "leads", "messages", "tags", "lead_tags", "lead_sla"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_data_version_{event.lower()} AFTER {event} ON {table} BEGIN
+                    UPDATE data_version SET value = value + 1 WHERE id = 1;
+                END
+            """)
+
+
+def _m014_outbox_lease(conn):
+    """
+    Reserva com prazo (lease) das mensagens em envio
+
+    claimed_by identifica o dispatcher (host:pid:aleatório) e lease_until é
+    até quando a reserva vale. Só mensagens com lease vencido voltam para a
+    fila: um processo reiniciando não rouba o que outro ainda está enviando.
+    """
+    _add_column(conn, "outbox", "claimed_by", "TEXT")
+    _add_column(conn, "outbox", "lease_until", "REAL")
+
+
+# (versão, descrição, função) - sempre em ordem crescente
+MIGRATIONS = [
+    (1, "schema base", _m001_base_schema),
+    (2, "tags e SLA", _m002_tags_sla),
+    (3, "colunas email/city/origin em leads", _m003_lead_contact_columns),
+    (4, "índices das consultas quentes", _m004_hot_query_indexes),
+    (5, "índice de paginação de leads", _m005_keyset_indexes),
+    (6, "busca full-text de mensagens (FTS5)", _m006_messages_fts),
+    (7, "contadores de conversa em leads", _m007_lead_conversation_counters),
+    (8, "contagem de leads por status", _m008_lead_status_counts),
+    (9, "sequência de sync incremental de leads", _m009_lead_sync_sequence),
+    (10, "fila de mensagens de saída (outbox)", _m010_outbox),
+    (11, "campanhas de envio em massa", _m011_campaigns),
+    (12, "id da mensagem no provedor (dedupe do webhook)", _m012_message_provider_id),
+    (13, "versão global dos dados (ETags)", _m013_data_version),
+    (14, "lease das mensagens em envio na outbox", _m014_outbox_lease),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+# =============================
+# RUNNER
+# =============================
+def run_migrations(pool):
+    """
+    Aplica as migrações pendentes, cada uma em sua própria transação.
+
+    A versão é relida depois do BEGIN IMMEDIATE, então dois processos
+    subindo ao mesmo tempo não aplicam a mesma migração duas vezes.
+
+    Returns:
+        Quantidade de migrações aplicadas
+    """
+    if get_schema_version(pool.connection()) >= SCHEMA_VERSION:
+        return 0
+
+    applied = 0
+    for version, description, migrate in MIGRATIONS:
+        with pool.transaction() as conn:
+            if get_schema_version(conn) >= version:
+                continue
+            migrate(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+        applied += 1
+        logger.info("🗄️ Migração %d aplicada: %s", version, description)
+
+    return applied
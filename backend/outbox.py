@@ -0,0 +1,193 @@
+"""
+Fila persistente de mensagens de saída (tabela outbox)
+
+A rota de envio só grava a mensagem na outbox e responde na hora com o id
+('queued'). Um pool de workers entrega ao bridge do WhatsApp com uma
+tentativa por vez; falhas voltam para a fila com backoff exponencial e
+jitter; com o circuit breaker do bridge aberto, ou o WhatsApp desconectado
+na última verificação do HealthMonitor, as mensagens são só reagendadas,
+sem gastar tentativas.
+
+Como tudo está no banco, a fila sobrevive a restarts. As transições
+'sent'/'failed' chegam ao front pelo Socket.IO (evento message_status).
+
+Cada mensagem em envio fica reservada para um dispatcher (claimed_by) até
+lease_until. Mais de um processo pode rodar workers: só reservas vencidas
+(dispatcher que caiu no meio do envio) voltam a ser distribuídas.
+"""
+import atexit
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+from realtime import lead_event_rooms
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+
+class OutboxDispatcher:
+    """
+    Workers de entrega da outbox
+
+    Usage:
+        outbox = OutboxDispatcher(db, whatsapp, socketio, health=health_monitor)
+        outbox.start()
+        outbox_id = outbox.enqueue(lead, content, user_id)
+    """
+
+    def __init__(self, database, whatsapp, socketio, workers=4, max_attempts=6,
+                 retry_base_seconds=2, retry_max_seconds=300, poll_interval=1.0,
+                 lease_seconds=120, health=None):
+        self.db = database
+        self.whatsapp = whatsapp
+        self.socketio = socketio
+        # HealthMonitor: estado do bridge já verificado, sem chamada de rede por mensagem
+        self.health = health
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base_seconds
+        self.retry_max = retry_max_seconds
+        self.poll_interval = poll_interval
+        # Precisa cobrir um envio inteiro (timeouts de conexão + leitura do bridge)
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self.stats = {
+            "enqueued": 0,
+            "sent": 0,
+            "retried": 0,
+            "failed": 0,
+        }
+
+    # =============================
+    # CICLO DE VIDA
+    # =============================
+    def start(self):
+        """Inicia os workers (idempotente); envios com lease vencido são retomados no claim"""
+        with self._lock:
+            if self._threads:
+                return
+            expired = self.db.count_expired_outbox_leases(time.time())
+            self.db.release_connection()
+            if expired:
+                logger.warning("📤 Outbox: %d mensagens interrompidas serão reenviadas", expired)
+            self._stopping.clear()
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"outbox-worker-{n}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        atexit.register(self.stop)
+
+    def stop(self, timeout=15):
+        """Termina o envio em andamento e encerra os workers (o resto fica na fila)"""
+        self._stopping.set()
+        self._wakeup.set()
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(timeout)
+
+    # =============================
+    # PRODUTOR (request thread)
+    # =============================
+    def enqueue(self, lead, content, user_id=None):
+        """Grava a mensagem na outbox e acorda um worker; retorna o id"""
+        outbox_id = self.db.enqueue_outbox(lead["id"], lead["phone"], content, user_id)
+        self.stats["enqueued"] += 1
+        self._wakeup.set()
+        return outbox_id
+
+    def notify(self):
+        """Acorda um worker (mensagens gravadas direto na tabela, ex: campanhas)"""
+        self._wakeup.set()
+
+    def pending(self):
+        """Mensagens aguardando envio"""
+        return self.db.count_outbox("queued")
+
+    # =============================
+    # WORKERS
+    # =============================
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                item = self.db.claim_outbox(time.time(), self.owner, self.lease_seconds)
+                if item:
+                    self._deliver(item)
+            except Exception as e:
+                logger.exception("❌ Erro no worker da outbox: %s", e)
+                item = None
+            finally:
+                self.db.release_connection()
+
+            if not item:
+                # Fila vazia (ou só retries no futuro): dorme até enqueue() ou o próximo poll
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def _deliver(self, item):
+        lead = self.db.get_lead(item["lead_id"])
+        if not lead:
+            self._fail(item, None, "Lead não encontrado")
+            return
+
+        # Bridge fora do ar: reagenda sem gastar tentativa nem ocupar o worker
+        if self.whatsapp.circuit_open():
+            # Para quando o circuito aceitar teste
+            self._postpone(item, self.whatsapp.breaker.retry_after(), "Circuito do bridge aberto")
+            return
+        if self.health is not None and self.health.whatsapp_connected() is False:
+            # Para depois da próxima verificação do monitor
+            self._postpone(item, self.health.interval, "WhatsApp não conectado")
+            return
+
+        logger.debug("📤 Outbox #%d: enviando para %s (tentativa %d/%d)",
+                     item["id"], item["phone"], item["attempts"], self.max_attempts)
+        ok, error = self.whatsapp.deliver(item["phone"], item["content"])
+
+        if ok:
+            if not self.whatsapp.record_sent(lead, item["content"], item["user_id"],
+                                             outbox_id=item["id"], owner=self.owner):
+                return
+            self.stats["sent"] += 1
+            self._emit_status(item, lead, "sent")
+        elif item["attempts"] >= self.max_attempts:
+            self._fail(item, lead, error)
+        else:
+            delay = self._backoff(item["attempts"])
+            self.db.mark_outbox_retry(item["id"], self.owner, time.time() + delay, error)
+            self.stats["retried"] += 1
+            logger.warning("⚠️ Outbox #%d: %s. Nova tentativa em %.1fs", item["id"], error, delay)
+
+    def _postpone(self, item, delay, reason):
+        self.db.mark_outbox_retry(item["id"], self.owner,
+                                  time.time() + delay + random.uniform(0, self.retry_base),
+                                  reason, refund_attempt=True)
+
+    def _fail(self, item, lead, error):
+        self.db.mark_outbox_failed(item["id"], self.owner, error)
+        self.stats["failed"] += 1
+        logger.error("❌ Outbox #%d: falhou após %d tentativas (%s)", item["id"], item["attempts"], error)
+        self._emit_status(item, lead, "failed", error)
+
+    def _backoff(self, attempts):
+        """Exponencial com jitter: metade fixa + metade aleatória do teto"""
+        cap = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+        return cap / 2 + random.uniform(0, cap / 2)
+
+    def _emit_status(self, item, lead, status, error=None):
+        assigned_to = lead.get("assigned_to") if lead else None
+        self.socketio.emit("message_status", {
+            "outbox_id": item["id"],
+            "lead_id": item["lead_id"],
+            "status": status,
+            "attempts": item["attempts"],
+            "error": error
+        }, to=lead_event_rooms(item["lead_id"], assigned_to, item["user_id"]))
@@ -0,0 +1,58 @@
+"""
+Salas do Socket.IO
+
+As salas são atribuídas pelo servidor a partir da sessão autenticada:
+    authenticated  - toda conexão com sessão (avisos gerais, ex: status da conexão)
+    user:<id>      - todas as conexões de um usuário
+    role:gestor    - admins e gestores (visão da loja inteira)
+    lead:<id>      - quem está com a conversa do lead aberta
+
+Cada evento vai só para as salas interessadas no lead, em vez de ser
+transmitido para todo mundo.
+"""
+
+AUTHENTICATED_ROOM = "authenticated"
+GESTOR_ROOM = "role:gestor"
+GESTOR_ROLES = ("admin", "gestor")
+
+
+def user_room(user_id):
+    return f"user:{user_id}"
+
+
+def lead_room(lead_id):
+    return f"lead:{lead_id}"
+
+
+def session_rooms(user_id, role):
+    """Salas em que uma conexão autenticada entra automaticamente"""
+    rooms = [AUTHENTICATED_ROOM, user_room(user_id)]
+    if role in GESTOR_ROLES:
+        rooms.append(GESTOR_ROOM)
+    return rooms
+
+
+def lead_event_rooms(lead_id, assigned_to=None, *user_ids):
+    """
+    Destinatários de um evento sobre um lead: gestores, a conversa aberta,
+    o vendedor responsável e qualquer outro usuário envolvido (ex: quem
+    perdeu o lead numa transferência)
+
+    Lead sem vendedor está na fila de atendimento, que todos os vendedores
+    veem: o evento vai para todas as conexões autenticadas.
+    """
+    rooms = [GESTOR_ROOM, lead_room(lead_id)]
+    if not assigned_to:
+        rooms.append(AUTHENTICATED_ROOM)
+    for uid in (assigned_to, *user_ids):
+        if uid and user_room(uid) not in rooms:
+            rooms.append(user_room(uid))
+    return rooms
+
+
+def parse_lead_room(room):
+    """Retorna o lead_id de 'lead:<id>' (ou None se não for sala de lead)"""
+    prefix, _, lead_id = str(room).partition(":")
+    if prefix != "lead" or not lead_id.isdigit():
+        return None
+    return int(lead_id)
@@ -0,0 +1,66 @@
+"""
+Fixtures dos testes
+
+O ambiente é montado antes de qualquer import do backend: config.py lê as
+variáveis na importação e o python-dotenv não sobrescreve o que já está em
+os.environ. Cada sessão usa um banco temporário, sem bridge do WhatsApp
+(porta fechada) e sem rate limit nas rotas.
+"""
+import os
+import sys
+import tempfile
+
+_TMP = tempfile.mkdtemp(prefix="crm-tests-")
+os.environ.update({
+    "DATABASE_NAME": os.path.join(_TMP, "crm_test.db"),
+    "RATE_LIMIT_ENABLED": "False",
+    "RATE_LIMIT_BACKEND": "memory",
+    "WHATSAPP_SERVICE_URL": "http://127.0.0.1:9",
+    "WHATSAPP_CONNECT_TIMEOUT": "0.2",
+    "HEALTH_CHECK_INTERVAL": "3600",
+    "LOG_FILE": "",
+    "LOG_LEVEL": "WARNING",
+    "SOCKETIO_ASYNC_MODE": "threading",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import itertools
+
+import pytest
+
+_phones = itertools.count(1)
+
+
+@pytest.fixture
+def phone():
+    """Telefone único por teste (o banco do app é compartilhado na sessão)"""
+    return f"5551{next(_phones):09d}"
+
+
+@pytest.fixture(scope="session")
+def crm():
+    """Módulo app.py importado uma vez (serviços e threads de fundo no ar)"""
+    import app
+    return app
+
+
+@pytest.fixture
+def client(crm):
+    """Cliente HTTP logado como admin"""
+    client = crm.app.test_client()
+    response = client.post("/api/login", json={"username": "admin", "password": "admin123"})
+    assert response.status_code == 200
+    return client
+
+
+@pytest.fixture
+def webhook(crm):
+    """Cliente HTTP sem sessão (o bridge)"""
+    return crm.app.test_client()
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Database isolado em arquivo próprio (testes que não precisam do app)"""
+    from database import Database
+    return Database(str(tmp_path / "isolated.db"))
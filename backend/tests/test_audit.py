@@ -0,0 +1,90 @@
+"""AuditLogger: buffer em memória gravado em lote por uma thread de fundo"""
+import time
+
+import pytest
+
+from middlewares import AuditLogger
+
+
+def _stored(database):
+    rows = database.get_connection().execute("SELECT entity_id FROM audit_log ORDER BY id")
+    return [row[0] for row in rows]
+
+
+def _log(audit, *entity_ids):
+    for entity_id in entity_ids:
+        audit.log_action(1, "update", "lead", entity_id, "detalhe")
+
+
+def test_log_action_only_buffers(database):
+    audit = AuditLogger(database)
+
+    _log(audit, 1, 2, 3)
+
+    assert _stored(database) == []
+    assert audit.pending() == 3
+
+
+def test_flush_writes_everything_in_order_in_batches(database, monkeypatch):
+    audit = AuditLogger(database, batch_size=2)
+    batches = []
+    original = database.add_audit_logs
+    monkeypatch.setattr(database, "add_audit_logs", lambda entries: batches.append(len(entries)) or original(entries))
+    _log(audit, 1, 2, 3, 4, 5)
+
+    audit.flush()
+
+    assert _stored(database) == [1, 2, 3, 4, 5]
+    assert batches == [2, 2, 1]
+    assert audit.stats["written"] == 5 and audit.pending() == 0
+
+
+@pytest.mark.parametrize("policy, kept", [("drop_oldest", [3, 4, 5]), ("drop_newest", [1, 2, 3])])
+def test_overflow_policy(database, policy, kept):
+    audit = AuditLogger(database, buffer_size=3, overflow_policy=policy)
+
+    _log(audit, 1, 2, 3, 4, 5)
+    audit.flush()
+
+    assert _stored(database) == kept
+    assert audit.stats["dropped"] == 2
+
+
+def test_unknown_overflow_policy_is_rejected(database):
+    with pytest.raises(ValueError):
+        AuditLogger(database, overflow_policy="block")
+
+
+def test_failed_write_keeps_entries_for_the_next_flush(database, monkeypatch):
+    audit = AuditLogger(database)
+    _log(audit, 1, 2)
+    original = database.add_audit_logs
+
+    def locked(entries):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(database, "add_audit_logs", locked)
+    audit.flush()
+    assert audit.stats["errors"] == 1 and audit.pending() == 2
+
+    monkeypatch.setattr(database, "add_audit_logs", original)
+    _log(audit, 3)
+    audit.flush()
+    assert _stored(database) == [1, 2, 3]
+
+
+def test_background_writer_flushes_on_interval_and_on_stop(database):
+    audit = AuditLogger(database, batch_size=100, flush_interval_ms=20)
+    audit.start()
+    try:
+        _log(audit, 1)
+        deadline = time.monotonic() + 2
+        while _stored(database) != [1] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert _stored(database) == [1]
+    finally:
+        audit.flush_interval = 60
+        _log(audit, 2)
+        audit.stop()
+
+    assert _stored(database) == [1, 2]
@@ -0,0 +1,95 @@
+"""PerformanceCache: LRU/TTL e invalidação por tópico com gerações"""
+from utils import PerformanceCache
+
+
+def test_invalidate_drops_only_that_topic():
+    cache = PerformanceCache()
+    cache.set("tags:all", [1])
+    cache.set("leads:metrics:None", {"total": 1})
+
+    cache.invalidate("tags")
+
+    assert cache.get("tags:all") is None
+    assert cache.get("leads:metrics:None") == {"total": 1}
+    assert cache.get_stats()["invalidations"] == 1
+
+
+def test_fill_that_raced_with_invalidation_is_discarded():
+    cache = PerformanceCache()
+
+    def stale_loader():
+        # Leu o banco antes do commit que disparou a invalidação
+        cache.invalidate("leads")
+        return {"total": "velho"}
+
+    assert cache.get_or_set("leads:metrics:None", stale_loader) == {"total": "velho"}
+    assert cache.get("leads:metrics:None") is None
+
+    assert cache.get_or_set("leads:metrics:None", lambda: {"total": "novo"}) == {"total": "novo"}
+    assert cache.get("leads:metrics:None") == {"total": "novo"}
+
+
+def test_invalidating_another_topic_keeps_the_fill():
+    cache = PerformanceCache()
+
+    def loader():
+        cache.invalidate("tags")
+        return [1, 2]
+
+    cache.get_or_set("users:all", loader)
+
+    assert cache.get("users:all") == [1, 2]
+
+
+def test_clear_also_discards_in_flight_fills():
+    cache = PerformanceCache()
+
+    def loader():
+        cache.clear()
+        return "valor"
+
+    cache.get_or_set("sla:metrics", loader)
+
+    assert cache.get("sla:metrics") is None
+
+
+def test_lru_bounds_by_entries_and_bytes():
+    cache = PerformanceCache(max_entries=2, max_bytes=50)
+    cache.set("a:1", "x")
+    cache.set("a:2", "y")
+    cache.get("a:1")
+    cache.set("a:3", "z")
+
+    assert cache.get("a:2") is None  # menos usada saiu
+    assert cache.get("a:1") == "x" and cache.get("a:3") == "z"
+
+    cache.set("a:big", "x" * 100)  # maior que max_bytes: nem entra
+    assert cache.get("a:big") is None
+    assert cache.get_stats()["size_bytes"] <= 50
+
+
+def test_ttl_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("utils.time.monotonic", lambda: now[0])
+    cache = PerformanceCache(ttl_seconds=10)
+    cache.set("tags:all", [1])
+    cache.set("tags:short", [2], ttl=1)
+
+    now[0] += 5
+    assert cache.get("tags:all") == [1]
+    assert cache.get("tags:short") is None
+
+    now[0] += 10
+    cache.clear_expired()
+    assert cache.get_stats()["entries"] == 0
+
+
+def test_database_changes_invalidate_cached_reads(crm, client):
+    crm.cache.clear()
+    before = client.get("/api/tags").json
+
+    created = client.post("/api/tags", json={"name": "Cache teste", "color": "#123456"})
+    assert created.status_code in (200, 201)
+
+    after = client.get("/api/tags").json
+    assert len(after) == len(before) + 1
@@ -0,0 +1,172 @@
+"""Campanhas: token bucket, limite de mensagens na outbox e devolução de fichas"""
+import pytest
+
+from campaigns import CampaignEngine, render_template
+from utils import TokenBucket
+
+
+class FakeWhatsApp:
+    phone = "5551900000000"
+    open = False
+
+    def circuit_open(self):
+        return self.open
+
+
+class FakeOutbox:
+    def __init__(self):
+        self.notified = 0
+
+    def notify(self):
+        self.notified += 1
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data, to=None):
+        self.emitted.append((event, data))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Relógio do token bucket parado (avança só quando o teste manda)"""
+    now = [1000.0]
+    monkeypatch.setattr("utils.time.monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def engine(database, clock):
+    return CampaignEngine(database, FakeWhatsApp(), FakeOutbox(), FakeSocketIO(),
+                          rate_per_minute=60, burst=3, max_in_flight=10)
+
+
+def _leads(database, count, status="novo", first=0):
+    for n in range(first, first + count):
+        lead = database.create_or_get_lead(f"55519{n:08d}", f"Cliente {n}")
+        database.update_lead_status(lead["id"], status)
+
+
+def _queued(database):
+    return database.count_outbox("queued")
+
+
+# =============================
+# TOKEN BUCKET
+# =============================
+def test_bucket_allows_a_burst_then_refills_at_the_rate(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    assert bucket.wait_time() == pytest.approx(0.5)
+
+    clock[0] += 0.5
+    assert bucket.try_acquire() is True
+    assert bucket.try_acquire() is False
+
+
+def test_bucket_never_holds_more_than_capacity(clock):
+    bucket = TokenBucket(rate=1, capacity=2)
+
+    clock[0] += 3600
+    assert [bucket.try_acquire() for _ in range(3)] == [True, True, False]
+
+    bucket.refund(5)
+    assert bucket._tokens == 2
+
+
+# =============================
+# ALIMENTAÇÃO DA OUTBOX
+# =============================
+def test_tick_queues_only_the_burst(engine, database):
+    _leads(database, 5)
+    campaign_id, total = engine.create("Promo", "Olá {{primeiro_nome}}!", {"status": "novo"})
+
+    engine._tick()
+
+    assert total == 5
+    assert _queued(database) == 3
+    assert database.get_campaign_progress(campaign_id)["pending"] == 2
+    assert engine.outbox.notified == 1
+
+
+def test_tick_respects_max_in_flight(engine, database):
+    engine.max_in_flight = 2
+    _leads(database, 5)
+    engine.create("Promo", "Olá!", {"status": "novo"})
+
+    engine._tick()
+    engine._tick()
+
+    # A outbox não andou: os dois slots continuam ocupados
+    assert _queued(database) == 2
+    assert engine._bucket()._tokens == 1
+
+
+def test_campaign_without_pending_refunds_the_token(engine, database):
+    _leads(database, 1)
+    engine.create("Uma", "Olá!", {"status": "novo"})
+    _leads(database, 3, status="qualificado", first=100)
+    engine.create("Outra", "Oi!", {"status": "qualificado"})
+
+    engine._tick()
+
+    # 3 fichas: duas viram mensagens, a da campanha que esvaziou volta ao bucket
+    assert _queued(database) == 3
+    assert engine._bucket()._tokens == 0
+
+
+def test_open_circuit_queues_nothing(engine, database):
+    _leads(database, 3)
+    engine.whatsapp.open = True
+    engine.create("Promo", "Olá!", {"status": "novo"})
+
+    assert engine._tick() == engine.poll_interval
+    assert _queued(database) == 0
+    assert engine._bucket()._tokens == 3
+
+
+def test_paused_campaign_is_not_fed(engine, database):
+    _leads(database, 3)
+    campaign_id, _ = engine.create("Promo", "Olá!", {"status": "novo"})
+
+    assert engine.pause(campaign_id) is True
+    engine._tick()
+
+    assert _queued(database) == 0
+    assert engine.socketio.emitted[-1][1]["status"] == "paused"
+
+
+def test_campaign_completes_when_the_outbox_delivers(engine, database):
+    _leads(database, 1)
+    campaign_id, _ = engine.create("Promo", "Olá!", {"status": "novo"})
+    engine._tick()
+    item = database.claim_outbox(2000.0, "worker", 60)
+
+    assert database.mark_outbox_sent(item["id"], "worker") is True
+    engine._tick()
+
+    campaign = database.get_campaign(campaign_id)
+    assert campaign["status"] == "completed"
+    assert campaign["progress"]["sent"] == 1
+    assert engine.stats["completed"] == 1
+
+
+# =============================
+# TEMPLATE
+# =============================
+def test_render_template_fills_lead_variables():
+    lead = {"name": "Maria da Silva", "phone": "5551999", "city": "Porto Alegre", "vendedor": "João"}
+
+    text = render_template("Oi {{ primeiro_nome }}, {{vendedor}} de {{cidade}}. {{outra}}", lead)
+
+    assert text == "Oi Maria, João de Porto Alegre. {{outra}}"
+
+
+def test_unknown_template_variable_is_rejected(engine, database):
+    with pytest.raises(ValueError, match="desconto"):
+        engine.create("Promo", "Olá {{nome}}, {{desconto}}!", {})
+
+    assert database.get_campaigns() == []
@@ -0,0 +1,9 @@
+"""Configuração por ambiente"""
+import config
+
+
+def test_log_level_from_env_wins_in_every_environment():
+    # conftest.py exporta LOG_LEVEL=WARNING antes do import
+    assert config.DevelopmentConfig.LOG_LEVEL == "WARNING"
+    assert config.ProductionConfig.LOG_LEVEL == "WARNING"
+    assert config.config.LOG_LEVEL == "WARNING"
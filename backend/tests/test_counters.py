@@ -0,0 +1,92 @@
+"""Contadores mantidos por trigger: conversa do lead e leads por status/vendedor"""
+import pytest
+
+
+def _status_counts(database):
+    rows = database.get_connection().execute("""
+        SELECT status, assigned_to, count FROM lead_status_counts WHERE count != 0
+    """)
+    return {(r["status"], r["assigned_to"]): r["count"] for r in rows}
+
+
+def _recount(database):
+    rows = database.get_connection().execute("""
+        SELECT COALESCE(status, 'novo') AS status, COALESCE(assigned_to, 0) AS assigned_to, COUNT(*) AS count
+        FROM leads GROUP BY 1, 2
+    """)
+    return {(r["status"], r["assigned_to"]): r["count"] for r in rows}
+
+
+@pytest.fixture
+def lead_id(database):
+    return database.create_or_get_lead("5551966665555", "Cliente")["id"]
+
+
+# =============================
+# CONVERSA DO LEAD
+# =============================
+def test_message_insert_updates_counters(database, lead_id):
+    conn = database.get_connection()
+    conn.execute("INSERT INTO messages (lead_id, sender_type, content, timestamp) VALUES (?, 'lead', 'oi', '2024-05-01 10:00:00')", (lead_id,))
+    conn.execute("INSERT INTO messages (lead_id, sender_type, content, timestamp) VALUES (?, 'vendedor', ?, '2024-05-01 10:05:00')", (lead_id, "x" * 200))
+
+    lead = database.get_lead(lead_id)
+
+    assert lead["message_count"] == 2
+    assert lead["last_message_at"] == "2024-05-01 10:05:00"
+    assert lead["last_inbound_at"] == "2024-05-01 10:00:00"
+    assert lead["last_message_preview"] == "x" * 120
+
+
+def test_message_delete_recomputes_from_remaining(database, lead_id):
+    conn = database.get_connection()
+    conn.execute("INSERT INTO messages (lead_id, sender_type, content, timestamp) VALUES (?, 'lead', 'primeira', '2024-05-01 10:00:00')", (lead_id,))
+    last = conn.execute("INSERT INTO messages (lead_id, sender_type, content, timestamp) VALUES (?, 'lead', 'segunda', '2024-05-01 11:00:00')", (lead_id,)).lastrowid
+
+    conn.execute("DELETE FROM messages WHERE id = ?", (last,))
+    lead = database.get_lead(lead_id)
+
+    assert lead["message_count"] == 1
+    assert lead["last_message_at"] == lead["last_inbound_at"] == "2024-05-01 10:00:00"
+    assert lead["last_message_preview"] == "primeira"
+
+
+def test_batch_ingestion_keeps_counters(database):
+    events = [{"phone": "5551966664444", "name": "Lote", "content": f"m{i}", "provider_id": None} for i in range(4)]
+
+    (written, _) = database.ingest_messages(events)
+    lead = database.get_lead(written[0][1])
+
+    assert lead["message_count"] == 4
+    assert lead["last_message_preview"] == "m3"
+
+
+# =============================
+# LEADS POR STATUS E VENDEDOR
+# =============================
+def test_status_counts_follow_inserts_updates_and_deletes(database):
+    seller = database.create_user("vend_contador", "senha123", "Vendedor", "vendedor")
+    ids = [database.create_or_get_lead(f"55519555{i:05d}", f"L{i}")["id"] for i in range(5)]
+
+    database.assign_lead(ids[0], seller)
+    database.assign_lead(ids[1], seller)
+    database.update_lead_status(ids[1], "ganho")
+    database.update_lead_status(ids[2], "perdido")
+    database.transfer_lead(ids[0], None)
+    database.get_connection().execute("DELETE FROM leads WHERE id = ?", (ids[3],))
+
+    assert _status_counts(database) == _recount(database) == {
+        ("novo", 0): 1,
+        ("em_atendimento", 0): 1,
+        ("ganho", seller): 1,
+        ("perdido", 0): 1,
+    }
+
+
+def test_unchanged_status_does_not_move_counts(database, lead_id):
+    before = _status_counts(database)
+
+    database.update_lead_status(lead_id, "novo")
+    database.get_connection().execute("UPDATE leads SET name = 'Outro' WHERE id = ?", (lead_id,))
+
+    assert _status_counts(database) == before == {("novo", 0): 1}
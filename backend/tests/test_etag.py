@@ -0,0 +1,59 @@
+"""GET condicional: 304 enquanto os dados não mudam, 200 depois de qualquer escrita"""
+import sqlite3
+
+
+def _etag(response):
+    assert response.status_code == 200
+    return response.headers["ETag"]
+
+
+def test_unchanged_data_answers_304(client):
+    etag = _etag(client.get("/api/leads"))
+
+    response = client.get("/api/leads", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+
+def test_write_through_api_invalidates_etag(client, webhook, phone):
+    etag = _etag(client.get("/api/leads"))
+
+    webhook.post("/api/webhook/message", json={"from": f"{phone}@c.us", "body": "oi"})
+    response = client.get("/api/leads", headers={"If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert phone in {lead["phone"] for lead in response.json}
+
+
+def test_write_from_another_process_invalidates_etag(crm, client, phone):
+    etag = _etag(client.get("/api/leads"))
+
+    # Outro processo / sqlite3 direto no arquivo: nada passa pelo notify_change
+    other = sqlite3.connect(crm.config.DATABASE_NAME)
+    with other:
+        other.execute("INSERT INTO leads (name, phone, status) VALUES ('Externo', ?, 'novo')", (phone,))
+    other.close()
+
+    assert client.get("/api/leads", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_known_lead_upsert_keeps_etag(crm, client, phone):
+    crm.db.create_or_get_lead(phone, "Cliente")
+    etag = _etag(client.get("/api/leads"))
+
+    crm.db.create_or_get_lead(phone, "Cliente")
+
+    assert client.get("/api/leads", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_etag_does_not_depend_on_the_process(crm, client):
+    """Mesma versão do banco => mesma ETag em qualquer worker"""
+    first = _etag(client.get("/api/leads"))
+    version = crm.db.get_data_version()
+
+    second = _etag(client.get("/api/leads"))
+
+    assert crm.db.get_data_version() == version
+    assert first == second
@@ -0,0 +1,61 @@
+"""Funil de métricas por status, lido dos contadores mantidos por trigger"""
+from database import LEAD_STATUSES
+
+
+def _leads(database, count, prefix):
+    return [database.create_or_get_lead(f"{prefix}{i:04d}", f"L{i}")["id"] for i in range(count)]
+
+
+def test_summary_of_an_empty_database_lists_every_status(database):
+    summary = database.get_metrics_summary()
+
+    assert summary == {
+        "total_leads": 0,
+        "leads_ganhos": 0,
+        "leads_perdidos": 0,
+        "funil": dict.fromkeys(LEAD_STATUSES, 0),
+    }
+
+
+def test_funnel_totals_and_per_seller_view(database):
+    ana = database.create_user("ana_funil", "senha123", "Ana", "vendedor")
+    bia = database.create_user("bia_funil", "senha123", "Bia", "vendedor")
+    ids = _leads(database, 6, "555193330")
+    for lead_id in ids[:3]:
+        database.assign_lead(lead_id, ana)
+    database.assign_lead(ids[3], bia)
+    database.update_lead_status(ids[0], "ganho")
+    database.update_lead_status(ids[1], "perdido")
+    database.update_lead_status(ids[3], "ganho")
+
+    everyone = database.get_metrics_summary()
+    only_ana = database.get_metrics_summary(vendedor_id=ana)
+
+    assert everyone["total_leads"] == 6
+    assert (everyone["leads_ganhos"], everyone["leads_perdidos"]) == (2, 1)
+    assert everyone["funil"]["novo"] == 2
+    assert everyone["funil"]["em_atendimento"] == 1
+    assert only_ana["total_leads"] == 3
+    assert (only_ana["leads_ganhos"], only_ana["leads_perdidos"]) == (1, 1)
+    assert database.get_metrics_summary(vendedor_id=999)["total_leads"] == 0
+
+
+def test_summary_matches_a_full_recount(database):
+    ids = _leads(database, 20, "555193331")
+    for n, lead_id in enumerate(ids):
+        database.update_lead_status(lead_id, LEAD_STATUSES[n % len(LEAD_STATUSES)])
+
+    recount = dict(database.get_connection().execute("SELECT status, COUNT(*) FROM leads GROUP BY status").fetchall())
+
+    assert {k: v for k, v in database.get_metrics_summary()["funil"].items() if v} == recount
+
+
+def test_metrics_endpoint_reflects_status_changes(crm, client, phone):
+    before = client.get("/api/metrics").json
+    lead_id = crm.db.create_or_get_lead(phone, "Funil")["id"]
+    crm.db.update_lead_status(lead_id, "ganho")
+
+    after = client.get("/api/metrics").json
+
+    assert after["total_leads"] == before["total_leads"] + 1
+    assert after["leads_ganhos"] == before["leads_ganhos"] + 1
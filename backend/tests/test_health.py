@@ -0,0 +1,109 @@
+"""HealthMonitor: estado publicado em memória, eventos só quando a conectividade muda"""
+import time
+
+import pytest
+
+from health import HealthMonitor
+
+
+class FakeBridge:
+    def __init__(self):
+        self.connected = True
+        self.calls = 0
+
+    def check_connection(self):
+        self.calls += 1
+        return {"connected": self.connected, "phone": "5551900000000" if self.connected else None}
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data, to=None):
+        self.emitted.append((event, data, to))
+
+
+@pytest.fixture
+def monitor(database):
+    return HealthMonitor(database, FakeBridge(), FakeSocketIO(), interval=3600)
+
+
+def test_starts_unknown_until_the_first_check(monitor):
+    assert monitor.snapshot()["status"] == "starting"
+    assert monitor.whatsapp_connected() is None
+    assert monitor.whatsapp.calls == 0
+
+
+def test_healthy_then_degraded_then_healthy(monitor):
+    assert monitor.check() == "healthy"
+    assert monitor.whatsapp_connected() is True
+    assert monitor.snapshot()["database"]["latency_ms"] is not None
+
+    monitor.whatsapp.connected = False
+    assert monitor.check() == "degraded"
+    assert monitor.whatsapp_connected() is False
+
+    monitor.whatsapp.connected = True
+    assert monitor.check() == "healthy"
+    assert [data["status"] for _, data, _ in monitor.socketio.emitted] == ["healthy", "degraded", "healthy"]
+    assert {to for _, _, to in monitor.socketio.emitted} == {"authenticated"}
+
+
+def test_same_state_is_not_emitted_again(monitor):
+    monitor.check()
+    monitor.check()
+    monitor.check()
+
+    assert len(monitor.socketio.emitted) == 1
+
+
+def test_database_failure_is_unhealthy(monitor, monkeypatch):
+    def broken():
+        raise RuntimeError("disk I/O error")
+
+    monkeypatch.setattr(monitor.db, "get_connection", broken)
+
+    assert monitor.check() == "unhealthy"
+    assert monitor.snapshot()["database"] == {"ok": False, "latency_ms": None, "error": "disk I/O error"}
+
+
+def test_snapshot_is_a_copy(monitor):
+    monitor.check()
+    snapshot = monitor.snapshot()
+    snapshot["whatsapp"]["connected"] = False
+
+    assert monitor.snapshot()["whatsapp"]["connected"] is True
+
+
+def test_background_thread_checks_on_start_and_on_refresh(monitor):
+    monitor.start()
+    try:
+        deadline = time.monotonic() + 2
+        while monitor.whatsapp.calls < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        monitor.refresh()
+        while monitor.whatsapp.calls < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        monitor.stop()
+
+    assert monitor.whatsapp.calls == 2
+    assert monitor.snapshot()["status"] == "healthy"
+
+
+def test_health_routes_answer_from_the_snapshot(crm, client, monkeypatch):
+    monkeypatch.setattr(crm.whatsapp.session, "request", lambda *a, **k: pytest.fail("chamou o bridge"))
+    state = {
+        "status": "unhealthy",
+        "checked_at": "2026-01-01T00:00:00",
+        "database": {"ok": False, "latency_ms": None, "error": "x"},
+        "whatsapp": {"connected": False, "phone": None},
+    }
+    monkeypatch.setattr(crm.health_monitor, "snapshot", lambda: state)
+
+    response = client.get("/health")
+
+    assert response.status_code == 503
+    assert response.json["services"] == {"database": "error", "whatsapp": "disconnected"}
+    assert client.get("/api/whatsapp/status").status_code == 200
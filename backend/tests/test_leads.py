@@ -0,0 +1,56 @@
+"""Upsert atômico de lead pelo telefone normalizado"""
+import sqlite3
+
+from database import Database
+from migrations import MIGRATIONS
+
+
+def test_known_phone_is_resolved_by_primary_key(database, monkeypatch):
+    lead = database.create_or_get_lead("+55 51 99999-0001", "Ana")
+    statements = []
+    conn = database.get_connection()
+    original = conn.execute
+    monkeypatch.setattr(conn, "execute", lambda sql, *args: statements.append(sql) or original(sql, *args))
+
+    again = database.create_or_get_lead("5551999990001@c.us", "Outro nome")
+
+    assert again["id"] == lead["id"]
+    assert again["name"] == "Ana"
+    assert [sql.split()[0] for sql in statements] == ["SELECT"]
+
+
+def test_existing_lead_outside_the_lru_is_not_rewritten(database):
+    lead_id = database.create_or_get_lead("5551999990002", "Ana")["id"]
+    stored = database.get_lead(lead_id)
+    database._lead_ids_by_phone.delete("5551999990002")
+    notified = []
+    database.on_change(notified.append)
+
+    again = database.create_or_get_lead("5551999990002", "Outro nome")
+
+    assert again == stored == database.get_lead(lead_id)
+    assert notified == []
+
+
+def test_migration_normalizes_legacy_phones_before_unique_index(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    for version, _, migrate in MIGRATIONS[:3]:
+        migrate(conn)
+    conn.executemany("INSERT INTO leads (name, phone) VALUES (?, ?)", [
+        ("Antigo", "+55 51 99999-0003"),
+        ("Baileys", "5551999990003@s.whatsapp.net"),
+        ("Novo", "5551999990003"),
+        ("Outro", "5551999990004"),
+    ])
+    conn.execute("INSERT INTO messages (lead_id, sender_type, content) VALUES (2, 'lead', 'oi')")
+    conn.execute("PRAGMA user_version = 3")
+    conn.commit()
+    conn.close()
+
+    database = Database(path)
+    leads = database.get_connection().execute("SELECT id, name, phone FROM leads ORDER BY id").fetchall()
+
+    assert [tuple(row) for row in leads] == [(1, "Antigo", "5551999990003"), (4, "Outro", "5551999990004")]
+    assert database.get_messages_by_lead(1)[0]["content"] == "oi"
+    assert database.create_or_get_lead("+55 51 99999-0003")["id"] == 1
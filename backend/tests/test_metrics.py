@@ -0,0 +1,112 @@
+"""/metrics: formato de exposição do Prometheus e acesso restrito"""
+from metrics import CONTENT_TYPE, Registry
+
+
+# =============================
+# FORMATO
+# =============================
+def test_counter_renders_help_type_and_labels():
+    registry = Registry()
+    emits = registry.counter("crm_emits_total", "Eventos emitidos", labels=("event",))
+
+    emits.inc(event="new_message")
+    emits.inc(2, event="new_message")
+    emits.inc(event='lead "x"\n')
+
+    assert registry.render().splitlines() == [
+        "# HELP crm_emits_total Eventos emitidos",
+        "# TYPE crm_emits_total counter",
+        'crm_emits_total{event="new_message"} 3',
+        'crm_emits_total{event="lead \\"x\\"\\n"} 1',
+    ]
+
+
+def test_histogram_buckets_are_cumulative_and_inclusive():
+    registry = Registry()
+    latency = registry.histogram("crm_latency_seconds", "Latência", labels=("route",), buckets=(0.1, 0.5))
+
+    for value in (0.05, 0.5, 2.0):
+        latency.observe(value, route="/api/leads")
+
+    lines = registry.render().splitlines()
+    assert lines[1] == "# TYPE crm_latency_seconds histogram"
+    assert lines[2:] == [
+        'crm_latency_seconds_bucket{route="/api/leads",le="0.1"} 1',
+        'crm_latency_seconds_bucket{route="/api/leads",le="0.5"} 2',
+        'crm_latency_seconds_bucket{route="/api/leads",le="+Inf"} 3',
+        'crm_latency_seconds_sum{route="/api/leads"} 2.55',
+        'crm_latency_seconds_count{route="/api/leads"} 3',
+    ]
+
+
+def test_callback_metrics_are_read_at_collection_time():
+    registry = Registry()
+    depth = [4]
+    registry.gauge_callback("crm_queue_depth", "Fila", lambda: depth[0])
+    registry.counter_callback(
+        "crm_results_total", "Resultados",
+        lambda: [({"result": "sent"}, 7), ({"result": "failed"}, None)], labels=("result",),
+    )
+
+    assert "crm_queue_depth 4" in registry.render()
+    depth[0] = 0
+    text = registry.render()
+    assert "crm_queue_depth 0" in text
+    assert "# TYPE crm_results_total counter" in text
+    # Amostra sem valor é omitida
+    assert 'crm_results_total{result="sent"} 7' in text
+    assert "failed" not in text
+
+
+def test_broken_callback_does_not_hide_other_metrics():
+    registry = Registry()
+    registry.gauge_callback("crm_broken", "Quebrada", lambda: 1 / 0)
+    registry.gauge_callback("crm_ok", "Ok", lambda: 1)
+
+    text = registry.render()
+
+    assert "crm_broken" not in text
+    assert "crm_ok 1" in text
+
+
+def test_reregistering_reuses_the_existing_metric():
+    registry = Registry()
+    first = registry.counter("crm_total", "Total")
+    first.inc()
+
+    assert registry.counter("crm_total", "Total") is first
+
+
+# =============================
+# ROTA
+# =============================
+def test_metrics_route_serves_prometheus_text_to_localhost(crm, webhook):
+    webhook.get("/health")
+
+    response = webhook.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == CONTENT_TYPE
+    text = response.get_data(as_text=True)
+    assert "# TYPE crm_http_request_duration_seconds histogram" in text
+    assert 'route="/health"' in text
+    assert "crm_outbox_messages" in text
+
+
+def test_metrics_route_refuses_remote_addresses(webhook):
+    response = webhook.get("/metrics", environ_base={"REMOTE_ADDR": "10.0.0.5"})
+
+    assert response.status_code == 403
+
+
+def test_metrics_token_is_required_when_configured(crm, webhook, monkeypatch):
+    monkeypatch.setattr(crm.config, "METRICS_TOKEN", "segredo")
+    remote = {"REMOTE_ADDR": "10.0.0.5"}
+
+    # Com token, nem localhost passa sem ele
+    assert webhook.get("/metrics").status_code == 403
+    assert webhook.get("/metrics", environ_base=remote,
+                       headers={"Authorization": "Bearer errado"}).status_code == 403
+    response = webhook.get("/metrics", environ_base=remote,
+                           headers={"Authorization": "Bearer segredo"})
+    assert response.status_code == 200
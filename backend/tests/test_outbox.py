@@ -0,0 +1,200 @@
+"""Outbox: retry com backoff, reagendamento com circuito aberto e lease entre processos"""
+import time
+
+import pytest
+
+from outbox import OutboxDispatcher
+from whatsapp_service import WhatsAppService
+
+
+class FakeBreaker:
+    def retry_after(self):
+        return 30.0
+
+
+class FakeWhatsApp:
+    """Bridge falso: resultado de deliver configurável, sem rede"""
+
+    def __init__(self, database):
+        self.db = database
+        self.breaker = FakeBreaker()
+        self.open = False
+        self.result = (True, None)
+        self.delivered = []
+
+    def circuit_open(self):
+        return self.open
+
+    def deliver(self, phone, content):
+        self.delivered.append((phone, content))
+        return self.result
+
+    def record_sent(self, lead, content, vendedor_id=None, outbox_id=None, owner=None):
+        return self.db.mark_outbox_sent(outbox_id, owner)
+
+
+class FakeHealth:
+    interval = 15
+    connected = None
+
+    def whatsapp_connected(self):
+        return self.connected
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data, to=None):
+        self.emitted.append((event, data))
+
+
+@pytest.fixture
+def setup(database):
+    whatsapp = FakeWhatsApp(database)
+    socketio = FakeSocketIO()
+    dispatcher = OutboxDispatcher(database, whatsapp, socketio, max_attempts=3,
+                                  retry_base_seconds=2, retry_max_seconds=60)
+    lead = database.create_or_get_lead("5551988887777", "Cliente")
+    outbox_id = dispatcher.enqueue(lead, "Olá!")
+    return dispatcher, whatsapp, socketio, outbox_id
+
+
+def _claim_and_deliver(dispatcher, now=None):
+    item = dispatcher.db.claim_outbox(now or time.time(), dispatcher.owner, dispatcher.lease_seconds)
+    assert item is not None
+    dispatcher._deliver(item)
+    return dispatcher.db.get_outbox_item(item["id"])
+
+
+def test_successful_delivery_marks_sent(setup):
+    dispatcher, whatsapp, _, outbox_id = setup
+
+    row = _claim_and_deliver(dispatcher)
+
+    assert row["id"] == outbox_id
+    assert row["status"] == "sent"
+    assert whatsapp.delivered == [("5551988887777", "Olá!")]
+
+
+def test_failure_is_retried_with_backoff(setup):
+    dispatcher, whatsapp, _, _ = setup
+    whatsapp.result = (False, "timeout")
+    before = time.time()
+
+    row = _claim_and_deliver(dispatcher)
+
+    assert row["status"] == "queued"
+    assert row["attempts"] == 1
+    assert row["last_error"] == "timeout"
+    # Primeira tentativa: entre metade e o teto de retry_base
+    assert before + 1 <= row["next_attempt_at"] <= time.time() + 2
+    assert row["claimed_by"] is None
+    # Ainda não venceu o backoff: nada para reservar
+    assert dispatcher.db.claim_outbox(before, dispatcher.owner, 60) is None
+
+
+def test_gives_up_after_max_attempts(setup):
+    dispatcher, whatsapp, socketio, outbox_id = setup
+    whatsapp.result = (False, "HTTP 500")
+
+    for attempt in range(3):
+        row = _claim_and_deliver(dispatcher, now=time.time() + 3600 * (attempt + 1))
+
+    assert row["status"] == "failed"
+    assert row["attempts"] == 3
+    assert socketio.emitted[-1][0] == "message_status"
+    assert socketio.emitted[-1][1]["status"] == "failed"
+    assert socketio.emitted[-1][1]["outbox_id"] == outbox_id
+
+
+def test_open_circuit_reschedules_without_spending_attempt(setup):
+    dispatcher, whatsapp, _, _ = setup
+    whatsapp.open = True
+    before = time.time()
+
+    row = _claim_and_deliver(dispatcher)
+
+    assert row["status"] == "queued"
+    assert row["attempts"] == 0
+    assert row["next_attempt_at"] >= before + 30
+    assert whatsapp.delivered == []
+
+
+def test_disconnected_bridge_waits_for_the_health_monitor(setup):
+    dispatcher, whatsapp, _, _ = setup
+    dispatcher.health = FakeHealth()
+    dispatcher.health.connected = False
+    before = time.time()
+
+    row = _claim_and_deliver(dispatcher)
+
+    assert row["status"] == "queued"
+    assert row["attempts"] == 0
+    assert row["last_error"] == "WhatsApp não conectado"
+    assert row["next_attempt_at"] >= before + FakeHealth.interval
+    assert whatsapp.delivered == []
+
+
+def test_unknown_health_state_still_delivers(setup):
+    dispatcher, whatsapp, _, _ = setup
+    dispatcher.health = FakeHealth()
+
+    assert _claim_and_deliver(dispatcher)["status"] == "sent"
+
+
+def test_live_lease_is_not_stolen_by_another_dispatcher(setup):
+    dispatcher, _, _, outbox_id = setup
+    now = time.time()
+    item = dispatcher.db.claim_outbox(now, "worker-a", 60)
+
+    assert dispatcher.db.claim_outbox(now + 30, "worker-b", 60) is None
+    # Quem não é dono não devolve a mensagem para a fila
+    dispatcher.db.mark_outbox_retry(item["id"], "worker-b", now, "x")
+    assert dispatcher.db.get_outbox_item(outbox_id)["status"] == "sending"
+
+
+def test_expired_lease_is_taken_over(setup):
+    dispatcher, _, _, outbox_id = setup
+    now = time.time()
+    dispatcher.db.claim_outbox(now, "worker-a", 60)
+
+    item = dispatcher.db.claim_outbox(now + 61, "worker-b", 60)
+
+    assert item["id"] == outbox_id
+    assert item["claimed_by"] == "worker-b"
+    assert item["attempts"] == 2
+    # O dono antigo, atrasado, não sobrescreve a nova reserva
+    dispatcher.db.mark_outbox_failed(outbox_id, "worker-a", "tarde demais")
+    assert dispatcher.db.mark_outbox_sent(outbox_id, "worker-a") is False
+    assert dispatcher.db.get_outbox_item(outbox_id)["status"] == "sending"
+    assert dispatcher.db.mark_outbox_sent(outbox_id, "worker-b") is True
+
+
+def test_send_with_lost_lease_is_not_recorded(setup):
+    dispatcher, _, socketio, outbox_id = setup
+    whatsapp = WhatsAppService(dispatcher.db, socketio, base_url="http://127.0.0.1:9")
+    lead_id = dispatcher.db.get_outbox_item(outbox_id)["lead_id"]
+    lead = dispatcher.db.get_lead(lead_id)
+    now = time.time()
+    dispatcher.db.claim_outbox(now, "worker-a", 60)
+    dispatcher.db.claim_outbox(now + 61, "worker-b", 60)
+
+    assert whatsapp.record_sent(lead, "Olá!", outbox_id=outbox_id, owner="worker-a") is False
+    assert dispatcher.db.get_messages_by_lead(lead_id) == []
+
+    assert whatsapp.record_sent(lead, "Olá!", outbox_id=outbox_id, owner="worker-b") is True
+    assert [m["content"] for m in dispatcher.db.get_messages_by_lead(lead_id)] == ["Olá!"]
+    assert dispatcher.db.get_outbox_item(outbox_id)["status"] == "sent"
+
+
+def test_messages_of_a_lead_keep_their_order(setup):
+    dispatcher, whatsapp, _, first_id = setup
+    lead = dispatcher.db.get_lead(dispatcher.db.get_outbox_item(first_id)["lead_id"])
+    dispatcher.enqueue(lead, "Segunda")
+    whatsapp.result = (False, "timeout")
+
+    _claim_and_deliver(dispatcher)
+
+    # A primeira voltou para a fila com backoff: a segunda espera por ela
+    assert dispatcher.db.claim_outbox(time.time(), dispatcher.owner, 60) is None
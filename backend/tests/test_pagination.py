@@ -0,0 +1,86 @@
+"""Paginação por cursor (keyset) de leads e mensagens"""
+import pytest
+
+from utils import CURSOR_ID, CURSOR_TIME_ID, decode_cursor, encode_cursor
+
+
+def _walk(client, url, limit):
+    items, cursor = [], None
+    for _ in range(100):
+        page_url = f"{url}?limit={limit}" + (f"&cursor={cursor}" if cursor else "")
+        page = client.get(page_url).json
+        items.extend(page["items"])
+        assert len(page["items"]) <= limit
+        if not page["has_more"]:
+            assert page["next_cursor"] is None
+            return items
+        cursor = page["next_cursor"]
+    pytest.fail("paginação não terminou")
+
+
+def test_leads_pages_cover_every_lead_once(crm, client):
+    for i in range(7):
+        crm.db.create_or_get_lead(f"5599{i:08d}", f"Paginado {i}")
+    total = crm.db.get_connection().execute("SELECT COUNT(*) FROM leads").fetchone()[0]
+
+    items = _walk(client, "/api/leads", limit=3)
+
+    ids = [lead["id"] for lead in items]
+    assert len(ids) == len(set(ids)) == total
+    keys = [(lead["updated_at"], lead["id"]) for lead in items]
+    assert keys == sorted(keys, reverse=True)
+
+
+def test_messages_before_id_goes_back_in_history(crm, client, phone):
+    lead = crm.db.create_or_get_lead(phone, "Histórico")
+    crm.db.ingest_messages([
+        {"phone": phone, "name": "Histórico", "content": f"m{i}", "provider_id": None} for i in range(5)
+    ])
+
+    newest = client.get(f"/api/leads/{lead['id']}/messages?limit=2").json
+    older = client.get(f"/api/leads/{lead['id']}/messages?limit=2&before_id={newest['items'][0]['id']}").json
+
+    assert [m["content"] for m in newest["items"]] == ["m3", "m4"]
+    assert [m["content"] for m in older["items"]] == ["m1", "m2"]
+
+
+def test_invalid_cursor_is_rejected(client):
+    assert client.get("/api/leads?cursor=lixo").status_code == 400
+
+
+def test_cursor_round_trip_and_endpoint_check():
+    cursor = encode_cursor({"after": ["2024-01-01 00:00:00", 10]})
+
+    assert decode_cursor(cursor, CURSOR_TIME_ID) == {"after": ["2024-01-01 00:00:00", 10]}
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, CURSOR_ID)
+
+
+@pytest.mark.parametrize("position, fields", [
+    ({"after": ["2024-01-01 00:00:00"]}, CURSOR_TIME_ID),
+    ({"after": ["2024-01-01 00:00:00", 10, 3]}, CURSOR_TIME_ID),
+    ({"after": ["2024-01-01 00:00:00", "10"]}, CURSOR_TIME_ID),
+    ({"after": [5, 10]}, CURSOR_TIME_ID),
+    ({"after": "2024-01-01"}, CURSOR_TIME_ID),
+    ({"before_id": "10"}, CURSOR_ID),
+    ({"before_id": True}, CURSOR_ID),
+    ({"after_id": [10]}, CURSOR_ID),
+])
+def test_cursor_values_are_type_checked(position, fields):
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor(position), fields)
+
+
+def test_null_timestamp_is_a_valid_cursor():
+    assert decode_cursor(encode_cursor({"after": [None, 3]}), CURSOR_TIME_ID) == {"after": [None, 3]}
+
+
+@pytest.mark.parametrize("url, position", [
+    ("/api/leads", {"after": ["2024-01-01 00:00:00", {"x": 1}]}),
+    ("/api/leads", {"after": [1]}),
+    ("/api/audit-log", {"after": [[], 1]}),
+])
+def test_malformed_cursor_values_answer_400(client, url, position):
+    response = client.get(f"{url}?cursor={encode_cursor(position)}")
+
+    assert response.status_code == 400
@@ -0,0 +1,91 @@
+"""Rate limiter sliding-window: limite por janela e peso da janela anterior"""
+import pytest
+
+from middlewares import MemoryRateLimitStore, RateLimiter, SQLiteRateLimitStore
+
+WINDOW = 60
+START = 1_700_000_040.0  # início exato de uma janela de 60s
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryRateLimitStore()
+    return SQLiteRateLimitStore(str(tmp_path / "rate_limits.db"))
+
+
+def _hits(store, key, count, now, limit=5):
+    return [store.hit(key, limit, WINDOW, now) for _ in range(count)]
+
+
+def test_limit_within_a_window(store):
+    assert _hits(store, "ip", 5, START) == [True] * 5
+    assert store.hit("ip", 5, WINDOW, START + 30) is False
+
+
+def test_keys_are_independent(store):
+    _hits(store, "a", 5, START)
+
+    assert store.hit("b", 5, WINDOW, START) is True
+
+
+def test_previous_window_still_counts_at_the_boundary(store):
+    _hits(store, "ip", 5, START)
+
+    # Início da janela seguinte: a anterior ainda pesa 100%
+    assert store.hit("ip", 5, WINDOW, START + WINDOW) is False
+
+
+def test_previous_window_weight_decays(store):
+    _hits(store, "ip", 4, START)
+
+    # 75% da janela nova passou: anterior pesa 4 * 0.25 = 1
+    now = START + WINDOW + 45
+    assert _hits(store, "ip", 5, now) == [True, True, True, True, False]
+
+
+def test_two_idle_windows_reset_the_counter(store):
+    _hits(store, "ip", 5, START)
+
+    assert _hits(store, "ip", 5, START + 2 * WINDOW) == [True] * 5
+
+
+def test_rejected_requests_are_not_counted(store):
+    _hits(store, "ip", 8, START)
+
+    # Só 5 contaram: com 50% da janela seguinte a anterior pesa 2.5 => cabem 3
+    now = START + WINDOW + 30
+    assert _hits(store, "ip", 4, now) == [True, True, True, False]
+
+
+def test_rate_limiter_uses_limit_type_windows(monkeypatch):
+    limiter = RateLimiter(per_minute=2, per_hour=3)
+    monkeypatch.setattr("middlewares.time.time", lambda: START)
+
+    assert [limiter.is_rate_limited("u1", "per_minute") for _ in range(3)] == [False, False, True]
+    assert limiter.is_rate_limited("u1", "per_hour") is False
+
+    limiter.reset("u1")
+    assert limiter.is_rate_limited("u1", "per_minute") is False
+
+
+def test_disabled_limiter_never_limits():
+    limiter = RateLimiter(per_minute=1, enabled=False)
+
+    assert not any(limiter.is_rate_limited("u1") for _ in range(10))
+
+
+def test_retry_after_points_to_the_first_allowed_second(store):
+    _hits(store, "ip", 5, START)
+
+    # Janela cheia: só depois que ela vira a anterior e perde algum peso
+    wait = store.retry_after("ip", 5, WINDOW, START + 30)
+    assert wait == 31
+    assert store.hit("ip", 5, WINDOW, START + 30 + wait - 1) is False
+    assert store.hit("ip", 5, WINDOW, START + 30 + wait) is True
+
+
+def test_retry_after_with_room_left_is_one_second(store):
+    assert store.retry_after("ip", 5, WINDOW, START) == 1
+    _hits(store, "ip", 2, START)
+    assert store.retry_after("ip", 5, WINDOW, START + 10) == 1
@@ -0,0 +1,104 @@
+"""Busca full-text de mensagens (FTS5): acentos, prefixo, trechos destacados"""
+import pytest
+
+from utils import MessageSearcher, build_fts_query
+
+
+@pytest.fixture
+def conversation(database):
+    lead_id = database.create_or_get_lead("5551977776666", "Cliente")["id"]
+    other_id = database.create_or_get_lead("5551977775555", "Outro")["id"]
+    for sender, content in [
+        ("lead", "Bom dia"),
+        ("lead", "Olá, gostaria de um orçamento para a instalação"),
+        ("vendedor", "Claro! Qual o endereço?"),
+        ("lead", "Rua das Acácias, 10"),
+        ("vendedor", "Orçamento enviado por e-mail"),
+    ]:
+        database.add_message(lead_id, sender, "X", content)
+    database.add_message(other_id, "lead", "Y", "Preciso de orçamento também")
+    return database, lead_id, other_id
+
+
+def _contents(result):
+    return sorted(m["content"] for m in result["messages"])
+
+
+def test_search_ignores_accents_both_ways(conversation):
+    database, _, _ = conversation
+    searcher = MessageSearcher(database)
+
+    plain = searcher.search_messages(search_term="orcamento")
+    accented = searcher.search_messages(search_term="ORÇAMENTO")
+
+    assert plain["total"] == accented["total"] == 3
+    assert _contents(plain) == _contents(accented)
+    assert _contents(searcher.search_messages(search_term="acacias")) == ["Rua das Acácias, 10"]
+
+
+def test_words_match_by_prefix_and_all_must_appear(conversation):
+    database, _, _ = conversation
+    searcher = MessageSearcher(database)
+
+    assert searcher.search_messages(search_term="instal")["total"] == 1
+    assert _contents(searcher.search_messages(search_term="orçamento enviado")) == ["Orçamento enviado por e-mail"]
+
+
+def test_snippet_highlights_the_original_text(conversation):
+    database, lead_id, _ = conversation
+
+    result = MessageSearcher(database).search_messages(lead_id=lead_id, search_term="instalacao")
+
+    assert result["messages"][0]["snippet"].endswith("<mark>instalação</mark>")
+
+
+def test_filters_and_total_with_paging(conversation):
+    database, lead_id, _ = conversation
+    searcher = MessageSearcher(database)
+
+    page = searcher.search_messages(lead_id=lead_id, search_term="orcamento", limit=1)
+    by_seller = searcher.search_messages(lead_id=lead_id, search_term="orcamento", sender_type="vendedor")
+
+    assert page["total"] == 2 and len(page["messages"]) == 1
+    assert _contents(by_seller) == ["Orçamento enviado por e-mail"]
+
+
+@pytest.mark.parametrize("term", ['orçamento"', "orçamento OR", "NEAR(", "*", "-orçamento"])
+def test_user_operators_do_not_break_the_query(conversation, term):
+    database, _, _ = conversation
+
+    MessageSearcher(database).search_messages(search_term=term)
+
+
+def test_blank_term_is_not_a_full_text_query(conversation):
+    database, _, _ = conversation
+
+    assert build_fts_query("  ") is None
+    assert MessageSearcher(database).search_messages(search_term=" ")["total"] == 6
+
+
+def test_index_follows_edits_and_deletes(conversation):
+    database, _, _ = conversation
+    searcher = MessageSearcher(database)
+    conn = database.get_connection()
+
+    conn.execute("UPDATE messages SET content = 'Boa tarde' WHERE content = 'Bom dia'")
+    conn.execute("DELETE FROM messages WHERE content LIKE 'Preciso%'")
+
+    assert searcher.search_messages(search_term="bom")["total"] == 0
+    assert searcher.search_messages(search_term="tarde")["total"] == 1
+    assert searcher.search_messages(search_term="orcamento")["total"] == 2
+
+
+def test_search_in_lead_returns_context_around_each_hit(conversation):
+    database, lead_id, _ = conversation
+
+    results = MessageSearcher(database).search_in_lead(lead_id, "endereco", context_size=1)
+
+    assert len(results) == 1
+    assert "<mark>endereço</mark>" in results[0]["match"]["snippet"]
+    assert [m["content"] for m in results[0]["context"]] == [
+        "Olá, gostaria de um orçamento para a instalação",
+        "Claro! Qual o endereço?",
+        "Rua das Acácias, 10",
+    ]
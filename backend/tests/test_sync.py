@@ -0,0 +1,127 @@
+"""Sync incremental da lista de leads: itens alterados e tombstones"""
+import pytest
+
+from database_tags_sla import extend_database_with_tags_sla
+
+
+@pytest.fixture
+def db(database):
+    extend_database_with_tags_sla(database)
+    return database
+
+
+@pytest.fixture
+def sellers(db):
+    return (db.create_user("ana_sync", "senha123", "Ana", "vendedor"),
+            db.create_user("bia_sync", "senha123", "Bia", "vendedor"))
+
+
+def _lead(db, n, name="Lead"):
+    return db.create_or_get_lead(f"55519444{n:05d}", f"{name} {n}")["id"]
+
+
+def _ids(changes):
+    return [lead["id"] for lead in changes["items"]]
+
+
+def test_full_sync_then_only_changes(db):
+    ids = [_lead(db, n) for n in range(3)]
+
+    full = db.get_lead_changes(0)
+    assert _ids(full) == ids and full["deleted"] == [] and not full["has_more"]
+    assert db.get_lead_changes(full["next_since"])["items"] == []
+
+    db.update_lead_status(ids[1], "qualificado")
+    db.add_message(ids[2], "lead", "X", "oi")
+    delta = db.get_lead_changes(full["next_since"])
+
+    assert _ids(delta) == [ids[1], ids[2]]
+    assert delta["items"][1]["message_count"] == 1
+    assert delta["next_since"] > full["next_since"]
+
+
+def test_untracked_columns_do_not_produce_changes(db):
+    lead_id = _lead(db, 1)
+    since = db.get_lead_changes(0)["next_since"]
+
+    db.get_connection().execute("UPDATE leads SET updated_at = '2030-01-01' WHERE id = ?", (lead_id,))
+
+    assert db.get_lead_changes(since)["items"] == []
+
+
+def test_tag_changes_bump_the_lead_and_items_carry_tags(db):
+    lead_id = _lead(db, 1)
+    tag_id = db.create_tag("Quente", "#ff0000")
+    since = db.get_lead_changes(0)["next_since"]
+
+    db.add_tag_to_lead(lead_id, tag_id)
+    changes = db.get_lead_changes(since)
+
+    assert _ids(changes) == [lead_id]
+    assert [tag["name"] for tag in changes["items"][0]["tags"]] == ["Quente"]
+
+
+def test_deleted_lead_is_a_tombstone_for_everyone(db, sellers):
+    ana, _ = sellers
+    lead_id = _lead(db, 1)
+    db.assign_lead(lead_id, ana)
+    since = db.get_lead_changes(0)["next_since"]
+
+    db.get_connection().execute("DELETE FROM leads WHERE id = ?", (lead_id,))
+
+    assert db.get_lead_changes(since)["deleted"] == [lead_id]
+    assert db.get_lead_changes(since, assigned_to=ana)["deleted"] == [lead_id]
+
+
+def test_reassigned_lead_leaves_only_the_old_sellers_view(db, sellers):
+    ana, bia = sellers
+    lead_id = _lead(db, 1)
+    db.assign_lead(lead_id, ana)
+    since = db.get_lead_changes(0)["next_since"]
+
+    db.transfer_lead(lead_id, bia)
+
+    for_ana = db.get_lead_changes(since, assigned_to=ana)
+    for_bia = db.get_lead_changes(since, assigned_to=bia)
+    assert for_ana["items"] == [] and for_ana["deleted"] == [lead_id]
+    assert _ids(for_bia) == [lead_id] and for_bia["deleted"] == []
+    # Admin continua vendo o lead: nada de tombstone
+    assert db.get_lead_changes(since)["deleted"] == []
+
+
+def test_lead_that_came_back_is_not_a_tombstone(db, sellers):
+    ana, bia = sellers
+    lead_id = _lead(db, 1)
+    db.assign_lead(lead_id, ana)
+    since = db.get_lead_changes(0)["next_since"]
+
+    db.transfer_lead(lead_id, bia)
+    db.transfer_lead(lead_id, ana)
+
+    changes = db.get_lead_changes(since, assigned_to=ana)
+    assert _ids(changes) == [lead_id] and changes["deleted"] == []
+
+
+def test_limit_pages_through_every_change_once(db):
+    ids = [_lead(db, n) for n in range(7)]
+    seen, since = [], 0
+
+    for _ in range(10):
+        page = db.get_lead_changes(since, limit=3, include_tags=False)
+        seen += _ids(page)
+        since = page["next_since"]
+        if not page["has_more"]:
+            break
+
+    assert seen == ids
+    assert db.get_lead_changes(since)["items"] == []
+
+
+def test_changes_endpoint(crm, client, phone):
+    crm.db.create_or_get_lead(phone, "Endpoint")
+    crm.db.create_or_get_lead(phone + "0", "Endpoint 2")
+
+    page = client.get("/api/leads/changes?since=0&limit=1").json
+
+    assert len(page["items"]) == 1 and page["has_more"] is True
+    assert client.get("/api/leads/changes?since=-1").status_code == 400
@@ -0,0 +1,209 @@
+"""Webhook de mensagens: confirmação só depois do commit e deduplicação por id do provedor"""
+import threading
+
+import pytest
+
+from ingestion import MessageIngestor
+
+
+def _message(phone, body="oi", provider_id=None):
+    payload = {"from": f"{phone}@c.us", "body": body, "notifyName": "Cliente"}
+    if provider_id:
+        payload["id"] = provider_id
+    return payload
+
+
+def _count_messages(crm, phone):
+    return crm.db.get_connection().execute("""
+        SELECT COUNT(*) FROM messages m JOIN leads l ON l.id = m.lead_id WHERE l.phone = ?
+    """, (phone,)).fetchone()[0]
+
+
+# =============================
+# CONFIRMAÇÃO (ACK) E DURABILIDADE
+# =============================
+def test_ack_only_after_message_is_committed(crm, webhook, phone):
+    response = webhook.post("/api/webhook/message", json=_message(phone))
+
+    assert response.status_code == 200
+    lead_id = response.json["lead_id"]
+    # Sem esperar a thread escritora: o 200 já implica COMMIT
+    assert _count_messages(crm, phone) == 1
+    assert crm.db.get_lead(lead_id)["phone"] == phone
+
+
+def test_full_queue_answers_503_with_retry_after(crm, webhook, phone, monkeypatch):
+    stalled = MessageIngestor(crm.db, crm.socketio, max_queue=1)  # sem start(): ninguém drena
+    assert stalled.submit({"phone": "0", "provider_id": None}, timeout=0)[0] is not None
+    monkeypatch.setattr(crm, "ingestor", stalled)
+
+    response = webhook.post("/api/webhook/message", json=_message(phone))
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert stalled.stats["rejected"] == 1
+
+
+def test_slow_commit_answers_503_so_bridge_retries(crm, webhook, phone, monkeypatch):
+    stalled = MessageIngestor(crm.db, crm.socketio)
+    monkeypatch.setattr(crm, "ingestor", stalled)
+    monkeypatch.setattr(crm.config, "INGEST_ACK_TIMEOUT_MS", 50)
+
+    response = webhook.post("/api/webhook/message", json=_message(phone, provider_id=f"slow-{phone}"))
+
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+
+
+def test_failed_write_is_reported_and_releases_provider_id(crm, phone, monkeypatch):
+    ingestor = MessageIngestor(crm.db, crm.socketio)
+
+    def broken(events):
+        raise RuntimeError("disco cheio")
+
+    monkeypatch.setattr(crm.db, "ingest_messages", broken)
+    event = {"phone": phone, "name": "X", "content": "oi", "provider_id": f"fail-{phone}", "received_at": ""}
+    future, duplicate = ingestor._claim(event)
+    ingestor._write([(event, future)])
+
+    with pytest.raises(RuntimeError):
+        future.result(timeout=1)
+    # A reentrega do bridge não pode cair como duplicada
+    assert ingestor._claim(dict(event))[1] is False
+
+
+# =============================
+# LOTE
+# =============================
+def test_batch_writes_valid_and_reports_rejected(crm, webhook, phone):
+    batch = [
+        _message(phone, "primeira"),
+        {"from": "abc@c.us", "body": "oi"},
+        {"from": f"{phone}@c.us", "body": "minha", "fromMe": True},
+        _message(phone, "segunda"),
+    ]
+
+    response = webhook.post("/api/webhook/messages", json={"messages": batch})
+
+    assert response.status_code == 200
+    assert response.json["written"] == 2
+    assert response.json["ignored"] == 1
+    assert [r["index"] for r in response.json["rejected"]] == [1]
+    assert _count_messages(crm, phone) == 2
+
+
+def test_batch_limits(crm, webhook, monkeypatch):
+    assert webhook.post("/api/webhook/messages", json={"messages": "x"}).status_code == 400
+
+    monkeypatch.setattr(crm, "WEBHOOK_BATCH_MAX", 2)
+    response = webhook.post("/api/webhook/messages", json=[{}, {}, {}])
+    assert response.status_code == 413
+
+
+# =============================
+# IDS DE PROVEDOR DUPLICADOS
+# =============================
+def test_redelivery_returns_original_lead(crm, webhook, phone):
+    message = _message(phone, provider_id=f"dup-{phone}")
+
+    first = webhook.post("/api/webhook/message", json=message)
+    second = webhook.post("/api/webhook/message", json=message)
+
+    assert first.status_code == second.status_code == 200
+    assert second.json["duplicate"] is True
+    assert second.json["lead_id"] == first.json["lead_id"]
+    assert _count_messages(crm, phone) == 1
+
+
+def test_concurrent_redeliveries_write_once(crm, phone):
+    message = _message(phone, provider_id=f"race-{phone}")
+    responses = []
+
+    def post():
+        responses.append(crm.app.test_client().post("/api/webhook/message", json=message).json)
+
+    threads = [threading.Thread(target=post) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({r["lead_id"] for r in responses}) == 1
+    assert sum(1 for r in responses if not r.get("duplicate")) == 1
+    assert _count_messages(crm, phone) == 1
+
+
+def test_baileys_key_id_is_used_for_dedupe(crm, webhook, phone):
+    message = {
+        "key": {"remoteJid": f"{phone}@s.whatsapp.net", "fromMe": False, "id": f"BAE5{phone}"},
+        "message": {"conversation": "oi"},
+        "pushName": "Cliente",
+    }
+
+    webhook.post("/api/webhook/message", json=message)
+    response = webhook.post("/api/webhook/message", json=message)
+
+    assert response.json["duplicate"] is True
+    assert _count_messages(crm, phone) == 1
+
+
+def test_batch_skips_repeated_and_already_stored_ids(crm, webhook, phone):
+    stored = webhook.post("/api/webhook/message", json=_message(phone, provider_id=f"b0-{phone}"))
+    assert stored.status_code == 200
+
+    batch = [_message(phone, f"m{i}", provider_id=f"b{i % 3}-{phone}") for i in range(6)]
+    response = webhook.post("/api/webhook/messages", json=batch)
+
+    assert response.json["written"] == 2
+    assert response.json["duplicates"] == 4
+    assert _count_messages(crm, phone) == 3
+
+
+def test_dedupe_survives_restart_through_unique_index(crm, phone):
+    event = {"phone": phone, "name": "X", "content": "oi", "provider_id": f"restart-{phone}", "received_at": ""}
+    assert MessageIngestor(crm.db, crm.socketio).ingest_batch([dict(event)]) == (1, 0)
+
+    # Processo novo: LRU vazio, quem barra é o índice único
+    assert MessageIngestor(crm.db, crm.socketio).ingest_batch([dict(event)]) == (0, 1)
+    assert _count_messages(crm, phone) == 1
+
+
+# =============================
+# RATE LIMIT DO WEBHOOK
+# =============================
+@pytest.fixture
+def strict_limiter(monkeypatch):
+    import middlewares
+    limiter = middlewares.RateLimiter(per_minute=1, per_hour=1)
+    monkeypatch.setattr(middlewares, "rate_limiter", limiter)
+    return limiter
+
+
+def test_unauthenticated_webhook_gets_429_with_retry_after(crm, webhook, phone, strict_limiter):
+    remote = {"REMOTE_ADDR": "203.0.113.7"}
+
+    assert webhook.post("/api/webhook/message", json=_message(phone), environ_base=remote).status_code == 200
+    response = webhook.post("/api/webhook/message", json=_message(phone), environ_base=remote)
+
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert response.json["retry_after"] == int(response.headers["Retry-After"])
+
+
+def test_local_bridge_is_exempt_without_token(crm, webhook, phone, strict_limiter):
+    statuses = [webhook.post("/api/webhook/message", json=_message(phone, f"m{i}")).status_code for i in range(5)]
+
+    assert statuses == [200] * 5
+
+
+def test_webhook_token_authenticates_and_exempts(crm, webhook, phone, strict_limiter, monkeypatch):
+    monkeypatch.setattr(crm.config, "WEBHOOK_TOKEN", "segredo")
+    remote = {"REMOTE_ADDR": "203.0.113.8"}
+    auth = {"Authorization": "Bearer segredo"}
+
+    assert webhook.post("/api/webhook/message", json=_message(phone)).status_code == 401
+    statuses = [
+        webhook.post("/api/webhook/message", json=_message(phone, f"m{i}"), headers=auth, environ_base=remote).status_code
+        for i in range(5)
+    ]
+    assert statuses == [200] * 5
@@ -1,10 +1,18 @@
 """
 Utilidades para paginação, busca e performance
 """
-import sqlite3
+import base64
+import json
+import threading
+import time
+from collections import OrderedDict
 from typing import List, Dict, Any, Optional
 from datetime import datetime, timedelta
 
+from logs import get_logger
+
+logger = get_logger(__name__)
+
 
 class Paginator:
     """
@@ -38,10 +46,73 @@ class Paginator:
         }
 
 
+def encode_cursor(position: Dict[str, Any]) -> str:
+    """Codifica a posição de uma página (keyset) em um cursor opaco"""
+    raw = json.dumps(position, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+# Formatos de cursor: campo -> tipo(s) do valor; lista = chave de tamanho fixo
+CURSOR_TIME_ID = {"after": [(str, type(None)), int]}  # (timestamp, id)
+CURSOR_ID = {"before_id": int, "after_id": int}
+
+
+def _cursor_value_matches(value: Any, spec: Any) -> bool:
+    if isinstance(spec, list):
+        return (isinstance(value, list) and len(value) == len(spec)
+                and all(_cursor_value_matches(v, s) for v, s in zip(value, spec)))
+    # bool é subclasse de int, mas true/false não é id
+    return isinstance(value, spec) and not isinstance(value, bool)
+
+
+def decode_cursor(cursor: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Decodifica um cursor gerado por encode_cursor
+    
+    Args:
+        fields: campos aceitos pelo endpoint e o tipo de cada valor
+                (ex: CURSOR_TIME_ID, CURSOR_ID)
+
+    Raises:
+        ValueError: se o cursor for inválido ou não pertencer a este endpoint
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Cursor inválido")
+    
+    if not isinstance(position, dict) or not set(position) <= set(fields):
+        raise ValueError("Cursor inválido")
+    # Valores vão direto para o SQL: tipo e tamanho errados viram 400, não 500
+    if not all(_cursor_value_matches(value, fields[key]) for key, value in position.items()):
+        raise ValueError("Cursor inválido")
+    return position
+
+
+def build_fts_query(search_term: str) -> Optional[str]:
+    """
+    Converte o termo digitado em uma query FTS5 segura
+    
+    Cada palavra vira um termo entre aspas com busca por prefixo,
+    então operadores/aspas digitados pelo usuário não quebram a query.
+    """
+    tokens = [t.replace('"', '') for t in (search_term or '').split()]
+    tokens = [t for t in tokens if t]
+    if not tokens:
+        return None
+    return " ".join(f'"{t}"*' for t in tokens)
+
+
 class MessageSearcher:
     """
     Busca otimizada de mensagens com filtros
+    
+    O texto é buscado no índice FTS5 messages_fts (sem acentos, ver
+    migrations.py), com resultados ordenados por relevância (bm25).
     """
+    SNIPPET = "snippet(messages_fts, 0, '<mark>', '</mark>', '…', 12)"
+    
     def __init__(self, database):
         self.db = database
     
@@ -52,6 +123,7 @@ class MessageSearcher:
         sender_type: Optional[str] = None,
         date_from: Optional[datetime] = None,
         date_to: Optional[datetime] = None,
+        assigned_to: Optional[int] = None,
         limit: int = 50,
         offset: int = 0
     ) -> Dict[str, Any]:
@@ -60,58 +132,84 @@ class MessageSearcher:
         
         Args:
             lead_id: Filtrar por lead específico
-            search_term: Termo de busca no conteúdo
+            search_term: Termo de busca no conteúdo (full-text)
             sender_type: Tipo de remetente (lead/vendedor/sistema)
             date_from: Data inicial
             date_to: Data final
+            assigned_to: Apenas leads deste vendedor
             limit: Quantidade máxima de resultados
             offset: Offset para paginação
         
         Returns:
             Dict com mensagens e total de resultados
         """
-        conn = sqlite3.connect(self.db.db_name)
-        conn.row_factory = sqlite3.Row
+        conn = self.db.get_connection()
         cursor = conn.cursor()
         
-        # Construir query
-        query = "SELECT * FROM messages WHERE 1=1"
-        params = []
+        fts_query = build_fts_query(search_term)
         
         # Filtros
+        filters = ""
+        params = []
+        
         if lead_id:
-            query += " AND lead_id = ?"
+            filters += " AND m.lead_id = ?"
             params.append(lead_id)
         
-        if search_term:
-            query += " AND content LIKE ?"
-            params.append(f"%{search_term}%")
-        
         if sender_type:
-            query += " AND sender_type = ?"
+            filters += " AND m.sender_type = ?"
             params.append(sender_type)
         
         if date_from:
-            query += " AND timestamp >= ?"
+            filters += " AND m.timestamp >= ?"
             params.append(date_from.isoformat())
         
         if date_to:
-            query += " AND timestamp <= ?"
+            filters += " AND m.timestamp <= ?"
             params.append(date_to.isoformat())
         
-        # Count total
-        count_query = query.replace("SELECT *", "SELECT COUNT(*)")
-        cursor.execute(count_query, params)
-        total = cursor.fetchone()[0]
-        
-        # Buscar com paginação
-        query += " ORDER BY timestamp DESC LIMIT ? OFFSET ?"
-        params.extend([limit, offset])
+        if assigned_to is not None:
+            filters += " AND m.lead_id IN (SELECT id FROM leads WHERE assigned_to = ?)"
+            params.append(assigned_to)
+        
+        # Construir query (o total vem junto, via window function)
+        if fts_query:
+            # snippet() não pode ser usado junto com window functions:
+            # a página é escolhida primeiro e só ela recebe o trecho destacado
+            query = f"""
+                WITH hits AS (
+                    SELECT m.id, messages_fts.rank AS rank
+                    FROM messages_fts
+                    JOIN messages m ON m.id = messages_fts.rowid
+                    WHERE messages_fts MATCH ?{filters}
+                ),
+                page AS (
+                    SELECT id, rank, COUNT(*) OVER () AS _total
+                    FROM hits ORDER BY rank LIMIT ? OFFSET ?
+                )
+                SELECT m.*, {self.SNIPPET} AS snippet, page.rank, page._total
+                FROM page
+                JOIN messages m ON m.id = page.id
+                JOIN messages_fts ON messages_fts.rowid = page.id
+                WHERE messages_fts MATCH ?
+                ORDER BY page.rank
+            """
+            params = [fts_query, *params, limit, offset, fts_query]
+        else:
+            query = f"""
+                SELECT m.*, COUNT(*) OVER () AS _total
+                FROM messages m
+                WHERE 1=1{filters}
+                ORDER BY m.timestamp DESC, m.id DESC
+                LIMIT ? OFFSET ?
+            """
+            params.extend([limit, offset])
         
         cursor.execute(query, params)
         messages = [dict(row) for row in cursor.fetchall()]
-        
-        conn.close()
+        total = messages[0]['_total'] if messages else 0
+        for message in messages:
+            del message['_total']
         
         return {
             "messages": messages,
@@ -120,45 +218,69 @@ class MessageSearcher:
             "offset": offset
         }
     
-    def search_in_lead(self, lead_id: int, search_term: str) -> List[Dict[str, Any]]:
+    def search_in_lead(self, lead_id: int, search_term: str, context_size: int = 2) -> List[Dict[str, Any]]:
         """
         Busca mensagens em um lead específico
         Retorna com contexto (mensagens antes e depois)
         """
-        conn = sqlite3.connect(self.db.db_name)
-        conn.row_factory = sqlite3.Row
+        fts_query = build_fts_query(search_term)
+        if not fts_query:
+            return []
+        
+        conn = self.db.get_connection()
         cursor = conn.cursor()
         
         # Buscar mensagens que correspondem ao termo
-        cursor.execute("""
-            SELECT id, content, timestamp, sender_type, sender_name
-            FROM messages
-            WHERE lead_id = ? AND content LIKE ?
-            ORDER BY timestamp DESC
+        cursor.execute(f"""
+            SELECT m.id, m.content, m.timestamp, m.sender_type, m.sender_name,
+                   {self.SNIPPET} AS snippet
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ? AND m.lead_id = ?
+            ORDER BY bm25(messages_fts)
             LIMIT 10
-        """, (lead_id, f"%{search_term}%"))
+        """, (fts_query, lead_id))
+        matches = [dict(row) for row in cursor.fetchall()]
+        if not matches:
+            return []
         
-        results = []
+        # Contexto de todos os resultados em uma única query:
+        # para cada hit, de N mensagens antes até N mensagens depois na conversa
+        cursor.execute("""
+            WITH hits(id) AS (SELECT value FROM json_each(:hits)),
+            bounds AS (
+                SELECT h.id AS hit_id,
+                       COALESCE(
+                           (SELECT id FROM messages WHERE lead_id = :lead AND id < h.id
+                            ORDER BY id DESC LIMIT 1 OFFSET :n - 1),
+                           (SELECT MIN(id) FROM messages WHERE lead_id = :lead)
+                       ) AS lo,
+                       COALESCE(
+                           (SELECT id FROM messages WHERE lead_id = :lead AND id > h.id
+                            ORDER BY id ASC LIMIT 1 OFFSET :n - 1),
+                           (SELECT MAX(id) FROM messages WHERE lead_id = :lead)
+                       ) AS hi
+                FROM hits h
+            )
+            SELECT b.hit_id AS _hit_id, m.*
+            FROM bounds b
+            JOIN messages m ON m.lead_id = :lead AND m.id BETWEEN b.lo AND b.hi
+            ORDER BY b.hit_id, m.id
+        """, {
+            "hits": json.dumps([m['id'] for m in matches]),
+            "lead": lead_id,
+            "n": max(1, context_size),
+        })
+        
+        context_by_hit = {m['id']: [] for m in matches}
         for row in cursor.fetchall():
-            message_id = row['id']
-            
-            # Buscar contexto (2 mensagens antes e 2 depois)
-            cursor.execute("""
-                SELECT * FROM messages
-                WHERE lead_id = ?
-                AND id BETWEEN ? AND ?
-                ORDER BY id ASC
-            """, (lead_id, message_id - 2, message_id + 2))
-            
-            context = [dict(r) for r in cursor.fetchall()]
-            
-            results.append({
-                "match": dict(row),
-                "context": context
-            })
+            message = dict(row)
+            context_by_hit[message.pop('_hit_id')].append(message)
         
-        conn.close()
-        return results
+        return [
+            {"match": match, "context": context_by_hit[match['id']]}
+            for match in matches
+        ]
 
 
 class LeadSearcher:
@@ -201,17 +323,17 @@ class LeadSearcher:
         Returns:
             Dict com leads e total de resultados
         """
-        conn = sqlite3.connect(self.db.db_name)
-        conn.row_factory = sqlite3.Row
+        conn = self.db.get_connection()
         cursor = conn.cursor()
         
-        # Construir query
+        # Construir query (contadores de conversa vêm desnormalizados em leads;
+        # o total vem junto, via window function)
         query = """
             SELECT l.*, u.name as vendedor_name,
-                   COUNT(DISTINCT m.id) as messages_count
+                   l.message_count as messages_count,
+                   COUNT(*) OVER () AS _total
             FROM leads l
             LEFT JOIN users u ON l.assigned_to = u.id
-            LEFT JOIN messages m ON l.id = m.lead_id
             WHERE 1=1
         """
         params = []
@@ -249,20 +371,16 @@ class LeadSearcher:
             query += " AND l.created_at <= ?"
             params.append(date_to.isoformat())
         
-        query += " GROUP BY l.id"
-        
-        # Count total
-        count_query = f"SELECT COUNT(*) FROM ({query})"
-        cursor.execute(count_query, params)
-        total = cursor.fetchone()[0]
-        
         # Ordenação
-        valid_sort_fields = ['id', 'name', 'phone', 'status', 'created_at', 'updated_at', 'last_message_at']
+        valid_sort_fields = [
+            'id', 'name', 'phone', 'status', 'created_at', 'updated_at',
+            'last_message_at', 'last_inbound_at', 'message_count'
+        ]
         if sort_by not in valid_sort_fields:
             sort_by = 'updated_at'
         
         sort_order = 'DESC' if sort_order.upper() == 'DESC' else 'ASC'
-        query += f" ORDER BY l.{sort_by} {sort_order}"
+        query += f" ORDER BY l.{sort_by} {sort_order}, l.id {sort_order}"
         
         # Paginação
         query += " LIMIT ? OFFSET ?"
@@ -270,8 +388,9 @@ class LeadSearcher:
         
         cursor.execute(query, params)
         leads = [dict(row) for row in cursor.fetchall()]
-        
-        conn.close()
+        total = leads[0]['_total'] if leads else 0
+        for lead in leads:
+            del lead['_total']
         
         return {
             "leads": leads,
@@ -281,88 +400,382 @@ class LeadSearcher:
         }
 
 
+class LRUCache:
+    """
+    Dicionário limitado com descarte do item menos usado (thread-safe)
+    """
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: Any, default: Any = None) -> Any:
+        """Busca item e marca como usado recentemente"""
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+    
+    def set(self, key: Any, value: Any):
+        """Adiciona item, descartando o menos usado se passar do limite"""
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+    
+    def delete(self, key: Any):
+        """Remove item"""
+        with self._lock:
+            self._items.pop(key, None)
+    
+    def __contains__(self, key: Any) -> bool:
+        with self._lock:
+            return key in self._items
+    
+    def __len__(self) -> int:
+        return len(self._items)
+
+
 class PerformanceCache:
     """
-    Cache simples em memória para queries frequentes
-    Em produção: usar Redis
+    Cache read-through em memória para queries frequentes (thread-safe)
+
+    - LRU limitado por quantidade de entradas e por tamanho estimado (bytes)
+    - TTL por chave (default ttl_seconds)
+    - Estatísticas de hits/misses/evictions
+
+    Chaves são strings no formato "<tópico>:<resto>" para que invalidate()
+    descarte tudo que depende de um tópico (ex: "tags" → "tags:all").
+    Cada tópico tem uma geração, incrementada por invalidate(): get_or_set
+    não guarda o resultado de um loader que começou antes da invalidação
+    (ele pode ter lido o banco antes do commit).
+    Em produção com vários processos: usar Redis
     """
-    def __init__(self, ttl_seconds: int = 300):
-        self.cache = {}
+    def __init__(self, ttl_seconds: int = 300, max_entries: int = 1024, max_bytes: int = 16 * 1024 * 1024):
         self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()  # key -> (value, size, expires_at)
+        self.size_bytes = 0
+        self._generations = {}  # tópico -> geração (incrementa em invalidate)
+        self._clears = 0  # clear() invalida todas as gerações
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0
+        }
+    
+    @staticmethod
+    def _estimate_size(value: Any) -> int:
+        """Tamanho aproximado do valor serializado (as rotas cacheiam JSON)"""
+        try:
+            return len(json.dumps(value, default=str))
+        except (TypeError, ValueError):
+            return 1024
+    
+    def _remove(self, key: str):
+        _, size, _ = self.cache.pop(key)
+        self.size_bytes -= size
     
     def get(self, key: str) -> Optional[Any]:
         """Busca item no cache"""
-        if key in self.cache:
-            item, timestamp = self.cache[key]
-            if (datetime.now() - timestamp).total_seconds() < self.ttl:
-                return item
-            else:
-                del self.cache[key]
-        return None
+        with self._lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            value, _, expires_at = entry
+            if time.monotonic() >= expires_at:
+                self._remove(key)
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return None
+            self.cache.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+    
+    def _generation(self, key: str) -> tuple:
+        """Geração atual do tópico da chave (chamar com o lock)"""
+        return self._clears, self._generations.get(key.split(":", 1)[0], 0)
     
-    def set(self, key: str, value: Any):
-        """Adiciona item ao cache"""
-        self.cache[key] = (value, datetime.now())
+    def set(self, key: str, value: Any, ttl: Optional[int] = None, generation: Optional[tuple] = None):
+        """
+        Adiciona item ao cache (ttl em segundos sobrescreve o default)
+        
+        generation: geração do tópico lida antes de carregar o valor; se o
+        tópico foi invalidado desde então, o valor (velho) é descartado
+        """
+        size = self._estimate_size(value)
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if generation is not None and self._generation(key) != generation:
+                return
+            if key in self.cache:
+                self._remove(key)
+            self.cache[key] = (value, size, expires_at)
+            self.size_bytes += size
+            while len(self.cache) > self.max_entries or self.size_bytes > self.max_bytes:
+                oldest = next(iter(self.cache))
+                self._remove(oldest)
+                self.stats['evictions'] += 1
+    
+    def get_or_set(self, key: str, loader, ttl: Optional[int] = None) -> Any:
+        """
+        Read-through: retorna do cache ou chama loader() e guarda o resultado
+        
+        Usage:
+            tags = cache.get_or_set("tags:all", db.get_all_tags)
+        """
+        value = self.get(key)
+        if value is None:
+            with self._lock:
+                generation = self._generation(key)
+            value = loader()
+            if value is not None:
+                self.set(key, value, ttl, generation=generation)
+        return value
     
     def delete(self, key: str):
         """Remove item do cache"""
-        if key in self.cache:
-            del self.cache[key]
+        with self._lock:
+            if key in self.cache:
+                self._remove(key)
+    
+    def invalidate(self, *topics: str):
+        """Remove todas as chaves dos tópicos informados ("tags" remove "tags:*")"""
+        prefixes = tuple(f"{topic}:" for topic in topics)
+        with self._lock:
+            for topic in topics:
+                self._generations[topic] = self._generations.get(topic, 0) + 1
+            for key in [k for k in self.cache if k.startswith(prefixes)]:
+                self._remove(key)
+                self.stats['invalidations'] += 1
     
     def clear(self):
         """Limpa todo o cache"""
-        self.cache.clear()
+        with self._lock:
+            self._clears += 1
+            self.cache.clear()
+            self.size_bytes = 0
     
     def clear_expired(self):
         """Remove itens expirados"""
-        now = datetime.now()
-        expired_keys = [
-            key for key, (_, timestamp) in self.cache.items()
-            if (now - timestamp).total_seconds() >= self.ttl
-        ]
-        for key in expired_keys:
-            del self.cache[key]
+        now = time.monotonic()
+        with self._lock:
+            expired_keys = [
+                key for key, (_, _, expires_at) in self.cache.items()
+                if now >= expires_at
+            ]
+            for key in expired_keys:
+                self._remove(key)
+                self.stats['expirations'] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna estatísticas"""
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'entries': len(self.cache),
+                'size_bytes': self.size_bytes,
+                'hit_rate': (self.stats['hits'] / lookups * 100) if lookups > 0 else 0
+            }
+
+
+class CircuitOpenError(Exception):
+    """Chamada recusada porque o circuito está aberto"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker para dependências externas (ex: bridge do WhatsApp)
+
+    closed    - chamadas passam; failure_threshold falhas seguidas abrem o circuito
+    open      - chamadas falham na hora (sem rede, sem sleep) por recovery_timeout s
+    half_open - passada a espera, uma chamada de teste decide: sucesso fecha,
+                falha reabre
+    
+    Usage:
+        if not breaker.allow():
+            raise CircuitOpenError()
+        try:
+            ...
+            breaker.record_success()
+        except Exception:
+            breaker.record_failure()
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30, name: str = "circuit"):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.name = name
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.stats = {
+            'opened': 0,
+            'rejected': 0,
+            'failures': 0,
+            'successes': 0
+        }
+    
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+    
+    def _current_state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._state = self.HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+    
+    def allow(self) -> bool:
+        """True se a chamada pode seguir (no half_open, só a primeira)"""
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.stats['rejected'] += 1
+            return False
+    
+    def record_success(self):
+        with self._lock:
+            self.stats['successes'] += 1
+            if self._state != self.CLOSED:
+                logger.warning("✅ Circuito '%s' fechado", self.name)
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+    
+    def record_failure(self):
+        with self._lock:
+            self.stats['failures'] += 1
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.stats['opened'] += 1
+                    logger.error("🚨 Circuito '%s' aberto após %d falhas seguidas", self.name, self._failures)
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+    
+    def retry_after(self) -> float:
+        """Segundos até o circuito aceitar uma chamada de teste (0 se fechado)"""
+        with self._lock:
+            if self._current_state() != self.OPEN:
+                return 0.0
+            return max(0.0, self.recovery_timeout - (time.monotonic() - self._opened_at))
+    
+    def get_status(self) -> Dict[str, Any]:
+        """Estado atual e contadores"""
+        with self._lock:
+            return {
+                'state': self._current_state(),
+                'consecutive_failures': self._failures,
+                **self.stats
+            }
+
+
+class TokenBucket:
+    """
+    Token bucket para modelar a taxa de envio
+
+    Acumula `rate` fichas por segundo até `capacity` (rajada máxima);
+    cada envio consome uma.
+
+    Usage:
+        bucket = TokenBucket(rate=20 / 60, capacity=5)
+        if bucket.try_acquire():
+            enviar()
+        else:
+            time.sleep(bucket.wait_time())
+    """
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def try_acquire(self, tokens: float = 1) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+    
+    def wait_time(self, tokens: float = 1) -> float:
+        """Segundos até haver `tokens` fichas"""
+        with self._lock:
+            self._refill()
+            missing = tokens - self._tokens
+            return max(0.0, missing / self.rate) if missing > 0 else 0.0
+    
+    def refund(self, tokens: float = 1):
+        """Devolve fichas de um try_acquire que acabou não enviando nada"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + tokens)
 
 
 class QueryOptimizer:
     """
     Otimizador de queries com estatísticas
+    
+    Alimentado pela conexão instrumentada de database.py (toda query passa
+    por log_query); queries acima de slow_threshold segundos são guardadas.
     """
-    def __init__(self):
+    def __init__(self, slow_threshold: float = 1.0):
+        self.slow_threshold = slow_threshold
+        self._lock = threading.Lock()
         self.stats = {
             'total_queries': 0,
-            'slow_queries': [],
-            'cache_hits': 0,
-            'cache_misses': 0
+            'slow_total': 0,
+            'slow_queries': []
         }
     
-    def log_query(self, query: str, duration: float, used_cache: bool = False):
+    def log_query(self, query: str, duration: float):
         """Registra estatísticas de uma query"""
-        self.stats['total_queries'] += 1
-        
-        if used_cache:
-            self.stats['cache_hits'] += 1
-        else:
-            self.stats['cache_misses'] += 1
-        
-        # Registra queries lentas (> 1 segundo)
-        if duration > 1.0:
-            self.stats['slow_queries'].append({
-                'query': query,
-                'duration': duration,
-                'timestamp': datetime.now().isoformat()
-            })
+        with self._lock:
+            self.stats['total_queries'] += 1
             
-            # Mantém apenas últimas 100 queries lentas
-            if len(self.stats['slow_queries']) > 100:
-                self.stats['slow_queries'] = self.stats['slow_queries'][-100:]
+            # Registra queries lentas
+            if duration > self.slow_threshold:
+                self.stats['slow_total'] += 1
+                self.stats['slow_queries'].append({
+                    'query': ' '.join(query.split())[:500],
+                    'duration': duration,
+                    'timestamp': datetime.now().isoformat()
+                })
+                
+                # Mantém apenas últimas 100 queries lentas
+                if len(self.stats['slow_queries']) > 100:
+                    self.stats['slow_queries'] = self.stats['slow_queries'][-100:]
     
     def get_stats(self) -> Dict[str, Any]:
         """Retorna estatísticas"""
-        return {
-            **self.stats,
-            'cache_hit_rate': (
-                self.stats['cache_hits'] / self.stats['total_queries'] * 100
-                if self.stats['total_queries'] > 0 else 0
-            )
-        }
\ No newline at end of file
+        with self._lock:
+            return {**self.stats, 'slow_queries': list(self.stats['slow_queries'])}
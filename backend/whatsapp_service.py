@@ -1,21 +1,53 @@
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 import time
 from functools import wraps
 
+from realtime import lead_event_rooms
+from utils import CircuitBreaker, CircuitOpenError
+from logs import get_logger, log_body
+from metrics import registry
+
+logger = get_logger(__name__)
+
+BRIDGE_REQUEST_SECONDS = registry.histogram(
+    "crm_whatsapp_bridge_request_seconds",
+    "Latência das chamadas ao bridge do WhatsApp",
+    labels=("method", "path", "outcome"),
+)
+
 class WhatsAppService:
-    def __init__(self, database, socketio):
+    def __init__(self, database, socketio, base_url="http://localhost:3001", timeout=10,
+                 connect_timeout=3, max_retries=3, pool_size=10,
+                 circuit_failures=5, circuit_reset_seconds=30):
         self.db = database
         self.socketio = socketio
-        self.venom_url = "http://localhost:3001"
+        self.venom_url = base_url.rstrip("/")
         self.is_ready = False
-        self.max_retries = 3
+        self.phone = None
+        self.max_retries = max_retries
         self.retry_delay = 2  # segundos
+        self.timeout = (connect_timeout, timeout)  # (conexão, leitura)
+        self.status_timeout = (connect_timeout, min(timeout, 5))
         self.last_health_check = None
         self.health_check_interval = 30  # segundos
         self.connection_errors = 0
         self.max_connection_errors = 5
 
+        # Conexões keep-alive com o bridge (sem handshake TCP por chamada)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Bridge fora do ar: falha na hora em vez de esperar timeouts e retries
+        self.breaker = CircuitBreaker(
+            failure_threshold=circuit_failures,
+            recovery_timeout=circuit_reset_seconds,
+            name="whatsapp-bridge"
+        )
+
     # =============================
     # UTILITÁRIOS
     # =============================
@@ -29,55 +61,88 @@ class WhatsAppService:
         
         # Valida comprimento mínimo
         if len(phone_clean) < 10:
-            print(f"⚠️ Telefone inválido (muito curto): {phone}")
+            logger.warning("⚠️ Telefone inválido (muito curto): %s", phone)
             return None
         
         # Valida comprimento máximo
         if len(phone_clean) > 15:
-            print(f"⚠️ Telefone inválido (muito longo): {phone}")
+            logger.warning("⚠️ Telefone inválido (muito longo): %s", phone)
             return None
         
         return phone_clean
 
+    # =============================
+    # HTTP COM O BRIDGE
+    # =============================
+    def _request(self, method, path, timeout=None, **kwargs):
+        """
+        Chamada ao bridge pela sessão keep-alive, passando pelo circuit breaker
+
+        Qualquer exceção na chamada (não só erro de rede) e respostas 5xx
+        contam como falha do bridge.
+        Raises:
+            CircuitOpenError: circuito aberto (nenhuma chamada de rede feita)
+            requests.exceptions.RequestException: erro de rede
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Bridge indisponível (nova tentativa em {self.breaker.retry_after():.0f}s)")
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.venom_url}{path}",
+                                            timeout=timeout or self.timeout, **kwargs)
+        except BaseException:
+            # Inclui erros fora de RequestException (e o Timeout do eventlet):
+            # sem resultado registrado, a chamada de teste do half_open
+            # deixaria o circuito preso sem aceitar outra
+            BRIDGE_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                           method=method, path=path, outcome="error")
+            self.breaker.record_failure()
+            raise
+        outcome = "ok" if response.status_code < 400 else "http_error"
+        BRIDGE_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                       method=method, path=path, outcome=outcome)
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def circuit_open(self):
+        """True enquanto o circuito do bridge está aberto"""
+        return self.breaker.state == CircuitBreaker.OPEN
+
     # =============================
     # STATUS DE CONEXÃO E HEALTH CHECK
     # =============================
     def check_connection(self):
-        """Verifica se VenomBot está conectado - COM RETRY"""
-        max_attempts = 2
-        delay = 1
-        
-        for attempt in range(max_attempts):
-            try:
-                response = requests.get(f"{self.venom_url}/status", timeout=5)
-                if response.status_code == 200:
-                    data = response.json()
-                    self.is_ready = data.get("connected", False)
-                    self.last_health_check = datetime.now()
-                    self.connection_errors = 0  # Reset contador de erros
-                    
-                    if self.is_ready:
-                        print(f"✅ WhatsApp conectado: {data.get('phone', 'N/A')}")
-                    else:
-                        print(f"⚠️ WhatsApp não conectado")
-                    
-                    return data
-                return {"connected": False}
+        """Verifica se VenomBot está conectado (uma tentativa; falha rápido com circuito aberto)"""
+        try:
+            response = self._request("GET", "/status", timeout=self.status_timeout)
+            if response.status_code == 200:
+                data = response.json()
+                self.is_ready = data.get("connected", False)
+                self.phone = data.get("phone") if self.is_ready else None
+                self.last_health_check = datetime.now()
+                self.connection_errors = 0  # Reset contador de erros
                 
-            except requests.exceptions.RequestException as e:
-                if attempt < max_attempts - 1:
-                    print(f"⚠️ Tentativa {attempt + 1}/{max_attempts} falhou. Tentando novamente em {delay}s...")
-                    time.sleep(delay)
+                if self.is_ready:
+                    logger.debug("✅ WhatsApp conectado: %s", data.get("phone", "N/A"))
                 else:
-                    print(f"❌ Erro ao verificar conexão com VenomBot: {e}")
-                    self.is_ready = False
-                    self.last_health_check = datetime.now()
-                    self.connection_errors += 1
-                    
-                    if self.connection_errors >= self.max_connection_errors:
-                        print(f"🚨 ALERTA: {self.connection_errors} erros consecutivos de conexão!")
-                    
-                    return {"connected": False}
+                    logger.warning("⚠️ WhatsApp não conectado")
+                
+                return data
+            return {"connected": False}
+            
+        except (requests.exceptions.RequestException, CircuitOpenError) as e:
+            logger.warning("❌ Erro ao verificar conexão com VenomBot: %s", e)
+            self.is_ready = False
+            self.last_health_check = datetime.now()
+            self.connection_errors += 1
+            
+            if self.connection_errors >= self.max_connection_errors:
+                logger.error("🚨 ALERTA: %d erros consecutivos de conexão!", self.connection_errors)
+            
+            return {"connected": False}
     
     def should_check_health(self):
         """Verifica se deve fazer health check"""
@@ -92,7 +157,7 @@ class WhatsAppService:
             self.check_connection()
         
         if not self.is_ready:
-            print("⚠️ WhatsApp não está conectado. Tentando reconectar...")
+            logger.info("⚠️ WhatsApp não está conectado. Tentando reconectar...")
             self.check_connection()
         
         return self.is_ready
@@ -117,15 +182,15 @@ class WhatsAppService:
             # Valida telefone
             phone = self.validate_phone(phone)
             if not phone:
-                print(f"❌ Telefone inválido rejeitado")
+                logger.warning("❌ Telefone inválido rejeitado")
                 return
 
             # Valida conteúdo
             if not content or len(content) > 4096:
-                print(f"⚠️ Mensagem inválida (vazia ou muito grande)")
+                logger.warning("⚠️ Mensagem inválida (vazia ou muito grande)")
                 return
 
-            print(f"📨 Mensagem recebida de {sender_name} ({phone}): {content[:50]}...")
+            logger.info("📨 Mensagem recebida", extra={"phone": phone, "content": log_body(content)})
 
             # Cria ou busca o lead no banco
             lead = self.db.create_or_get_lead(phone, sender_name)
@@ -156,154 +221,170 @@ class WhatsAppService:
                 "content": content,
                 "timestamp": datetime.now().isoformat(),
                 "sender_type": "lead"
-            })
-
-            print("✅ Mensagem recebida e registrada com sucesso")
+            }, to=lead_event_rooms(lead["id"], lead.get("assigned_to")))
 
         except Exception as e:
-            print(f"❌ Erro ao processar mensagem recebida: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("❌ Erro ao processar mensagem recebida: %s", e)
 
     # =============================
     # ENVIAR MENSAGEM PARA O LEAD
     # =============================
-    def send_message(self, phone, content, vendedor_id=None):
-        """Envia mensagem para o lead via VenomBot com retry"""
+    def send_message(self, phone, content, vendedor_id=None, lead=None):
+        """
+        Envia mensagem para o lead via VenomBot com retry
+
+        Args:
+            lead: lead já carregado pelo chamador (evita buscar de novo pelo telefone)
+        """
         
         # Validações
         phone = self.validate_phone(phone)
         if not phone:
-            print(f"❌ Telefone inválido: {phone}")
+            logger.warning("❌ Telefone inválido: %s", phone)
             return False
         
         if not content or not content.strip():
-            print(f"❌ Mensagem vazia não pode ser enviada")
+            logger.warning("❌ Mensagem vazia não pode ser enviada")
             return False
         
         if len(content) > 4096:
-            print(f"❌ Mensagem muito grande (max 4096 caracteres)")
+            logger.warning("❌ Mensagem muito grande (max 4096 caracteres)")
+            return False
+        
+        if lead is None:
+            lead = self.db.get_lead_by_phone(phone)
+        if not lead:
+            logger.warning("⚠️ Nenhum lead encontrado com o número %s. Mensagem não será enviada.", phone)
             return False
         
         # Verifica conexão
         if not self.ensure_connected():
-            print(f"❌ WhatsApp não conectado. Não é possível enviar mensagem.")
+            logger.warning("❌ WhatsApp não conectado. Não é possível enviar mensagem.")
             return False
         
-        # Tenta enviar com retry
+        # Tenta enviar com retry (para na hora se o circuito abrir)
         for attempt in range(self.max_retries):
-            try:
-                print(f"📤 Enviando mensagem para {phone} (tentativa {attempt + 1}/{self.max_retries})")
-                
-                response = requests.post(
-                    f"{self.venom_url}/send",
-                    json={"phone": phone, "message": content},
-                    timeout=10
-                )
-
-                if response.status_code != 200:
-                    print(f"❌ Erro HTTP {response.status_code}: {response.text}")
-                    if attempt < self.max_retries - 1:
-                        time.sleep(self.retry_delay)
-                        continue
-                    return False
-
-                lead = self.db.get_lead_by_phone(phone)
-                if not lead:
-                    print(f"⚠️ Nenhum lead encontrado com o número {phone}. Mensagem não será enviada.")
-                    return False
-
-
-                # Busca nome do vendedor
-                vendedor_name = "Vendedor"
-                if vendedor_id:
-                    users = self.db.get_all_users()
-                    user = next((u for u in users if u["id"] == vendedor_id), None)
-                    if user:
-                        vendedor_name = user["name"]
-
-                # Salva mensagem enviada
-                self.db.add_message(
-                    lead_id=lead["id"],
-                    sender_type="vendedor",
-                    sender_name=vendedor_name,
-                    content=content
-                )
-
-                # Adiciona log de envio
-                self.db.add_lead_log(
-                    lead_id=lead["id"],
-                    action="mensagem_enviada",
-                    user_name=vendedor_name,
-                    details=content[:100]
-                )
-
-                # Notifica o front em tempo real
-                self.socketio.emit("message_sent", {
-                    "lead_id": lead["id"],
-                    "phone": phone,
-                    "content": content,
-                    "timestamp": datetime.now().isoformat(),
-                    "sender_type": "vendedor",
-                    "sender_id": vendedor_id
-                })
-
-                print("✅ Mensagem enviada e salva com sucesso")
-
-                
-
+            logger.debug("📤 Enviando mensagem para %s (tentativa %d/%d)", phone, attempt + 1, self.max_retries)
+            ok, error = self.deliver(phone, content)
+            if ok:
+                self.record_sent(lead, content, vendedor_id)
                 return True
 
-            except requests.exceptions.Timeout:
-                print(f"⏱️ Timeout na tentativa {attempt + 1}/{self.max_retries}")
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay)
-                else:
-                    print("❌ Timeout: VenomBot não responde.")
-                    return False
-                    
-            except requests.exceptions.ConnectionError:
-                print(f"🔌 Erro de conexão na tentativa {attempt + 1}/{self.max_retries}")
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay)
-                else:
-                    print("❌ VenomBot offline ou inacessível")
-                    return False
-                    
-            except Exception as e:
-                print(f"❌ Erro inesperado ao enviar mensagem: {e}")
-                import traceback
-                traceback.print_exc()
+            logger.warning("❌ %s", error)
+            if self.circuit_open():
                 return False
+            if attempt < self.max_retries - 1:
+                time.sleep(self.retry_delay)
         
         return False
 
+    def deliver(self, phone, content):
+        """
+        Uma única tentativa de entrega ao bridge (sem retry nem gravação)
+
+        Usado pela fila de saída (outbox.py), que cuida de retry e backoff.
+
+        Returns:
+            (True, None) se o bridge aceitou, (False, motivo) caso contrário
+        """
+        try:
+            response = self._request("POST", "/send", json={"phone": phone, "message": content})
+        except CircuitOpenError as e:
+            return False, str(e)
+        except requests.exceptions.Timeout:
+            return False, "Timeout: VenomBot não responde"
+        except requests.exceptions.ConnectionError:
+            return False, "VenomBot offline ou inacessível"
+        except requests.exceptions.RequestException as e:
+            return False, str(e)
+
+        if response.status_code != 200:
+            return False, f"HTTP {response.status_code}: {response.text[:200]}"
+        return True, None
+
+    def record_sent(self, lead, content, vendedor_id=None, outbox_id=None, owner=None):
+        """
+        Grava a mensagem entregue (mensagem + timeline) e notifica o front
+
+        Com outbox_id, só grava se o dispatcher owner ainda detém a reserva.
+
+        Returns:
+            False se a reserva da outbox foi perdida (nada é gravado)
+        """
+        # Busca nome do vendedor
+        vendedor_name = "Vendedor"
+        if vendedor_id:
+            user = self.db.get_user(vendedor_id)
+            if user:
+                vendedor_name = user["name"]
+
+        with self.db.transaction():
+            if outbox_id is not None and not self.db.mark_outbox_sent(outbox_id, owner):
+                # Lease vencido: outro worker assumiu a mensagem e registra o envio dele
+                logger.warning("⚠️ Outbox #%d: reserva perdida, envio não registrado", outbox_id)
+                return False
+
+            # Salva mensagem enviada
+            self.db.add_message(
+                lead_id=lead["id"],
+                sender_type="vendedor",
+                sender_name=vendedor_name,
+                content=content
+            )
+
+            # Adiciona log de envio
+            self.db.add_lead_log(
+                lead_id=lead["id"],
+                action="mensagem_enviada",
+                user_name=vendedor_name,
+                details=content[:100]
+            )
+
+        # Notifica o front em tempo real
+        self.socketio.emit("message_sent", {
+            "lead_id": lead["id"],
+            "phone": lead["phone"],
+            "content": content,
+            "timestamp": datetime.now().isoformat(),
+            "sender_type": "vendedor",
+            "sender_id": vendedor_id,
+            "outbox_id": outbox_id
+        }, to=lead_event_rooms(lead["id"], lead.get("assigned_to"), vendedor_id))
+
+        logger.info("✅ Mensagem enviada", extra={"lead_id": lead["id"], "outbox_id": outbox_id})
+        return True
+
     # =============================
     # STATUS E DESCONECTAR
     # =============================
     def get_status(self):
-        """Retorna status atual do VenomBot com informações detalhadas"""
-        status = self.check_connection()
-        
+        """
+        Status do VenomBot com informações detalhadas
+
+        Lê o estado da última verificação (mantido pelo HealthMonitor),
+        sem chamar o bridge.
+        """
         return {
-            "connected": status.get("connected", False),
-            "phone": status.get("phone", "Não conectado"),
+            "connected": self.is_ready,
+            "phone": self.phone or "Não conectado",
             "venom_url": self.venom_url,
             "is_ready": self.is_ready,
             "last_health_check": self.last_health_check.isoformat() if self.last_health_check else None,
             "connection_errors": self.connection_errors,
+            "circuit": self.breaker.get_status(),
             "health_status": "healthy" if self.connection_errors == 0 else "degraded" if self.connection_errors < 3 else "critical"
         }
 
     def disconnect(self):
         """Força desconexão manual do VenomBot"""
         try:
-            response = requests.post(f"{self.venom_url}/disconnect", timeout=5)
+            response = self._request("POST", "/disconnect", timeout=self.status_timeout)
             if response.status_code == 200:
-                print("🔌 Desconectado do WhatsApp com sucesso")
+                logger.info("🔌 Desconectado do WhatsApp com sucesso")
                 self.is_ready = False
+                self.phone = None
                 return {"success": True}
             return {"success": False, "error": response.text}
         except Exception as e:
-            print(f"❌ Erro ao desconectar: {e}")
-            return {"success": False, "error": str(e)}
\ No newline at end of file
+            logger.error("❌ Erro ao desconectar: %s", e)
+            return {"success": False, "error": str(e)}
@@ -87,8 +87,10 @@ const api = {
   // =============================
   // 🧾 MENSAGENS
   // =============================
-  getMessages: async (leadId) => {
-    const response = await axios.get(`${API_URL}/leads/${leadId}/messages`);
+  // Com params ({ limit, cursor, before_id, after_id }) retorna uma página:
+  // { items, has_more, next_cursor }. Sem params retorna a conversa inteira.
+  getMessages: async (leadId, params = undefined) => {
+    const response = await axios.get(`${API_URL}/leads/${leadId}/messages`, { params });
     return response.data;
   },
 
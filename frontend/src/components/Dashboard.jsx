@@ -34,24 +34,27 @@ export default function Dashboard({ user, onLogout }) {
 
   // ================= SOCKET.IO =================
   useEffect(() => {
-    const newSocket = io('http://localhost:5000', { transports: ['websocket'] });
+    const newSocket = io('http://localhost:5000', { transports: ['websocket'], withCredentials: true });
     setSocket(newSocket);
 
     newSocket.on('connect', () => {
       console.log('✅ Conectado ao Socket.io');
-      if (user?.role === 'admin' || user?.role === 'gestor') {
-        newSocket.emit('join_room', { room: 'gestores' });
+      // Salas do usuário/gestor são atribuídas pelo servidor a partir da sessão;
+      // aqui só entramos na conversa aberta
+      if (selectedLead) {
+        newSocket.emit('join_room', { room: `lead:${selectedLead.id}` });
       }
     });
 
-    // 📩 Nova mensagem
+    // 📩 Nova mensagem (o backend agrupa num único evento as mensagens do mesmo lead)
     newSocket.on('new_message', (data) => {
       if (selectedLead && data.lead_id === selectedLead.id) {
-        setMessages((prev) => [...prev, {
+        const incoming = data.messages || [{
           content: data.content,
           sender_type: data.sender_type,
           timestamp: data.timestamp,
-        }]);
+        }];
+        setMessages((prev) => [...prev, ...incoming]);
       } else {
         setNewMessagesCount((c) => c + 1);
         playSound(newMessageSound);
@@ -68,6 +71,22 @@ export default function Dashboard({ user, onLogout }) {
       refreshLeads();
     });
 
+    // 📤 Resultado da entrega (fila de saída)
+    newSocket.on('message_status', (data) => {
+      if (data.status === 'failed') {
+        toast.error(`❌ Falha ao enviar mensagem: ${data.error || 'erro desconhecido'}`);
+      }
+    });
+
+    // 📡 Mudança de conectividade do WhatsApp (monitor de saúde do backend)
+    newSocket.on('connection_status', (data) => {
+      if (data.whatsapp) {
+        toast.success('✅ WhatsApp conectado');
+      } else {
+        toast.warn('⚠️ WhatsApp desconectado — mensagens ficam na fila');
+      }
+    });
+
     newSocket.on('disconnect', () => {
       toast.warn('⚠️ Desconectado do servidor');
     });
@@ -145,7 +164,7 @@ export default function Dashboard({ user, onLogout }) {
         sender_name: user.name,
         timestamp: new Date().toISOString(),
       }]);
-      toast.success('✅ Mensagem enviada com sucesso!');
+      toast.success('📤 Mensagem na fila de envio');
       setMessageInput('');
     } catch {
       toast.error('❌ Falha ao enviar mensagem');
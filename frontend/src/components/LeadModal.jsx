@@ -37,7 +37,7 @@ export default function LeadModal({ lead, onClose, onOpenChat }) {
     setLoading(true);
     try {
       // Mensagens
-      const msgData = await api.getMessages(lead.id);
+      const msgData = await api.getMessages(lead.id, { limit: 5 });
       const msgs = msgData.items || msgData;
       setMessages(Array.isArray(msgs) ? msgs.slice(-5) : []);
     } catch {
@@ -13,6 +13,54 @@ app.use(bodyParser.json());
 
 const FLASK_URL = 'http://localhost:5000/api/webhook/message'; // Endpoint do Flask
 const PORT = 3001;
+const WEBHOOK_TOKEN = process.env.WEBHOOK_TOKEN || ''; // mesmo WEBHOOK_TOKEN do backend
+const WEBHOOK_MAX_ATTEMPTS = 8; // reenvio quando o Flask responde 429/5xx ou está fora do ar
+const WEBHOOK_RETRY_MAX_MS = 30000; // teto do backoff (o Retry-After do Flask vale como está)
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+// ============================
+// 📤 ENVIO PARA O FLASK (com reenvio)
+// ============================
+// O Flask só responde 200 depois de gravar a mensagem; 429, 5xx e falha de
+// rede são reenviados respeitando o Retry-After (o id da mensagem evita duplicar)
+async function sendToFlask(payload) {
+  const headers = { 'Content-Type': 'application/json' };
+  if (WEBHOOK_TOKEN) headers.Authorization = `Bearer ${WEBHOOK_TOKEN}`;
+
+  for (let attempt = 1; attempt <= WEBHOOK_MAX_ATTEMPTS; attempt++) {
+    let retryAfter = NaN;
+    try {
+      const response = await fetch(FLASK_URL, {
+        method: 'POST',
+        headers,
+        body: JSON.stringify(payload),
+      });
+
+      if (response.ok) {
+        console.log(`✅ Mensagem enviada ao Flask (${FLASK_URL}) com sucesso`);
+        return true;
+      }
+      const errorText = await response.text();
+      console.error(`❌ Erro ao enviar pro Flask: ${response.status} - ${errorText}`);
+      // 4xx (exceto 429, rate limit): payload recusado, reenviar não adianta
+      if (response.status < 500 && response.status !== 429) return false;
+      retryAfter = parseFloat(response.headers.get('retry-after'));
+    } catch (error) {
+      console.error('❌ Flask não respondeu:', error.message);
+    }
+
+    if (attempt < WEBHOOK_MAX_ATTEMPTS) {
+      const delay = Number.isFinite(retryAfter)
+        ? retryAfter * 1000
+        : Math.min(1000 * 2 ** (attempt - 1), WEBHOOK_RETRY_MAX_MS);
+      console.log(`🔁 Nova tentativa (${attempt + 1}/${WEBHOOK_MAX_ATTEMPTS}) em ${delay}ms`);
+      await sleep(delay);
+    }
+  }
+  console.error(`❌ Mensagem não entregue ao Flask após ${WEBHOOK_MAX_ATTEMPTS} tentativas`);
+  return false;
+}
 
 // ============================
 // 1️⃣ INICIALIZAÇÃO DO VENOM
@@ -77,21 +125,10 @@ function start(client) {
       console.log(`💬 Conteúdo: ${content}`);
       console.log('======================================================================');
 
-      // Envia pro Flask
-      const payload = { phone, content, name };
+      // Envia pro Flask (id do WhatsApp: o CRM descarta reentregas por ele)
+      const payload = { id: message.id, phone, content, name };
 
-      const response = await fetch(FLASK_URL, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(payload),
-      });
-
-      if (response.ok) {
-        console.log(`✅ Mensagem enviada ao Flask (${FLASK_URL}) com sucesso`);
-      } else {
-        const errorText = await response.text();
-        console.error(`❌ Erro ao enviar pro Flask: ${response.status} - ${errorText}`);
-      }
+      await sendToFlask(payload);
     } catch (error) {
       console.error('❌ Erro no processamento da mensagem:', error);
     }
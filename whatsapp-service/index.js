@@ -26,8 +26,13 @@ dotenv.config();
 const CONFIG = {
   SESSION_DIR: './auth_info_baileys',
   WEBHOOK_URL: process.env.WEBHOOK_URL || 'http://localhost:5000/api/webhook/message',
+  // Mesmo valor do WEBHOOK_TOKEN do backend (vazio = sem autenticação)
+  WEBHOOK_TOKEN: process.env.WEBHOOK_TOKEN || '',
   PORT: process.env.PORT || 3001,
   LOG_LEVEL: process.env.LOG_LEVEL || 'info',
+  // Reenvio ao webhook quando o CRM responde 429/5xx ou está fora do ar
+  WEBHOOK_MAX_ATTEMPTS: parseInt(process.env.WEBHOOK_MAX_ATTEMPTS || '8', 10),
+  WEBHOOK_RETRY_MAX_MS: parseInt(process.env.WEBHOOK_RETRY_MAX_MS || '30000', 10),
 };
 
 // ===================================
@@ -218,6 +223,7 @@ async function handleIncomingMessage(message) {
     const phoneClean = remoteJid.replace('@s.whatsapp.net', '');
     
     const payload = {
+      id: message.key.id,  // id do WhatsApp: o CRM descarta reentregas por ele
       from: phoneClean,  // ✅ SEM @c.us - Flask vai adicionar depois
       body: text,
       notifyName: pushName,
@@ -247,26 +253,58 @@ async function handleIncomingMessage(message) {
 // ===================================
 // ENVIAR PARA WEBHOOK
 // ===================================
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+// Espera antes da próxima tentativa: o Retry-After do CRM vale como está;
+// sem ele, backoff exponencial limitado a WEBHOOK_RETRY_MAX_MS
+function retryDelay(error, attempt) {
+  const retryAfter = parseFloat(error.response?.headers?.['retry-after']);
+  if (Number.isFinite(retryAfter)) return retryAfter * 1000;
+  return Math.min(1000 * 2 ** (attempt - 1), CONFIG.WEBHOOK_RETRY_MAX_MS);
+}
+
+// 429 (rate limit) e 5xx são temporários; outros 4xx são payload recusado
+const isRetryable = (status) => !status || status === 429 || status >= 500;
+
+// O CRM só responde 200 depois de gravar a mensagem; 429, 5xx e falha de
+// rede são reenviados (o id da mensagem evita duplicar no CRM)
 async function sendToWebhook(payload) {
-  try {
-    const response = await axios.post(CONFIG.WEBHOOK_URL, payload, {
-      headers: { 'Content-Type': 'application/json' },
-      timeout: 10000,
-    });
-    
-    logger.success(`Webhook chamado com sucesso (Status: ${response.status})`);
-    logger.debug('Resposta:', response.data);
-    
-  } catch (error) {
-    if (error.code === 'ECONNREFUSED') {
-      logger.error('Webhook não respondeu - CRM Backend offline?');
-    } else if (error.response) {
-      logger.error(`Webhook retornou erro ${error.response.status}`);
-      logger.debug('Detalhes:', error.response.data);
-    } else {
-      logger.error('Erro ao chamar webhook:', error.message);
+  const headers = { 'Content-Type': 'application/json' };
+  if (CONFIG.WEBHOOK_TOKEN) headers.Authorization = `Bearer ${CONFIG.WEBHOOK_TOKEN}`;
+
+  for (let attempt = 1; attempt <= CONFIG.WEBHOOK_MAX_ATTEMPTS; attempt++) {
+    try {
+      const response = await axios.post(CONFIG.WEBHOOK_URL, payload, {
+        headers,
+        timeout: 10000,
+      });
+      
+      logger.success(`Webhook chamado com sucesso (Status: ${response.status})`);
+      logger.debug('Resposta:', response.data);
+      return true;
+      
+    } catch (error) {
+      const status = error.response?.status;
+      if (error.code === 'ECONNREFUSED') {
+        logger.error('Webhook não respondeu - CRM Backend offline?');
+      } else if (error.response) {
+        logger.error(`Webhook retornou erro ${status}`);
+        logger.debug('Detalhes:', error.response.data);
+      } else {
+        logger.error('Erro ao chamar webhook:', error.message);
+      }
+      
+      // 4xx (exceto 429): payload recusado, reenviar não adianta
+      if (!isRetryable(status)) return false;
+      if (attempt < CONFIG.WEBHOOK_MAX_ATTEMPTS) {
+        const delay = retryDelay(error, attempt);
+        logger.warn(`Nova tentativa (${attempt + 1}/${CONFIG.WEBHOOK_MAX_ATTEMPTS}) em ${delay}ms`);
+        await sleep(delay);
+      }
     }
   }
+  logger.error(`Mensagem não entregue ao CRM após ${CONFIG.WEBHOOK_MAX_ATTEMPTS} tentativas`);
+  return false;
 }
 
 // ===================================